@@ -1,18 +1,31 @@
 import os
+import asyncio
 import json
 import mimetypes
 import base64
+import ctypes
+import gc
 import hashlib
+import io
 import logging
+import random
+import re
 import secrets
 import socket
 import sqlite3
 import subprocess
+import sys
 import threading
+import time
+import tracemalloc
 import uuid
-from datetime import datetime
+import zlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional
+from contextvars import ContextVar
+from typing import Callable, Optional
 from fastapi import (
     Depends,
     FastAPI,
@@ -24,21 +37,52 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
 )
-from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from cryptography.fernet import Fernet, InvalidToken
 from passlib.context import CryptContext
 from pydantic import BaseModel
+from starlette.datastructures import Headers, MutableHeaders
+
+# Необязательные ускорители: без orjson ответы кодирует json, без brotli сжимаем только gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Без Pillow галерея отдаёт вложения без превью
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH = BASE_DIR / "messenger.db"
-UPLOAD_DIR = BASE_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+DB_PATH = Path(os.getenv("DB_PATH", str(BASE_DIR / "messenger.db")))
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", str(BASE_DIR / "uploads")))
 ACCESS_CODE = "7xTM[xN[K0FEG&wMKU6TYBbyZMu}H7?v*PLsHAyV"
 
-app = FastAPI(title="LAN Messenger")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await _startup()
+    try:
+        yield
+    finally:
+        await _shutdown()
+
+class FastJSONResponse(JSONResponse):
+    # Ответ по умолчанию для всех маршрутов. Списочные эндпоинты отдают его
+    # напрямую, минуя jsonable_encoder: их данные уже из dict/list/str/int
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+app = FastAPI(title="LAN Messenger", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Добавляем CORS для кросс-платформенной работы
 app.add_middleware(
@@ -49,26 +93,608 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
+ASSET_DIST_DIR = BASE_DIR / "static" / "dist"
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# Имя, которое даёт scripts/build_assets.py: <имя>.<12 hex sha256>.<расширение>
+HASHED_ASSET_NAME = re.compile(r"^[\w-]+\.[0-9a-f]{12}\.\w+$")
+
+class PrecompressedStaticFiles(StaticFiles):
+    # static/dist собирает scripts/build_assets.py: имена с хэшем содержимого и
+    # рядом готовые .br/.gz — кэшируем навсегда и не сжимаем на лету.
+    # Остальная статика (режим разработки) — с перепроверкой по ETag
+    async def get_response(self, path: str, scope) -> Response:
+        parts = Path(path).parts
+        # manifest.json и прочее без хэша в имени лежит там же, но кэшироваться навсегда не должно
+        hashed = len(parts) == 2 and parts[0] == "dist" and HASHED_ASSET_NAME.match(parts[1]) is not None
+        response = None
+        if hashed and scope["method"] in ("GET", "HEAD"):
+            variants = await asyncio.to_thread(self._compressed_variants, path)
+            encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""), tuple(variants))
+            if encoding:
+                full_path, stat_result = variants[encoding]
+                response = self.file_response(full_path, stat_result, scope)
+                media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                if media_type.startswith("text/"):
+                    media_type += "; charset=utf-8"
+                response.headers["content-type"] = media_type
+                response.headers["content-encoding"] = encoding
+        if response is None:
+            response = await super().get_response(path, scope)
+        if hashed:
+            response.headers["cache-control"] = IMMUTABLE_CACHE
+            response.headers.add_vary_header("Accept-Encoding")
+        else:
+            response.headers["cache-control"] = "no-cache"
+        return response
+
+    def _compressed_variants(self, path: str) -> dict:
+        variants = {}
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            full_path, stat_result = self.lookup_path(path + suffix)
+            if stat_result is not None:
+                variants[encoding] = (full_path, stat_result)
+        return variants
+
+app.mount("/static", PrecompressedStaticFiles(directory=BASE_DIR / "static"), name="static")
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+asset_manifest: dict[str, str] = {}
+
+def load_asset_manifest():
+    # Без сборки или если исходник правили после неё — ссылаемся на сам /static/<имя>
+    asset_manifest.clear()
+    try:
+        files = json.loads((ASSET_DIST_DIR / "manifest.json").read_text(encoding="utf-8"))["files"]
+    except (OSError, ValueError, KeyError):
+        return
+    for name, entry in files.items():
+        try:
+            source_sha256 = hashlib.sha256((BASE_DIR / "static" / name).read_bytes()).hexdigest()
+        except OSError:
+            continue
+        if source_sha256 == entry["source_sha256"] and (ASSET_DIST_DIR / entry["file"]).is_file():
+            asset_manifest[name] = entry["file"]
+        else:
+            logger.warning("static/dist устарел для %s, запустите scripts/build_assets.py", name)
+
+def asset_url(name: str) -> str:
+    hashed = asset_manifest.get(name)
+    return f"/static/dist/{hashed}" if hashed else f"/static/{name}"
+
+templates.env.globals["asset"] = asset_url
 
 logger = logging.getLogger("lan_messenger")
 if not logger.handlers:
     logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
-db_lock = threading.Lock()
+
+# Метрики в текстовом формате Prometheus. Метки только из конечных множеств
+# (шаблон маршрута, полоса, имя блокировки), чтобы число рядов не росло
+LATENCY_BUCKETS_SEC = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS_BYTES = (1024, 16 * 1024, 128 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+
+def _metric_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self.values.items()):
+            lines.append(f"{self.name}{_metric_labels(self.labels, values)} {total:g}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS_SEC):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам..., +Inf, сумма]
+        self.values: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self.lock:
+            row = self.values.get(label_values)
+            if row is None:
+                row = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[idx] += 1
+            row[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, row in sorted(self.values.items()):
+            lines.extend(_render_histogram_rows(self.name, self.labels, values, self.buckets, row[:-1], row[-1]))
+        return lines
+
+def _render_histogram_rows(name: str, labels: tuple, values: tuple, buckets: tuple, counts: list, total: float) -> list[str]:
+    lines = []
+    running = 0
+    for bound, count in zip([*buckets, "+Inf"], counts):
+        running += count
+        le = 'le="%s"' % bound
+        lines.append(f"{name}_bucket{_metric_labels(labels, values, le)} {running}")
+    lines.append(f"{name}_sum{_metric_labels(labels, values)} {total:.6f}")
+    lines.append(f"{name}_count{_metric_labels(labels, values)} {running}")
+    return lines
+
+class GaugeFunc:
+    # Значение снимается в момент выдачи /metrics; fn возвращает число или {метки: число}
+    def __init__(self, name: str, help_text: str, fn, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labels = labels
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, number in items:
+            lines.append(f"{self.name}{_metric_labels(self.labels, values)} {number:g}")
+        return lines
+
+metrics_registry: list = []
+
+def register_metric(metric):
+    metrics_registry.append(metric)
+    return metric
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+http_request_seconds = register_metric(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status")))
+db_query_seconds = register_metric(Histogram(
+    "db_query_duration_seconds", "SQLite statement execution time by endpoint", ("endpoint",)))
+lock_wait_seconds = register_metric(Histogram(
+    "db_lock_wait_seconds", "Time spent waiting for a writer lock", ("lock",)))
+lock_hold_seconds = register_metric(Histogram(
+    "db_lock_hold_seconds", "Time a writer lock was held", ("lock",)))
+media_bytes_served = register_metric(Counter("media_served_bytes_total", "Decrypted media bytes sent to clients"))
+media_decrypt_seconds = register_metric(Histogram("media_decrypt_seconds", "Time to read and decrypt a media file"))
+upload_size_bytes = register_metric(Histogram(
+    "upload_size_bytes", "Size of uploaded files", ("kind",), buckets=SIZE_BUCKETS_BYTES))
+call_events = register_metric(Counter("call_events_total", "Call signalling frames received", ("event",)))
+compression_bytes = register_metric(Counter(
+    "http_compression_bytes_total", "Response bytes before (in) and after (out) compression", ("encoding", "stage")))
+compression_seconds = register_metric(Counter(
+    "http_compression_seconds_total", "CPU time spent compressing responses", ("encoding",)))
+
+# Эндпоинт, в рамках которого выполняется запрос к базе: в contextvar лежит
+# ASGI scope, а шаблон маршрута роутер дописывает в него уже после middleware
+metrics_scope: ContextVar[Optional[dict]] = ContextVar("metrics_scope", default=None)
+
+def current_endpoint() -> str:
+    scope = metrics_scope.get()
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+QUERY_PROFILE_SAMPLE = float(os.getenv("QUERY_PROFILE_SAMPLE", "0"))
+QUERY_SLOW_MS = float(os.getenv("QUERY_SLOW_MS", "100"))
+QUERY_PROFILE_MAX_TEMPLATES = int(os.getenv("QUERY_PROFILE_MAX_TEMPLATES", "500"))
+
+_SQL_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_NUMBER = re.compile(r"\b\d+\b")
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_SPACES = re.compile(r"\s+")
+
+def sql_template(sql: str) -> str:
+    # Шаблон запроса: списки IN (?, ?, ...) схлопываются, литералы заменяются на ?
+    sql = _SQL_STRING.sub("?", sql)
+    sql = _SQL_NUMBER.sub("?", sql)
+    sql = _SQL_PLACEHOLDER_LIST.sub("(?...)", sql)
+    return _SQL_SPACES.sub(" ", sql).strip()
+
+class QueryProfiler:
+    # Выборочный профиль запросов: время меряется для каждого запроса (оно уже
+    # нужно метрикам), а шаблон и статистика считаются для доли QUERY_PROFILE_SAMPLE
+    # и для всех медленных. У медленных сохраняется EXPLAIN QUERY PLAN; журнал
+    # медленных работает и без выборки, пока QUERY_SLOW_MS > 0
+    def __init__(self, sample: float, slow_ms: float, max_templates: int):
+        self.sample = sample
+        self.slow_sec = slow_ms / 1000
+        self.max_templates = max_templates
+        self.entries: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.sampled = 0
+        self.slow = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample > 0 or self.slow_sec > 0
+
+    def observe(self, conn: sqlite3.Connection, sql: str, parameters, elapsed: float, endpoint: str):
+        slow = self.slow_sec > 0 and elapsed >= self.slow_sec
+        if not slow and (self.sample <= 0 or random.random() >= self.sample):
+            return
+        template = sql_template(sql)
+        plan = None
+        if slow:
+            plan = self._plan(conn, sql, parameters)
+            logger.warning("slow query %.1f ms at %s: %s\n%s", elapsed * 1000, endpoint, template, "\n".join(plan or []))
+        with self.lock:
+            entry = self.entries.get(template)
+            if entry is None:
+                if len(self.entries) >= self.max_templates:
+                    template = "<other>"
+                    entry = self.entries.get(template)
+                if entry is None:
+                    entry = self.entries[template] = {
+                        "count": 0, "total_sec": 0.0, "max_sec": 0.0, "slow": 0, "endpoints": set(), "plan": None,
+                    }
+            entry["count"] += 1
+            entry["total_sec"] += elapsed
+            entry["max_sec"] = max(entry["max_sec"], elapsed)
+            if len(entry["endpoints"]) < 10:
+                entry["endpoints"].add(endpoint)
+            if slow:
+                entry["slow"] += 1
+                entry["plan"] = plan
+                self.slow += 1
+            self.sampled += 1
+
+    def _plan(self, conn: sqlite3.Connection, sql: str, parameters) -> Optional[list[str]]:
+        # EXPLAIN QUERY PLAN не выполняет запрос; идём мимо обёртки, чтобы не считать его самого
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return None
+        return [row[-1] for row in rows]
+
+    def top(self, limit: int, sort: str) -> list[dict]:
+        key = {"total": "total_sec", "max": "max_sec", "count": "count", "slow": "slow"}[sort]
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda item: item[1][key], reverse=True)[:limit]
+            result = []
+            for template, entry in items:
+                result.append({
+                    "sql": template,
+                    "count": entry["count"],
+                    "total_ms": round(entry["total_sec"] * 1000, 3),
+                    "avg_ms": round(entry["total_sec"] * 1000 / entry["count"], 3),
+                    "max_ms": round(entry["max_sec"] * 1000, 3),
+                    "slow": entry["slow"],
+                    "endpoints": sorted(entry["endpoints"]),
+                    "plan": entry["plan"],
+                })
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.sampled = 0
+            self.slow = 0
+
+query_profiler = QueryProfiler(QUERY_PROFILE_SAMPLE, QUERY_SLOW_MS, QUERY_PROFILE_MAX_TEMPLATES)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=(), /):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = current_endpoint()
+            db_query_seconds.observe(elapsed, endpoint)
+            if query_profiler.enabled:
+                query_profiler.observe(self, sql, parameters, elapsed, endpoint)
+
+    def executemany(self, sql, parameters, /):
+        # Для EXPLAIN QUERY PLAN нужен первый набор параметров, поэтому генератор
+        # разворачиваем в список
+        if query_profiler.enabled and not isinstance(parameters, (list, tuple)):
+            parameters = list(parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            endpoint = current_endpoint()
+            db_query_seconds.observe(elapsed, endpoint)
+            if query_profiler.enabled:
+                query_profiler.observe(self, sql, parameters[0] if parameters else (), elapsed, endpoint)
+
+class InstrumentedLock:
+    # threading.Lock с замером ожидания и удержания; используется как обычный лок
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        started = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            lock_wait_seconds.observe(self._acquired_at - started, self.name)
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        lock_hold_seconds.observe(held, self.name)
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class MetricsMiddleware:
+    # Чистый ASGI, без BaseHTTPMiddleware: на запрос одна гистограмма и contextvar
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in {"http", "websocket"}:
+            await self.app(scope, receive, send)
+            return
+        token = metrics_scope.set(scope)
+        if scope["type"] == "websocket":
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                metrics_scope.reset(token)
+            return
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics_scope.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                path = route.path
+            elif scope["path"].startswith("/static/"):
+                path = "/static"
+            else:
+                path = "unmatched"
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], path, f"{status // 100}xx")
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "text/", "image/svg+xml")
+
+def negotiate_encoding(accept_encoding: str, offered: Optional[tuple] = None) -> Optional[str]:
+    # Accept-Encoding с q-значениями; при равном весе br выигрывает у gzip.
+    # offered — что есть у сервера: по умолчанию то, что умеем сжимать на лету
+    if offered is None:
+        offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for encoding in ("br", "gzip"):
+        if encoding not in offered:
+            continue
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+class ResponseCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self.obj = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            # wbits=31 — zlib-поток в обёртке gzip
+            self.obj = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        started = time.process_time()
+        if self.encoding == "br":
+            out = self.obj.process(data) + (self.obj.finish() if final else self.obj.flush())
+        else:
+            out = self.obj.compress(data) + self.obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        compression_seconds.inc(self.encoding, amount=time.process_time() - started)
+        compression_bytes.inc(self.encoding, "in", amount=len(data))
+        compression_bytes.inc(self.encoding, "out", amount=len(out))
+        return out
+
+class CompressionMiddleware:
+    # gzip/brotli для текстовых ответов от COMPRESS_MIN_BYTES. Решение принимается
+    # по первому куску тела: потоковые ответы (bootstrap?stream=1, статика)
+    # сжимаются по кускам со сбросом буфера, чтобы клиент не ждал конца
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD" or COMPRESS_MIN_BYTES < 0:
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        if encoding is None or "range" in request_headers:
+            await self.app(scope, receive, send)
+            return
+        start_message = None
+        compressor: Optional[ResponseCompressor] = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if start_message is None:
+                if compressor is not None:
+                    message = {"type": "http.response.body", "body": compressor.compress(body, not more), "more_body": more}
+                await send(message)
+                return
+            start, start_message = start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            if (
+                start["status"] in {204, 206, 304}
+                or "content-encoding" in headers
+                or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                or (not more and len(body) < COMPRESS_MIN_BYTES)
+            ):
+                await send(start)
+                await send(message)
+                return
+            compressor = ResponseCompressor(encoding)
+            data = compressor.compress(body, not more)
+            headers["content-encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["etag"] = "W/" + etag
+            if more:
+                del headers["content-length"]
+            else:
+                headers["content-length"] = str(len(data))
+            await send(start)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_wrapper)
+
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+db_lock = InstrumentedLock("core")
 
 # Хранилища состояния WebSocket
 active_connections: dict[int, set[WebSocket]] = {}
-call_rooms: dict[int, dict[int, WebSocket]] = {}
-call_states: dict[int, dict[int, dict]] = {}
-call_debug_counts: dict[tuple[int, str], int] = {}
+
+class CallRoomRegistry:
+    # Комнаты звонков с обратными индексами: пользователь -> комнаты и сокет -> комнаты,
+    # чтобы отключение сокета или удаление аккаунта не требовали обхода всех комнат
+    def __init__(self):
+        self.rooms: dict[int, dict[int, WebSocket]] = {}
+        self.states: dict[int, dict[int, dict]] = {}
+        self.user_rooms: dict[int, set[int]] = {}
+        self.socket_rooms: dict[WebSocket, set[int]] = {}
+
+    def room(self, chat_id: int) -> dict[int, WebSocket]:
+        return self.rooms.get(chat_id, {})
+
+    def room_states(self, chat_id: int) -> dict[int, dict]:
+        return self.states.get(chat_id, {})
+
+    def is_in_room(self, chat_id: int, user_id: int, ws: WebSocket) -> bool:
+        return self.rooms.get(chat_id, {}).get(user_id) is ws
+
+    def peers(self, chat_id: int, user_id: int) -> list[WebSocket]:
+        return [peer_ws for uid, peer_ws in self.rooms.get(chat_id, {}).items() if uid != user_id]
+
+    def join(self, chat_id: int, user_id: int, ws: WebSocket, state: dict) -> bool:
+        room = self.rooms.setdefault(chat_id, {})
+        was_empty = len(room) == 0
+        previous = room.get(user_id)
+        if previous is not None and previous is not ws:
+            self._unlink_socket(previous, chat_id)
+        room[user_id] = ws
+        self.states.setdefault(chat_id, {})[user_id] = state
+        self.user_rooms.setdefault(user_id, set()).add(chat_id)
+        self.socket_rooms.setdefault(ws, set()).add(chat_id)
+        return was_empty
+
+    def set_state(self, chat_id: int, user_id: int, state: dict):
+        self.states.setdefault(chat_id, {})[user_id] = state
+
+    def leave(self, chat_id: int, user_id: int, ws: WebSocket) -> Optional[list[WebSocket]]:
+        if not self.is_in_room(chat_id, user_id, ws):
+            return None
+        room = self.rooms[chat_id]
+        room.pop(user_id, None)
+        self.states.get(chat_id, {}).pop(user_id, None)
+        self._unlink_socket(ws, chat_id)
+        user_rooms = self.user_rooms.get(user_id)
+        if user_rooms is not None:
+            user_rooms.discard(chat_id)
+            if not user_rooms:
+                self.user_rooms.pop(user_id, None)
+        if not room:
+            self.rooms.pop(chat_id, None)
+            self.states.pop(chat_id, None)
+        return list(room.values())
+
+    def leave_socket(self, ws: WebSocket, user_id: int) -> list[tuple[int, list[WebSocket]]]:
+        left = []
+        for chat_id in list(self.socket_rooms.get(ws, ())):
+            peers = self.leave(chat_id, user_id, ws)
+            if peers is not None:
+                left.append((chat_id, peers))
+        self.socket_rooms.pop(ws, None)
+        return left
+
+    def leave_user(self, user_id: int) -> list[tuple[int, list[WebSocket]]]:
+        # Со всех устройств сразу: пользователь мог быть в разных звонках с разных сокетов
+        left = []
+        for chat_id in list(self.user_rooms.get(user_id, ())):
+            peers = self.leave(chat_id, user_id, self.rooms[chat_id][user_id])
+            if peers is not None:
+                left.append((chat_id, peers))
+        return left
+
+    def _unlink_socket(self, ws: WebSocket, chat_id: int):
+        chats = self.socket_rooms.get(ws)
+        if chats is None:
+            return
+        chats.discard(chat_id)
+        if not chats:
+            self.socket_rooms.pop(ws, None)
+
+call_registry = CallRoomRegistry()
+
+CALL_EVENTS = {"call:join", "call:leave", "call:state", "call:signal"}
 
 def _call_dbg(chat_id: int, event: str, **kwargs):
-    key = (chat_id, event)
-    call_debug_counts[key] = call_debug_counts.get(key, 0) + 1
-    logger.debug("call chat=%s event=%s count=%s data=%s", chat_id, event, call_debug_counts[key], kwargs)
+    call_events.inc(event if event in CALL_EVENTS else "other")
+    logger.debug("call chat=%s event=%s data=%s", chat_id, event, kwargs)
 
 def _build_ice_servers() -> list[dict]:
     raw = os.getenv("RTC_ICE_SERVERS", "").strip()
@@ -115,7 +741,7 @@ def _build_ice_servers() -> list[dict]:
         servers.append(turn_cfg)
     return servers
 
-ICE_SERVERS = _build_ice_servers()
+ICE_SERVERS: list[dict] = []
 
 def _detect_windows_lan_ip() -> Optional[str]:
     command = [
@@ -196,7 +822,7 @@ def _build_file_fernet() -> Fernet:
     digest = hashlib.sha256(ACCESS_CODE.encode("utf-8")).digest()
     return Fernet(base64.urlsafe_b64encode(digest))
 
-FILE_FERNET = _build_file_fernet()
+FILE_FERNET: Optional[Fernet] = None
 
 def write_encrypted_file(path: Path, payload: bytes):
     path.write_bytes(FILE_FERNET.encrypt(payload))
@@ -251,6 +877,13 @@ class PasswordChangeIn(BaseModel):
     old_password: str
     new_password: str
 
+class ReadIn(BaseModel):
+    up_to_id: Optional[int] = None
+
+class RetentionIn(BaseModel):
+    max_age_days: Optional[int] = None
+    max_count: Optional[int] = None
+
 VALID_SETTING_VALUES = {
     "allow_friend_requests": {"everyone", "friends", "nobody"},
     "allow_calls_from": {"everyone", "friends", "nobody"},
@@ -260,7 +893,7 @@ VALID_SETTING_VALUES = {
 }
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -282,8 +915,194 @@ def serialize_user(row: sqlite3.Row) -> dict:
         "about": row["about"] or "",
     }
 
+SEARCH_ENABLED = True
+SEARCH_MARK_OPEN = "\x02"
+SEARCH_MARK_CLOSE = "\x03"
+
+def get_meta(conn: sqlite3.Connection, key: str, default: Optional[str] = None) -> Optional[str]:
+    row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+def set_meta(conn: sqlite3.Connection, key: str, value) -> None:
+    conn.execute(
+        "INSERT INTO app_meta(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, str(value)),
+    )
+
+def init_search_index(conn: sqlite3.Connection) -> None:
+    # Обычная (не external content) FTS5-таблица: удаление ещё не проиндексированной
+    # строки безопасно, пока фоновая сборка индекса не дошла до старых сообщений.
+    # chat_id проиндексирован как токен, чтобы поиск внутри чата пересекал списки в FTS
+    global SEARCH_ENABLED
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+    if exists:
+        return
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5("
+            "text, file_name, chat_id, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError as exc:
+        SEARCH_ENABLED = False
+        logger.warning("FTS5 недоступен, поиск по сообщениям отключён: %s", exc)
+        return
+    conn.execute(
+        "CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, text, file_name, chat_id) VALUES (new.id, new.text, new.file_name, new.chat_id); "
+        "END"
+    )
+    conn.execute(
+        "CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN "
+        "DELETE FROM messages_fts WHERE rowid = old.id; "
+        "END"
+    )
+    conn.execute(
+        "CREATE TRIGGER messages_fts_au AFTER UPDATE OF text, file_name, chat_id ON messages BEGIN "
+        "DELETE FROM messages_fts WHERE rowid = old.id; "
+        "INSERT INTO messages_fts(rowid, text, file_name, chat_id) VALUES (new.id, new.text, new.file_name, new.chat_id); "
+        "END"
+    )
+    # Всё, что уже лежит в messages, индексирует scripts/build_search_index.py
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    set_meta(conn, "messages_fts_backfill_upto", last_id)
+
+USER_TRIGRAM_ENABLED = True
+
+def nickname_key(nickname: str) -> str:
+    return (nickname or "").strip().lower()
+
+def init_user_index(conn: sqlite3.Connection) -> None:
+    # Триграммный индекс для поиска подстроки в username/нике; таблица пользователей
+    # небольшая, поэтому заполняем её сразу
+    global USER_TRIGRAM_ENABLED
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'").fetchone()
+    if exists:
+        return
+    try:
+        conn.execute("CREATE VIRTUAL TABLE users_fts USING fts5(username, nickname, tokenize = 'trigram')")
+    except sqlite3.OperationalError as exc:
+        USER_TRIGRAM_ENABLED = False
+        logger.warning("Триграммный индекс недоступен, поиск людей через LIKE: %s", exc)
+        return
+    conn.execute(
+        "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, username, nickname) VALUES (new.id, new.username, new.nickname); "
+        "END"
+    )
+    conn.execute(
+        "CREATE TRIGGER users_fts_ad AFTER DELETE ON users BEGIN "
+        "DELETE FROM users_fts WHERE rowid = old.id; "
+        "END"
+    )
+    conn.execute(
+        "CREATE TRIGGER users_fts_au AFTER UPDATE OF username, nickname ON users BEGIN "
+        "DELETE FROM users_fts WHERE rowid = old.id; "
+        "INSERT INTO users_fts(rowid, username, nickname) VALUES (new.id, new.username, new.nickname); "
+        "END"
+    )
+    conn.execute("INSERT INTO users_fts(rowid, username, nickname) SELECT id, username, nickname FROM users")
+
+def backfill_message_index(batch: int = 5000, pause: float = 0.0, progress=None, store=None) -> int:
+    # Идём от новых сообщений к старым короткими транзакциями, чтобы не держать запись.
+    # store — шард сообщений; по умолчанию основная база
+    done = 0
+    conn = store.connect() if store else get_db()
+    lock = store.lock if store else db_lock
+    try:
+        while True:
+            with lock, conn:
+                upto = int(get_meta(conn, "messages_fts_backfill_upto", "0") or 0)
+                if upto <= 0:
+                    break
+                low = max(upto - batch, 0)
+                cur = conn.execute(
+                    "INSERT INTO messages_fts(rowid, text, file_name, chat_id) "
+                    "SELECT id, text, file_name, chat_id FROM messages WHERE id > ? AND id <= ?",
+                    (low, upto),
+                )
+                set_meta(conn, "messages_fts_backfill_upto", low)
+            done += max(cur.rowcount, 0)
+            if progress:
+                progress(done, low)
+            if pause:
+                time.sleep(pause)
+    finally:
+        conn.close()
+    return done
+
+MESSAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS app_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'text',
+    text TEXT,
+    file_path TEXT,
+    file_name TEXT,
+    mime_type TEXT,
+    reply_to_message_id INTEGER,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+);
+CREATE TABLE IF NOT EXISTS message_deleted_for (
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    UNIQUE(message_id, user_id),
+    FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS message_reads (
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    read_at TEXT NOT NULL,
+    PRIMARY KEY (message_id, user_id),
+    FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS archive_ranges (
+    chat_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    min_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, month)
+);
+"""
+
+def init_message_tables(conn: sqlite3.Connection) -> None:
+    # Таблицы сообщений живут либо в основной базе, либо в каждом шарде
+    conn.executescript(MESSAGE_SCHEMA)
+    message_cols = {
+        row["name"]
+        for row in conn.execute("PRAGMA table_info(messages)").fetchall()
+    }
+    if "reply_to_message_id" not in message_cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN reply_to_message_id INTEGER")
+    if "file_size" not in message_cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN file_size INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_file ON messages(file_path) WHERE file_path IS NOT NULL")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_media ON messages(chat_id, kind, id) "
+        "WHERE file_path IS NOT NULL"
+    )
+    init_search_index(conn)
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    # auto_vacuum можно включить только до создания первой таблицы (иначе нужен VACUUM),
+    # поэтому делаем это для новых файлов: тогда retention сможет отдавать место кусками
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
 def init_db():
     conn = get_db()
+    enable_incremental_vacuum(conn)
     with conn:
         conn.executescript("""
 PRAGMA journal_mode=WAL;
@@ -346,6 +1165,13 @@ CREATE TABLE IF NOT EXISTS chats (
     created_at TEXT NOT NULL,
     FOREIGN KEY(created_by) REFERENCES users(id)
 );
+CREATE TABLE IF NOT EXISTS chat_retention (
+    chat_id INTEGER PRIMARY KEY,
+    max_age_days INTEGER,
+    max_count INTEGER,
+    updated_by INTEGER,
+    updated_at TEXT NOT NULL
+);
 CREATE TABLE IF NOT EXISTS chat_members (
     chat_id INTEGER NOT NULL,
     user_id INTEGER NOT NULL,
@@ -355,28 +1181,6 @@ CREATE TABLE IF NOT EXISTS chat_members (
     FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE,
     FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
 );
-CREATE TABLE IF NOT EXISTS messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    chat_id INTEGER NOT NULL,
-    user_id INTEGER NOT NULL,
-    kind TEXT NOT NULL DEFAULT 'text',
-    text TEXT,
-    file_path TEXT,
-    file_name TEXT,
-    mime_type TEXT,
-    reply_to_message_id INTEGER,
-    created_at TEXT NOT NULL,
-    FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-);
-CREATE TABLE IF NOT EXISTS message_deleted_for (
-    message_id INTEGER NOT NULL,
-    user_id INTEGER NOT NULL,
-    created_at TEXT NOT NULL,
-    UNIQUE(message_id, user_id),
-    FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
-    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-);
 CREATE TABLE IF NOT EXISTS custom_assets (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
@@ -400,14 +1204,21 @@ CREATE TABLE IF NOT EXISTS group_invites (
     FOREIGN KEY(inviter_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY(invitee_id) REFERENCES users(id) ON DELETE CASCADE
 );
-CREATE TABLE IF NOT EXISTS message_reads (
-    message_id INTEGER NOT NULL,
-    user_id INTEGER NOT NULL,
-    read_at TEXT NOT NULL,
-    PRIMARY KEY (message_id, user_id),
-    FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
-    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    finished_at TEXT
 );
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, run_after, id);
         """)
         settings_cols = {
             row["name"]
@@ -425,66 +1236,1100 @@ CREATE TABLE IF NOT EXISTS message_reads (
         if "avatar" not in chat_cols:
             conn.execute("ALTER TABLE chats ADD COLUMN avatar TEXT")
 
-        message_cols = {
+        user_cols = {
             row["name"]
-            for row in conn.execute("PRAGMA table_info(messages)").fetchall()
+            for row in conn.execute("PRAGMA table_info(users)").fetchall()
         }
-        if "reply_to_message_id" not in message_cols:
-            conn.execute("ALTER TABLE messages ADD COLUMN reply_to_message_id INTEGER")
+        if "last_seen" not in user_cols:
+            conn.execute("ALTER TABLE users ADD COLUMN last_seen TEXT")
+        if "nickname_key" not in user_cols:
+            conn.execute("ALTER TABLE users ADD COLUMN nickname_key TEXT")
+        # SQLite lower() не знает кириллицу, поэтому ключ ника считаем в Python
+        pending_keys = conn.execute("SELECT id, nickname FROM users WHERE nickname_key IS NULL").fetchall()
+        conn.executemany(
+            "UPDATE users SET nickname_key = ? WHERE id = ?",
+            [(nickname_key(r["nickname"]), r["id"]) for r in pending_keys],
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_nickname_key ON users(nickname_key)")
+
+        init_message_tables(conn)
+        init_user_index(conn)
 
     conn.close()
 
-init_db()
+def message_id_high_water(conn: sqlite3.Connection) -> int:
+    # AUTOINCREMENT помнит наибольший выданный id (и явно вставленный тоже) и не опускает его при удалении
+    row = conn.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'messages'").fetchone()
+    top = conn.execute("SELECT COALESCE(MAX(id), 0) FROM main.messages").fetchone()[0]
+    return max(row[0] if row else 0, top)
 
+MESSAGE_SHARDS = int(os.getenv("MESSAGE_SHARDS", "0"))
+SHARD_DIR = Path(os.getenv("SHARD_DIR", str(DB_PATH.parent / "shards")))
 
-def get_user_by_token(token: str) -> Optional[sqlite3.Row]:
+def shard_path(count: int, index: int) -> Path:
+    return SHARD_DIR / str(count) / f"messages_{index}.db"
+
+class MessageStore:
+    # Хранилище сообщений: основная база (path=None, общий db_lock) или шард
+    # со своим файлом и своим писателем. В шарде основная база подключена как
+    # core, поэтому users/chats/chat_members в запросах резолвятся без префикса
+    def __init__(self, index: int, count: int, path: Optional[Path], lock: InstrumentedLock):
+        self.index = index
+        self.count = count
+        self.path = path
+        self.lock = lock
+        self.id_floor = 0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.path is None:
+            return get_db()
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("ATTACH DATABASE ? AS core", (str(DB_PATH),))
+        return conn
+
+    def init(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        enable_incremental_vacuum(conn)
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            init_message_tables(conn)
+            self.id_floor = int(get_meta(conn, "message_id_floor", "0") or 0)
+        conn.close()
+
+    def next_message_id(self, conn: sqlite3.Connection) -> int:
+        # id сообщений глобально уникальны: шард i выдаёт только id = i (mod N),
+        # не меньше порога, оставшегося после перешардирования. Считаем от
+        # sqlite_sequence, а не от MAX(id): удаление и архивация опускают MAX(id),
+        # и id удалённого сообщения достался бы следующему
+        last = max(message_id_high_water(conn), self.id_floor)
+        return last + 1 + (self.index - last - 1) % self.count
+
+    def insert_message(self, conn: sqlite3.Connection, values: dict) -> int:
+        with self.lock, conn:
+            if self.path is not None:
+                values = {"id": self.next_message_id(conn), **values}
+            cur = conn.execute(
+                f"INSERT INTO messages({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                list(values.values()),
+            )
+        return cur.lastrowid
+
+def _init_message_stores() -> list[MessageStore]:
     conn = get_db()
-    row = conn.execute(
-        "SELECT u.* FROM sessions s JOIN users u ON u.id = s.user_id WHERE s.token = ?",
-        (token,),
-    ).fetchone()
+    current = int(get_meta(conn, "message_shards", "0") or 0)
+    if current != MESSAGE_SHARDS:
+        has_messages = conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone()
+        if current or has_messages:
+            conn.close()
+            raise RuntimeError(
+                f"База разбита на {current} шардов, а MESSAGE_SHARDS={MESSAGE_SHARDS}: "
+                f"запустите scripts/reshard.py --shards {MESSAGE_SHARDS}"
+            )
+        with conn:
+            set_meta(conn, "message_shards", MESSAGE_SHARDS)
     conn.close()
-    return row
+    if not MESSAGE_SHARDS:
+        return [MessageStore(0, 1, None, db_lock)]
+    stores = [
+        MessageStore(i, MESSAGE_SHARDS, shard_path(MESSAGE_SHARDS, i), InstrumentedLock("shard"))
+        for i in range(MESSAGE_SHARDS)
+    ]
+    for store in stores:
+        store.init()
+    return stores
 
-def get_current_user(request: Request) -> sqlite3.Row:
-    auth = request.headers.get("Authorization", "")
-    if not auth.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    token = auth.replace("Bearer ", "", 1).strip()
-    user = get_user_by_token(token)
-    if not user:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return user
+message_stores: list[MessageStore] = []
+runtime_state = {"initialized": False, "ready": False, "draining": False, "init_ms": None, "process_to_ready_ms": None}
 
-def ensure_settings(conn: sqlite3.Connection, user_id: int):
-    cols = {
-        row["name"]
-        for row in conn.execute("PRAGMA table_info(user_settings)").fetchall()
-    }
-    if "theme" not in cols:
-        conn.execute(
-            "ALTER TABLE user_settings ADD COLUMN theme TEXT NOT NULL DEFAULT 'default'"
-        )
+def init_runtime():
+    # Всё, что трогает диск и базу, выполняется здесь, а не при импорте:
+    # приложение вызывает это при старте (lifespan), скрипты — сразу после import app
+    global ICE_SERVERS, FILE_FERNET
+    if runtime_state["initialized"]:
+        return
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    init_db()
+    message_stores[:] = _init_message_stores()
+    ICE_SERVERS = _build_ice_servers()
+    FILE_FERNET = _build_file_fernet()
+    load_asset_manifest()
+    runtime_state["initialized"] = True
 
-    conn.execute(
-        """
-        INSERT OR IGNORE INTO user_settings(
-            user_id,
-            allow_friend_requests,
-            allow_calls_from,
-            allow_group_invites,
-            show_last_seen,
-            theme
-        )
-        VALUES (?, 'everyone', 'friends', 'friends', 'friends', 'default')
-        """,
-        (user_id,),
-    )
+def store_for_chat(chat_id: int) -> MessageStore:
+    return message_stores[chat_id % len(message_stores)]
 
-def get_settings(conn: sqlite3.Connection, user_id: int) -> dict:
-    ensure_settings(conn, user_id)
-    row = conn.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
-    return dict(row)
+def stores_for_chats(chat_ids) -> dict[MessageStore, list[int]]:
+    grouped: dict[MessageStore, list[int]] = {}
+    for chat_id in chat_ids:
+        grouped.setdefault(store_for_chat(chat_id), []).append(chat_id)
+    return grouped
+
+def message_conn(store: MessageStore, conn: Optional[sqlite3.Connection] = None) -> sqlite3.Connection:
+    # Без шардов сообщения лежат в основной базе — переиспользуем соединение вызывающего
+    if store.path is None and conn is not None:
+        return conn
+    return store.connect()
+
+def release_message_conn(mconn: sqlite3.Connection, conn: Optional[sqlite3.Connection] = None):
+    if mconn is not conn:
+        mconn.close()
+
+def locate_message(message_id: int, conn: sqlite3.Connection):
+    # Сначала шард, который выдал бы этот id; после перешардирования старые id
+    # могут лежать в любом, поэтому дальше проверяем остальные, а затем архивы,
+    # в диапазоны которых попадает id
+    first = message_stores[message_id % len(message_stores)]
+    hot = [first] + [s for s in message_stores if s is not first]
+    months: list[str] = []
+    for store in hot:
+        mconn = message_conn(store, conn)
+        row = mconn.execute("SELECT id, chat_id, user_id FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row:
+            return store, mconn, row
+        months += [
+            r["month"]
+            for r in mconn.execute("SELECT DISTINCT month FROM archive_ranges WHERE min_id <= ? AND max_id >= ?", (message_id, message_id))
+        ]
+        release_message_conn(mconn, conn)
+    for month in dict.fromkeys(months):
+        store = archive_store(month)
+        aconn = store.connect()
+        row = aconn.execute("SELECT id, chat_id, user_id FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row:
+            return store, aconn, row
+        aconn.close()
+    return None, None, None
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", str(DB_PATH.parent / "archive")))
+ARCHIVE_INTERVAL_SEC = int(os.getenv("ARCHIVE_INTERVAL_SEC", "3600"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_PAUSE_SEC = float(os.getenv("ARCHIVE_PAUSE_MS", "20")) / 1000
+MESSAGE_COLUMNS = (
+    "id", "chat_id", "user_id", "kind", "text", "file_path", "file_name",
+    "mime_type", "reply_to_message_id", "file_size", "created_at",
+)
+
+archive_stores: dict[str, MessageStore] = {}
+# Архивы открывают из потоков архиватора, поиска, ленты и retention: два
+# MessageStore на один месяц дали бы два писателя со своими блокировками
+archive_stores_lock = threading.Lock()
+
+def archive_store(month: str) -> MessageStore:
+    # Помесячный архив: та же схема, что у горячей базы (с FTS), открывается по требованию
+    store = archive_stores.get(month)
+    if store is None:
+        with archive_stores_lock:
+            store = archive_stores.get(month)
+            if store is None:
+                store = MessageStore(0, 1, ARCHIVE_DIR / f"messages_{month.replace('-', '_')}.db", InstrumentedLock("archive"))
+                store.init()
+                archive_stores[month] = store
+    return store
+
+def archive_stores_for(chat_id: int, message_id: int) -> list[MessageStore]:
+    # Архивы, в чей диапазон id этого чата попадает сообщение: туда его мог унести архиватор
+    mconn = store_for_chat(chat_id).connect()
+    rows = mconn.execute(
+        "SELECT month FROM archive_ranges WHERE chat_id = ? AND min_id <= ? AND max_id >= ?",
+        (chat_id, message_id, message_id),
+    ).fetchall()
+    mconn.close()
+    return [archive_store(r["month"]) for r in rows]
+
+def archive_months() -> list[str]:
+    months = [p.stem.removeprefix("messages_").replace("_", "-") for p in ARCHIVE_DIR.glob("messages_*.db")]
+    return sorted(months, reverse=True)
+
+def chat_archive_months(mconn: sqlite3.Connection, chat_id: int, before_id: int) -> list[str]:
+    rows = mconn.execute(
+        "SELECT month FROM archive_ranges WHERE chat_id = ? AND min_id < ? ORDER BY max_id DESC",
+        (chat_id, before_id),
+    ).fetchall()
+    return [r["month"] for r in rows]
+
+class MessageArchiver:
+    # Переносит сообщения старше ARCHIVE_AFTER_DAYS из горячих баз в помесячные
+    # архивы. Пачка сначала фиксируется в архиве, потом одной короткой транзакцией
+    # удаляется из горячей базы вместе с отметкой в archive_ranges; повтор после
+    # сбоя безопасен (INSERT OR IGNORE)
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+        self.runs = 0
+        self.moved_total = 0
+        self.last_run: Optional[dict] = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ARCHIVE_AFTER_DAYS > 0,
+            "after_days": ARCHIVE_AFTER_DAYS,
+            "running": self.running,
+            "runs": self.runs,
+            "moved_total": self.moved_total,
+            "last_run": self.last_run,
+            "months": archive_months(),
+        }
+
+    def start(self):
+        if ARCHIVE_AFTER_DAYS > 0 and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as exc:
+                logger.warning("archiver run failed: %s", exc)
+            await asyncio.sleep(ARCHIVE_INTERVAL_SEC)
+
+    async def run(self) -> dict:
+        if self.running:
+            return {"skipped": True}
+        self.running = True
+        try:
+            return await asyncio.to_thread(self.run_once)
+        finally:
+            self.running = False
+
+    def run_once(self) -> dict:
+        started = time.monotonic()
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        moved = 0
+        touched: set[str] = set()
+        for store in message_stores:
+            while True:
+                count, months = self._move_batch(store, cutoff)
+                moved += count
+                touched |= months
+                if count < ARCHIVE_BATCH:
+                    break
+                time.sleep(ARCHIVE_PAUSE_SEC)
+        for month in touched:
+            self._compact(month, cutoff)
+        self.runs += 1
+        self.moved_total += moved
+        self.last_run = {
+            "at": now_iso(),
+            "cutoff": cutoff,
+            "moved": moved,
+            "months": sorted(touched),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        return self.last_run
+
+    def _move_batch(self, store: MessageStore, cutoff: str) -> tuple[int, set[str]]:
+        # id растут вместе со временем, поэтому старейшие сообщения — в начале по id
+        cols = ", ".join(MESSAGE_COLUMNS)
+        conn = store.connect()
+        try:
+            rows = conn.execute(f"SELECT {cols} FROM messages ORDER BY id LIMIT ?", (ARCHIVE_BATCH,)).fetchall()
+            rows = [r for r in rows if r["created_at"] < cutoff]
+            if not rows:
+                return 0, set()
+            ids = [r["id"] for r in rows]
+            marks = ",".join("?" * len(ids))
+            month_of = {r["id"]: r["created_at"][:7] for r in rows}
+            reads, deleted = self._dependents(conn, ids)
+            by_month: dict[str, list[sqlite3.Row]] = {}
+            for r in rows:
+                by_month.setdefault(r["created_at"][:7], []).append(r)
+            for month, month_rows in by_month.items():
+                self._copy(month, month_rows, reads, deleted, month_of)
+            # Копия снята без блокировки: прочтения, «удалить у себя» и удаления
+            # у всех, случившиеся за это время, досылаем в архив под той же
+            # блокировкой и в той же транзакции, что и удаление из горячей базы
+            gone_files: list[str] = []
+            with store.lock, conn:
+                alive = {r["id"] for r in conn.execute(f"SELECT id FROM messages WHERE id IN ({marks})", ids).fetchall()}
+                reads_now, deleted_now = self._dependents(conn, ids)
+                new_reads = list(set(reads_now) - set(reads))
+                new_deleted = list(set(deleted_now) - set(deleted))
+                gone = [r for r in rows if r["id"] not in alive]
+                for month in {month_of[r[0]] for r in new_reads + new_deleted}:
+                    self._copy(month, [], new_reads, new_deleted, month_of)
+                for month in {r["created_at"][:7] for r in gone}:
+                    self._forget(month, [r["id"] for r in gone if r["created_at"][:7] == month])
+                gone_files = [r["file_path"] for r in gone if r["file_path"]]
+                ranges: dict[tuple[int, str], list[int]] = {}
+                for r in rows:
+                    if r["id"] not in alive:
+                        continue
+                    span = ranges.setdefault((r["chat_id"], r["created_at"][:7]), [r["id"], r["id"], 0])
+                    span[0] = min(span[0], r["id"])
+                    span[1] = max(span[1], r["id"])
+                    span[2] += 1
+                conn.executemany(
+                    "INSERT INTO archive_ranges(chat_id, month, min_id, max_id, count) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id, month) DO UPDATE SET min_id = MIN(min_id, excluded.min_id), "
+                    "max_id = MAX(max_id, excluded.max_id), count = count + excluded.count",
+                    [(chat_id, month, *span) for (chat_id, month), span in ranges.items()],
+                )
+                conn.execute(f"DELETE FROM message_reads WHERE message_id IN ({marks})", ids)
+                conn.execute(f"DELETE FROM message_deleted_for WHERE message_id IN ({marks})", ids)
+                conn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+            if gone_files:
+                # file_gc удалённого сообщения мог увидеть ссылку из архивной копии
+                release_files(gone_files)
+            return len(rows), set(by_month)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _dependents(conn: sqlite3.Connection, ids: list[int]) -> tuple[list[tuple], list[tuple]]:
+        marks = ",".join("?" * len(ids))
+        reads = conn.execute(f"SELECT message_id, user_id, read_at FROM message_reads WHERE message_id IN ({marks})", ids).fetchall()
+        deleted = conn.execute(f"SELECT message_id, user_id, created_at FROM message_deleted_for WHERE message_id IN ({marks})", ids).fetchall()
+        return [tuple(r) for r in reads], [tuple(r) for r in deleted]
+
+    @staticmethod
+    def _copy(month: str, rows: list[sqlite3.Row], reads: list[tuple], deleted: list[tuple], month_of: dict[int, str]):
+        target = archive_store(month)
+        aconn = target.connect()
+        try:
+            with target.lock, aconn:
+                aconn.executemany(
+                    f"INSERT OR IGNORE INTO messages({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})",
+                    [tuple(r) for r in rows],
+                )
+                aconn.executemany(
+                    "INSERT OR IGNORE INTO message_reads(message_id, user_id, read_at) VALUES (?, ?, ?)",
+                    [r for r in reads if month_of[r[0]] == month],
+                )
+                aconn.executemany(
+                    "INSERT OR IGNORE INTO message_deleted_for(message_id, user_id, created_at) VALUES (?, ?, ?)",
+                    [r for r in deleted if month_of[r[0]] == month],
+                )
+        finally:
+            aconn.close()
+
+    @staticmethod
+    def _forget(month: str, ids: list[int]):
+        target = archive_store(month)
+        marks = ",".join("?" * len(ids))
+        aconn = target.connect()
+        try:
+            with target.lock, aconn:
+                aconn.execute(f"DELETE FROM message_reads WHERE message_id IN ({marks})", ids)
+                aconn.execute(f"DELETE FROM message_deleted_for WHERE message_id IN ({marks})", ids)
+                aconn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+        finally:
+            aconn.close()
+
+    def _compact(self, month: str, cutoff: str):
+        # Месяц, целиком ушедший за порог, больше не пополняется: сжимаем один раз
+        store = archive_store(month)
+        conn = store.connect()
+        try:
+            with store.lock:
+                if SEARCH_ENABLED:
+                    with conn:
+                        conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+                if cutoff[:7] > month and get_meta(conn, "sealed") != "1":
+                    conn.execute("VACUUM")
+                    with conn:
+                        set_meta(conn, "sealed", "1")
+        finally:
+            conn.close()
+
+archiver = MessageArchiver()
+
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_PER_CHAT = int(os.getenv("RETENTION_MAX_PER_CHAT", "0"))
+RETENTION_REQUESTS_DAYS = int(os.getenv("RETENTION_REQUESTS_DAYS", "0"))
+SESSION_MAX_AGE_DAYS = int(os.getenv("SESSION_MAX_AGE_DAYS", "0"))
+RETENTION_INTERVAL_SEC = int(os.getenv("RETENTION_INTERVAL_SEC", "3600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_PAUSE_SEC = float(os.getenv("RETENTION_PAUSE_MS", "50")) / 1000
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "256"))
+
+def _iso_days_ago(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def effective_retention(max_age_days: Optional[int], max_count: Optional[int]) -> dict:
+    # Политика чата может быть только строже глобальной
+    def stricter(local: Optional[int], default: int) -> int:
+        values = [v for v in (local, default) if v]
+        return min(values) if values else 0
+    return {
+        "max_age_days": stricter(max_age_days, RETENTION_MAX_AGE_DAYS),
+        "max_count": stricter(max_count, RETENTION_MAX_PER_CHAT),
+    }
+
+def file_still_referenced(conn: sqlite3.Connection, file_path: str) -> bool:
+    if conn.execute(
+        "SELECT 1 FROM custom_assets WHERE file_path = ? UNION ALL SELECT 1 FROM users WHERE avatar = ? "
+        "UNION ALL SELECT 1 FROM chats WHERE avatar = ? LIMIT 1",
+        (file_path, file_path, file_path),
+    ).fetchone():
+        return True
+    for store in list(message_stores) + [archive_store(month) for month in archive_months()]:
+        mconn = message_conn(store, conn)
+        row = mconn.execute("SELECT 1 FROM messages WHERE file_path = ? LIMIT 1", (file_path,)).fetchone()
+        release_message_conn(mconn, conn)
+        if row:
+            return True
+    return False
+
+def release_files(paths) -> tuple[int, int]:
+    # Удаляем файл, только если на него больше никто не ссылается (стикеры
+    # переиспользуют файл ассета, аватары лежат там же)
+    removed = 0
+    freed = 0
+    conn = get_db()
+    try:
+        for name in set(paths):
+            if not name or file_still_referenced(conn, name):
+                continue
+            target = UPLOAD_DIR / Path(name).name
+            try:
+                size = target.stat().st_size
+                target.unlink()
+            except FileNotFoundError:
+                continue
+            media_thumb_path(target.name).unlink(missing_ok=True)
+            removed += 1
+            freed += size
+    finally:
+        conn.close()
+    return removed, freed
+
+def delete_message_rows(store: MessageStore, conn: sqlite3.Connection, ids: list[int]) -> list[str]:
+    # Одна короткая транзакция на пачку; возвращает файлы удалённых сообщений
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    with store.lock, conn:
+        files = [
+            r["file_path"]
+            for r in conn.execute(f"SELECT file_path FROM messages WHERE id IN ({marks}) AND file_path IS NOT NULL", ids).fetchall()
+        ]
+        conn.execute(f"DELETE FROM message_reads WHERE message_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM message_deleted_for WHERE message_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+    return files
+
+def db_file_bytes(store: MessageStore) -> int:
+    path = store.path or DB_PATH
+    return sum(p.stat().st_size for p in (path, Path(f"{path}-wal")) if p.exists())
+
+class RetentionManager:
+    # Фоновая чистка по политикам хранения. Всё удаляется пачками по RETENTION_BATCH
+    # с паузами между ними, место в файлах возвращается incremental_vacuum порциями
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+        self.runs: deque = deque(maxlen=20)
+
+    def config(self) -> dict:
+        return {
+            "max_age_days": RETENTION_MAX_AGE_DAYS,
+            "max_per_chat": RETENTION_MAX_PER_CHAT,
+            "requests_days": RETENTION_REQUESTS_DAYS,
+            "session_max_age_days": SESSION_MAX_AGE_DAYS,
+            "interval_sec": RETENTION_INTERVAL_SEC,
+            "batch": RETENTION_BATCH,
+        }
+
+    def stats(self) -> dict:
+        return {"config": self.config(), "running": self.running, "runs": list(self.runs)}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RETENTION_INTERVAL_SEC)
+            try:
+                await self.run()
+            except Exception as exc:
+                logger.warning("retention run failed: %s", exc)
+
+    async def run(self) -> dict:
+        if self.running:
+            return {"skipped": True}
+        self.running = True
+        try:
+            report = await asyncio.to_thread(self.run_once)
+        finally:
+            self.running = False
+        # Кэш хвостов живёт в event loop, поэтому сбрасываем его здесь, а не в потоке
+        for chat_id in report.pop("chats", []):
+            chat_tail_cache.drop(chat_id)
+        self.runs.append(report)
+        return report
+
+    def _pause(self):
+        if RETENTION_PAUSE_SEC:
+            time.sleep(RETENTION_PAUSE_SEC)
+
+    def run_once(self) -> dict:
+        started = time.monotonic()
+        report = {"at": now_iso(), "messages": 0, "friend_requests": 0, "group_invites": 0, "sessions": 0, "jobs": 0,
+                  "archive_months_dropped": 0, "files": 0, "file_bytes": 0, "db_bytes_reclaimed": 0}
+        touched: set[int] = set()
+        files: list[str] = []
+        policies = self._chat_policies()
+        for store in message_stores:
+            before = db_file_bytes(store)
+            conn = store.connect()
+            try:
+                files += self._prune_store(store, conn, policies, report, touched)
+            finally:
+                conn.close()
+            self._vacuum(store)
+            report["db_bytes_reclaimed"] += max(before - db_file_bytes(store), 0)
+        files += self._prune_archives(policies, report, touched)
+        self._prune_core(report)
+        report["files"], report["file_bytes"] = release_files(files)
+        report["seconds"] = round(time.monotonic() - started, 3)
+        report["chats"] = sorted(touched)
+        return report
+
+    def _chat_policies(self) -> dict[int, dict]:
+        conn = get_db()
+        rows = conn.execute("SELECT chat_id, max_age_days, max_count FROM chat_retention").fetchall()
+        conn.close()
+        return {r["chat_id"]: effective_retention(r["max_age_days"], r["max_count"]) for r in rows}
+
+    def _delete_batches(self, store, conn, query: str, params: tuple, report, touched) -> list[str]:
+        files: list[str] = []
+        while True:
+            rows = conn.execute(query, (*params, RETENTION_BATCH)).fetchall()
+            if not rows:
+                return files
+            files += delete_message_rows(store, conn, [r["id"] for r in rows])
+            touched.update(r["chat_id"] for r in rows)
+            report["messages"] += len(rows)
+            if len(rows) < RETENTION_BATCH:
+                return files
+            self._pause()
+
+    def _prune_store(self, store, conn, policies, report, touched) -> list[str]:
+        files: list[str] = []
+        if RETENTION_MAX_AGE_DAYS:
+            # Старейшие сообщения идут первыми по id, индекс по created_at не нужен
+            cutoff = _iso_days_ago(RETENTION_MAX_AGE_DAYS)
+            while True:
+                rows = conn.execute("SELECT id, chat_id, created_at FROM messages ORDER BY id LIMIT ?", (RETENTION_BATCH,)).fetchall()
+                rows = [r for r in rows if r["created_at"] < cutoff]
+                if not rows:
+                    break
+                files += delete_message_rows(store, conn, [r["id"] for r in rows])
+                touched.update(r["chat_id"] for r in rows)
+                report["messages"] += len(rows)
+                if len(rows) < RETENTION_BATCH:
+                    break
+                self._pause()
+        for chat_id, policy in policies.items():
+            if store_for_chat(chat_id) is not store or not policy["max_age_days"]:
+                continue
+            files += self._delete_batches(
+                store, conn,
+                "SELECT id, chat_id FROM messages WHERE chat_id = ? AND created_at < ? ORDER BY id LIMIT ?",
+                (chat_id, _iso_days_ago(policy["max_age_days"])), report, touched,
+            )
+        limits: dict[int, int] = {}
+        if RETENTION_MAX_PER_CHAT:
+            for r in conn.execute(
+                "SELECT chat_id FROM messages GROUP BY chat_id HAVING COUNT(*) > ?", (RETENTION_MAX_PER_CHAT,)
+            ).fetchall():
+                limits[r["chat_id"]] = RETENTION_MAX_PER_CHAT
+        for chat_id, policy in policies.items():
+            if store_for_chat(chat_id) is store and policy["max_count"]:
+                limits[chat_id] = policy["max_count"]
+        for chat_id, max_count in limits.items():
+            # Лимит по количеству считается по горячей базе; всё, что в архиве, уже старше
+            edge = conn.execute(
+                "SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (chat_id, max_count),
+            ).fetchone()
+            if not edge:
+                continue
+            files += self._delete_batches(
+                store, conn,
+                "SELECT id, chat_id FROM messages WHERE chat_id = ? AND id <= ? ORDER BY id LIMIT ?",
+                (chat_id, edge["id"]), report, touched,
+            )
+            files += self._drop_chat_archive(store, conn, chat_id, report)
+        return files
+
+    def _drop_chat_archive(self, store, mconn, chat_id: int, report, cutoff: Optional[str] = None) -> list[str]:
+        files: list[str] = []
+        for month in chat_archive_months(mconn, chat_id, 1 << 62):
+            if cutoff and month > cutoff[:7]:
+                continue
+            astore = archive_store(month)
+            aconn = astore.connect()
+            try:
+                while True:
+                    query = "SELECT id FROM messages WHERE chat_id = ?" + (" AND created_at < ?" if cutoff else "") + " ORDER BY id LIMIT ?"
+                    params = (chat_id, cutoff, RETENTION_BATCH) if cutoff else (chat_id, RETENTION_BATCH)
+                    ids = [r["id"] for r in aconn.execute(query, params).fetchall()]
+                    if not ids:
+                        break
+                    files += delete_message_rows(astore, aconn, ids)
+                    report["messages"] += len(ids)
+                    self._pause()
+            finally:
+                aconn.close()
+            if not cutoff or month < cutoff[:7]:
+                with store.lock, mconn:
+                    mconn.execute("DELETE FROM archive_ranges WHERE chat_id = ? AND month = ?", (chat_id, month))
+        return files
+
+    def _prune_archives(self, policies, report, touched) -> list[str]:
+        files: list[str] = []
+        if RETENTION_MAX_AGE_DAYS:
+            # Месяц целиком старше порога — удаляем файл архива, не трогая строки
+            cutoff_month = _iso_days_ago(RETENTION_MAX_AGE_DAYS)[:7]
+            for month in archive_months():
+                if month >= cutoff_month:
+                    continue
+                store = archive_store(month)
+                conn = store.connect()
+                files += [r["file_path"] for r in conn.execute("SELECT DISTINCT file_path FROM messages WHERE file_path IS NOT NULL").fetchall()]
+                touched.update(r["chat_id"] for r in conn.execute("SELECT DISTINCT chat_id FROM messages").fetchall())
+                report["messages"] += conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+                conn.close()
+                with store.lock, archive_stores_lock:
+                    archive_stores.pop(month, None)
+                    for suffix in ("", "-wal", "-shm"):
+                        Path(f"{store.path}{suffix}").unlink(missing_ok=True)
+                for hot in message_stores:
+                    hconn = hot.connect()
+                    with hot.lock, hconn:
+                        hconn.execute("DELETE FROM archive_ranges WHERE month = ?", (month,))
+                    hconn.close()
+                report["archive_months_dropped"] += 1
+        for chat_id, policy in policies.items():
+            if policy["max_age_days"]:
+                store = store_for_chat(chat_id)
+                conn = store.connect()
+                try:
+                    files += self._drop_chat_archive(store, conn, chat_id, report, _iso_days_ago(policy["max_age_days"]))
+                finally:
+                    conn.close()
+        return files
+
+    def _prune_core(self, report):
+        conn = get_db()
+        try:
+            steps = []
+            if RETENTION_REQUESTS_DAYS:
+                cutoff = _iso_days_ago(RETENTION_REQUESTS_DAYS)
+                steps.append(("friend_requests", "SELECT id FROM friend_requests WHERE status != 'pending' AND created_at < ? LIMIT ?", (cutoff,), "id"))
+                steps.append(("group_invites", "SELECT id FROM group_invites WHERE status != 'pending' AND created_at < ? LIMIT ?", (cutoff,), "id"))
+            if JOB_KEEP_DAYS:
+                steps.append(("jobs", "SELECT id FROM jobs WHERE status = 'done' AND finished_at < ? LIMIT ?", (_iso_days_ago(JOB_KEEP_DAYS),), "id"))
+            if SESSION_MAX_AGE_DAYS:
+                steps.append(("sessions", "SELECT token AS id FROM sessions WHERE created_at < ? LIMIT ?", (_iso_days_ago(SESSION_MAX_AGE_DAYS),), "token"))
+            for table, query, params, key in steps:
+                while True:
+                    ids = [r["id"] for r in conn.execute(query, (*params, RETENTION_BATCH)).fetchall()]
+                    if not ids:
+                        break
+                    with db_lock, conn:
+                        conn.execute(f"DELETE FROM {table} WHERE {key} IN ({','.join('?' * len(ids))})", ids)
+                    report[table] += len(ids)
+                    if len(ids) < RETENTION_BATCH:
+                        break
+                    self._pause()
+        finally:
+            conn.close()
+        if message_stores[0].path is not None:
+            # С шардами основная база не входит в message_stores — сжимаем её отдельно
+            core = MessageStore(0, 1, None, db_lock)
+            before = db_file_bytes(core)
+            self._vacuum(core)
+            report["db_bytes_reclaimed"] += max(before - db_file_bytes(core), 0)
+
+    def _vacuum(self, store: MessageStore):
+        # Пустые страницы отдаём порциями, чтобы не держать блокировку записи долго
+        conn = store.connect()
+        try:
+            if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+                return
+            while conn.execute("PRAGMA main.freelist_count").fetchone()[0] > 0:
+                with store.lock:
+                    conn.execute(f"PRAGMA main.incremental_vacuum({RETENTION_VACUUM_PAGES})")
+                self._pause()
+            with store.lock:
+                conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
+retention = RetentionManager()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SEC = float(os.getenv("JOB_POLL_MS", "1000")) / 1000
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_CHUNK = int(os.getenv("JOB_CHUNK", "500"))
+JOB_KEEP_DAYS = int(os.getenv("JOB_KEEP_DAYS", "7"))
+# Аренда задачи: пока порция выполняется, updated_at обновляется каждые
+# JOB_LEASE_SEC / 3; задачу, не обновлявшуюся дольше JOB_LEASE_SEC, считаем
+# брошенной (процесс упал или перезапущен) и возвращаем в очередь
+JOB_LEASE_SEC = float(os.getenv("JOB_LEASE_SEC", "60"))
+
+job_handlers: dict[str, Callable[[dict], bool]] = {}
+
+def job_handler(kind: str):
+    # Обработчик делает одну порцию работы и возвращает True, если осталось ещё.
+    # Порции идемпотентны: после сбоя задача просто запускается заново
+    def register(fn):
+        job_handlers[kind] = fn
+        return fn
+    return register
+
+def _iso_in(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def enqueue_job(conn: sqlite3.Connection, kind: str, payload: dict) -> int:
+    # Пишется в транзакции вызывающего: логическое удаление и задача на
+    # физическую очистку фиксируются вместе
+    now = now_iso()
+    cur = conn.execute(
+        "INSERT INTO jobs(kind, payload, max_attempts, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (kind, json.dumps(payload), JOB_MAX_ATTEMPTS, now, now, now),
+    )
+    return cur.lastrowid
+
+def serialize_job(row: sqlite3.Row) -> dict:
+    item = dict(row)
+    item["payload"] = json.loads(item["payload"])
+    return item
+
+def _delete_chunk(conn: sqlite3.Connection, lock, table: str, where: str, params: tuple) -> int:
+    with lock, conn:
+        cur = conn.execute(
+            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+            (*params, JOB_CHUNK),
+        )
+    return cur.rowcount
+
+@job_handler("purge_chat")
+def _purge_chat(payload: dict) -> bool:
+    chat_id = payload["chat_id"]
+    store = store_for_chat(chat_id)
+    mconn = store.connect()
+    try:
+        ids = [r["id"] for r in mconn.execute("SELECT id FROM messages WHERE chat_id = ? ORDER BY id LIMIT ?", (chat_id, JOB_CHUNK)).fetchall()]
+        if ids:
+            release_files(delete_message_rows(store, mconn, ids))
+            return True
+        for month in chat_archive_months(mconn, chat_id, 1 << 62):
+            astore = archive_store(month)
+            aconn = astore.connect()
+            ids = [r["id"] for r in aconn.execute("SELECT id FROM messages WHERE chat_id = ? ORDER BY id LIMIT ?", (chat_id, JOB_CHUNK)).fetchall()]
+            files = delete_message_rows(astore, aconn, ids)
+            aconn.close()
+            release_files(files)
+            if not ids:
+                with store.lock, mconn:
+                    mconn.execute("DELETE FROM archive_ranges WHERE chat_id = ? AND month = ?", (chat_id, month))
+            return True
+    finally:
+        mconn.close()
+    conn = get_db()
+    try:
+        for table in ("chat_members", "group_invites", "chat_retention"):
+            if _delete_chunk(conn, db_lock, table, "chat_id = ?", (chat_id,)):
+                return True
+    finally:
+        conn.close()
+    return False
+
+@job_handler("purge_user")
+def _purge_user(payload: dict) -> bool:
+    user_id = payload["user_id"]
+    conn = get_db()
+    try:
+        assets = conn.execute("SELECT id, file_path FROM custom_assets WHERE user_id = ? LIMIT ?", (user_id, JOB_CHUNK)).fetchall()
+        if assets:
+            with db_lock, conn:
+                conn.executemany("DELETE FROM custom_assets WHERE id = ?", [(a["id"],) for a in assets])
+            release_files([a["file_path"] for a in assets])
+            return True
+        steps = [
+            ("user_settings", "user_id = ?", (user_id,)),
+            ("friends", "user_id = ? OR friend_id = ?", (user_id, user_id)),
+            ("friend_requests", "from_user_id = ? OR to_user_id = ?", (user_id, user_id)),
+            ("blocked_users", "blocker_id = ? OR blocked_id = ?", (user_id, user_id)),
+            ("group_invites", "inviter_id = ? OR invitee_id = ?", (user_id, user_id)),
+        ]
+        for table, where, params in steps:
+            if _delete_chunk(conn, db_lock, table, where, params):
+                return True
+    finally:
+        conn.close()
+    # Сами сообщения пользователя остаются в чатах, убираем только его отметки
+    for store in message_stores:
+        mconn = store.connect()
+        try:
+            for table in ("message_reads", "message_deleted_for"):
+                if _delete_chunk(mconn, store.lock, table, "user_id = ?", (user_id,)):
+                    return True
+        finally:
+            mconn.close()
+    if payload.get("avatar"):
+        release_files([payload["avatar"]])
+    return False
+
+@job_handler("file_gc")
+def _file_gc(payload: dict) -> bool:
+    release_files(payload["paths"])
+    return False
+
+class JobQueue:
+    # Долговечная очередь в таблице jobs. Воркеры забирают задачи по одной и
+    # выполняют порцию в потоке; между порциями задача возвращается в очередь,
+    # так что большая чистка не держит ни воркер, ни блокировку записи
+    def __init__(self):
+        self.tasks: list[asyncio.Task] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(max(JOB_WORKERS, 1))]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def stats(self) -> dict:
+        conn = get_db()
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        conn.close()
+        return {
+            "workers": len(self.tasks),
+            "processed_chunks": self.processed,
+            "failed_attempts": self.failed,
+            "counts": {r["status"]: r["n"] for r in rows},
+            "kinds": sorted(job_handlers),
+        }
+
+    async def _worker(self):
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            execution = asyncio.create_task(asyncio.to_thread(self._execute, job))
+            while not execution.done():
+                done, _ = await asyncio.wait({execution}, timeout=JOB_LEASE_SEC / 3)
+                if not done:
+                    await asyncio.to_thread(self._heartbeat, job["id"])
+            await execution
+
+    def _heartbeat(self, job_id: int):
+        conn = get_db()
+        with db_lock, conn:
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (now_iso(), job_id))
+        conn.close()
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        conn = get_db()
+        now = now_iso()
+        with db_lock, conn:
+            # Задачи с истёкшей арендой (прерванные рестартом или упавшим воркером)
+            # начинаются заново; живые задачи других процессов аренду продлевают
+            expired = conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND updated_at < ?",
+                (now, _iso_in(-JOB_LEASE_SEC)),
+            ).rowcount
+            if expired:
+                logger.warning("requeued %s job(s) with an expired lease", expired)
+            job = conn.execute(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ("
+                "SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY run_after, id LIMIT 1"
+                ") RETURNING *",
+                (now, now),
+            ).fetchone()
+        conn.close()
+        return job
+
+    def _execute(self, job: sqlite3.Row):
+        handler = job_handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise RuntimeError(f"unknown job kind {job['kind']}")
+            more = handler(json.loads(job["payload"]))
+        except Exception as exc:
+            self.failed += 1
+            attempts = job["attempts"] + 1
+            status = "failed" if attempts >= job["max_attempts"] else "queued"
+            logger.warning("job %s (%s) failed, attempt %s: %s", job["id"], job["kind"], attempts, exc)
+            self._update(
+                job["id"],
+                "status = ?, attempts = ?, last_error = ?, run_after = ?",
+                (status, attempts, str(exc)[:500], _iso_in(min(2 ** attempts, 300))),
+            )
+            return
+        self.processed += 1
+        if more:
+            self._update(job["id"], "status = 'queued', chunks = chunks + 1", ())
+        else:
+            self._update(job["id"], "status = 'done', chunks = chunks + 1, finished_at = ?", (now_iso(),))
+
+    def _update(self, job_id: int, assignments: str, params: tuple):
+        conn = get_db()
+        with db_lock, conn:
+            conn.execute(f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?", (*params, now_iso(), job_id))
+        conn.close()
+
+jobs = JobQueue()
+
+def load_archived_messages(mconn: sqlite3.Connection, chat_id: int, user_id: int, before_id: int, limit: int) -> list[dict]:
+    # Продолжение истории чата за пределами горячей базы: идём по архивам от новых к старым
+    items: list[dict] = []
+    for month in chat_archive_months(mconn, chat_id, before_id):
+        if len(items) >= limit:
+            break
+        store = archive_store(month)
+        aconn = store.connect()
+        rows = aconn.execute(
+            "SELECT m.*, u.username, u.nickname, u.avatar, "
+            "(SELECT COUNT(DISTINCT r.user_id) FROM message_reads r WHERE r.message_id = m.id AND r.user_id != m.user_id) as read_count "
+            "FROM messages m JOIN users u ON u.id = m.user_id "
+            "WHERE m.chat_id = ? AND m.id < ? AND NOT EXISTS (SELECT 1 FROM message_deleted_for d WHERE d.message_id = m.id AND d.user_id = ?) "
+            "ORDER BY m.id DESC LIMIT ?",
+            (chat_id, before_id, user_id, limit - len(items)),
+        ).fetchall()
+        reply_cache: dict[int, Optional[dict]] = {}
+        items.extend(serialize_message(r, conn=aconn, reply_cache=reply_cache) for r in rows)
+        aconn.close()
+        if rows:
+            before_id = rows[-1]["id"]
+    return items
+
+def last_messages(conn: sqlite3.Connection, chat_ids: list[int]) -> dict[int, sqlite3.Row]:
+    result: dict[int, sqlite3.Row] = {}
+    for store, ids in stores_for_chats(chat_ids).items():
+        mconn = message_conn(store, conn)
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            marks = ",".join("?" * len(part))
+            for r in mconn.execute(
+                "SELECT m.chat_id, m.text, m.created_at FROM messages m "
+                f"WHERE m.id IN (SELECT MAX(id) FROM messages WHERE chat_id IN ({marks}) GROUP BY chat_id)",
+                part,
+            ).fetchall():
+                result[r["chat_id"]] = r
+        missing = [chat_id for chat_id in ids if chat_id not in result]
+        if missing:
+            # Вся история чата ушла в архив — последнее сообщение берём оттуда
+            newest: dict[int, tuple[int, str]] = {}
+            for start in range(0, len(missing), 500):
+                part = missing[start:start + 500]
+                marks = ",".join("?" * len(part))
+                for r in mconn.execute(f"SELECT chat_id, month, max_id FROM archive_ranges WHERE chat_id IN ({marks})", part).fetchall():
+                    if r["max_id"] > newest.get(r["chat_id"], (0, ""))[0]:
+                        newest[r["chat_id"]] = (r["max_id"], r["month"])
+            per_month: dict[str, list[int]] = {}
+            for max_id, month in newest.values():
+                per_month.setdefault(month, []).append(max_id)
+            for month, msg_ids in per_month.items():
+                aconn = archive_store(month).connect()
+                marks = ",".join("?" * len(msg_ids))
+                for r in aconn.execute(f"SELECT chat_id, text, created_at FROM messages WHERE id IN ({marks})", msg_ids).fetchall():
+                    result[r["chat_id"]] = r
+                aconn.close()
+        release_message_conn(mconn, conn)
+    return result
+
+
+def get_user_by_token(token: str) -> Optional[sqlite3.Row]:
+    conn = get_db()
+    row = conn.execute(
+        "SELECT u.*, s.created_at AS session_created_at FROM sessions s JOIN users u ON u.id = s.user_id WHERE s.token = ?",
+        (token,),
+    ).fetchone()
+    conn.close()
+    if row and SESSION_MAX_AGE_DAYS and row["session_created_at"] < _iso_days_ago(SESSION_MAX_AGE_DAYS):
+        return None
+    return row
+
+def get_current_user(request: Request) -> sqlite3.Row:
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    token = auth.replace("Bearer ", "", 1).strip()
+    user = get_user_by_token(token)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+
+def require_admin(request: Request):
+    # Служебные эндпоинты: по X-Admin-Token, а без настроенного токена — только с localhost
+    if ADMIN_TOKEN:
+        supplied = request.headers.get("X-Admin-Token", "")
+        if not secrets.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return
+    host = request.client.host if request.client else ""
+    if host not in {"127.0.0.1", "::1", "localhost"}:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def ensure_settings(conn: sqlite3.Connection, user_id: int):
+    cols = {
+        row["name"]
+        for row in conn.execute("PRAGMA table_info(user_settings)").fetchall()
+    }
+    if "theme" not in cols:
+        conn.execute(
+            "ALTER TABLE user_settings ADD COLUMN theme TEXT NOT NULL DEFAULT 'default'"
+        )
+
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO user_settings(
+            user_id,
+            allow_friend_requests,
+            allow_calls_from,
+            allow_group_invites,
+            show_last_seen,
+            theme
+        )
+        VALUES (?, 'everyone', 'friends', 'friends', 'friends', 'default')
+        """,
+        (user_id,),
+    )
+
+def get_settings(conn: sqlite3.Connection, user_id: int) -> dict:
+    ensure_settings(conn, user_id)
+    row = conn.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    return dict(row)
 
 def is_friend(conn: sqlite3.Connection, a: int, b: int) -> bool:
     row = conn.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (a, b)).fetchone()
@@ -498,7 +2343,11 @@ def is_any_block(conn: sqlite3.Connection, a: int, b: int) -> bool:
     return is_blocked(conn, a, b) or is_blocked(conn, b, a)
 
 def can_access_chat(conn: sqlite3.Connection, user_id: int, chat_id: int) -> bool:
-    row = conn.execute("SELECT 1 FROM chat_members WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)).fetchone()
+    # Участники удалённого чата вычищаются фоновой задачей, поэтому сверяемся и с chats
+    row = conn.execute(
+        "SELECT 1 FROM chat_members cm JOIN chats c ON c.id = cm.chat_id WHERE cm.user_id = ? AND cm.chat_id = ?",
+        (user_id, chat_id),
+    ).fetchone()
     return bool(row)
 
 def get_chat(conn: sqlite3.Connection, chat_id: int) -> Optional[sqlite3.Row]:
@@ -538,17 +2387,139 @@ def can_invite_to_group(conn: sqlite3.Connection, inviter_id: int, target_id: in
         return False, "Пользователь принимает приглашения только от друзей"
     return True, ""
 
+def _load_block_set(conn: sqlite3.Connection, user_id: int) -> set[int]:
+    rows = conn.execute(
+        "SELECT blocked_id AS uid FROM blocked_users WHERE blocker_id = ? "
+        "UNION SELECT blocker_id AS uid FROM blocked_users WHERE blocked_id = ?",
+        (user_id, user_id),
+    ).fetchall()
+    return {r["uid"] for r in rows}
+
+BLOCK_CACHE_MAX_USERS = 50_000
+
+class BlockCache:
+    # Множество пользователей, с которыми есть блокировка в любую сторону.
+    # Сбрасывается на block/unblock для обеих сторон
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self.sets: OrderedDict[int, frozenset] = OrderedDict()
+
+    def get(self, conn: sqlite3.Connection, user_id: int) -> frozenset:
+        blocked = self.sets.get(user_id)
+        if blocked is None:
+            blocked = frozenset(_load_block_set(conn, user_id))
+            self.sets[user_id] = blocked
+            while len(self.sets) > self.max_users:
+                self.sets.popitem(last=False)
+        else:
+            self.sets.move_to_end(user_id)
+        return blocked
+
+    def invalidate(self, *user_ids: int):
+        for uid in user_ids:
+            self.sets.pop(uid, None)
+
+    def clear(self):
+        self.sets.clear()
+
+block_cache = BlockCache(BLOCK_CACHE_MAX_USERS)
+
+def _load_chat_list(conn: sqlite3.Connection, user_id: int, blocked: set[int]) -> list[dict]:
+    chats = conn.execute("SELECT c.id, c.type, c.title, c.avatar, c.created_by, c.created_at FROM chats c JOIN chat_members cm ON cm.chat_id = c.id WHERE cm.user_id = ?", (user_id,)).fetchall()
+    # Последние сообщения читаем отдельно: при шардировании они лежат в других базах
+    lasts = last_messages(conn, [c["id"] for c in chats])
+    rows = []
+    for c in chats:
+        item = dict(c)
+        created_at = item.pop("created_at")
+        last = lasts.get(c["id"])
+        item["last_text"] = last["text"] if last else None
+        item["last_at"] = last["created_at"] if last else None
+        rows.append((item["last_at"] or created_at, item))
+    rows.sort(key=lambda pair: pair[0], reverse=True)
+    items = []
+    for _, item in rows:
+        if item["type"] == "direct":
+            peer = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar FROM chat_members cm JOIN users u ON u.id = cm.user_id WHERE cm.chat_id = ? AND cm.user_id != ? LIMIT 1", (item["id"], user_id)).fetchone()
+            if not peer:
+                continue
+            if peer["id"] in blocked:
+                continue
+            item["title"] = peer["nickname"]
+            item["peer"] = dict(peer)
+            can_call, _ = can_call_user(conn, user_id, peer["id"])
+            item["can_call"] = can_call
+        else:
+            item["can_call"] = True
+            item["can_delete"] = item["created_by"] == user_id
+            role = conn.execute("SELECT role FROM chat_members WHERE chat_id = ? AND user_id = ?", (item["id"], user_id)).fetchone()
+            count = conn.execute("SELECT COUNT(*) as total FROM chat_members WHERE chat_id = ?", (item["id"],)).fetchone()
+            item["my_role"] = role["role"] if role else "member"
+            item["member_count"] = count["total"] if count else 0
+        items.append(item)
+    return items
+
+def _load_friends(conn: sqlite3.Connection, user_id: int, blocked: set[int]) -> list[dict]:
+    rows = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar, u.about FROM friends f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? ORDER BY u.nickname", (user_id,)).fetchall()
+    return [dict(r) for r in rows if r["id"] not in blocked]
+
+def _load_friend_presence(conn: sqlite3.Connection, friend_ids: list[int]) -> list[dict]:
+    # Друзья видят last_seen при режимах everyone и friends
+    if not friend_ids:
+        return []
+    marks = ",".join("?" * len(friend_ids))
+    rows = conn.execute(
+        f"SELECT u.id, u.last_seen FROM users u LEFT JOIN user_settings s ON s.user_id = u.id "
+        f"WHERE u.id IN ({marks}) AND COALESCE(s.show_last_seen, 'friends') != 'nobody'",
+        friend_ids,
+    ).fetchall()
+    return [presence.snapshot(r["id"], r["last_seen"]) for r in rows]
+
+def _load_incoming_requests(conn: sqlite3.Connection, user_id: int) -> list[dict]:
+    rows = conn.execute("SELECT fr.id, fr.created_at, u.id as user_id, u.username, u.nickname, u.avatar FROM friend_requests fr JOIN users u ON u.id = fr.from_user_id WHERE fr.to_user_id = ? AND fr.status = 'pending' ORDER BY fr.id DESC", (user_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+def _load_group_invites(conn: sqlite3.Connection, user_id: int) -> list[dict]:
+    rows = conn.execute("SELECT gi.id, gi.chat_id, gi.inviter_id, gi.invitee_id, gi.status, gi.created_at, c.title as chat_title, u.username as inviter_username, u.nickname as inviter_nickname FROM group_invites gi JOIN chats c ON c.id = gi.chat_id JOIN users u ON u.id = gi.inviter_id WHERE gi.invitee_id = ? AND gi.status = 'pending' ORDER BY gi.id DESC", (user_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+def serialize_asset(row: sqlite3.Row) -> dict:
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "title": row["title"] or "",
+        "file_url": f"/media/{row['file_path']}",
+        "file_name": row["file_name"],
+        "mime_type": row["mime_type"],
+        "created_at": row["created_at"],
+    }
+
+def _load_assets(conn: sqlite3.Connection, user_id: int, kind: str = "") -> list[dict]:
+    params: list = [user_id]
+    query = "SELECT id, kind, title, file_path, file_name, mime_type, created_at FROM custom_assets WHERE user_id = ?"
+    if kind in {"emoji", "sticker"}:
+        query += " AND kind = ?"
+        params.append(kind)
+    query += " ORDER BY id DESC"
+    return [serialize_asset(r) for r in conn.execute(query, params).fetchall()]
+
+REPLY_PREVIEW_QUERY = """
+SELECT m.id, m.kind, m.text, m.file_name, u.nickname
+FROM messages m
+JOIN users u ON u.id = m.user_id
+WHERE m.id = ? AND m.chat_id = ?
+LIMIT 1
+"""
+
 def _load_reply_preview(conn: sqlite3.Connection, chat_id: int, reply_to_id: int) -> Optional[dict]:
-    ref = conn.execute(
-        """
-        SELECT m.id, m.kind, m.text, m.file_name, u.nickname
-        FROM messages m
-        JOIN users u ON u.id = m.user_id
-        WHERE m.id = ? AND m.chat_id = ?
-        LIMIT 1
-        """,
-        (reply_to_id, chat_id),
-    ).fetchone()
+    ref = conn.execute(REPLY_PREVIEW_QUERY, (reply_to_id, chat_id)).fetchone()
+    # Промах бывает редко: сообщение удалено или уехало в архив
+    for store in [] if ref else archive_stores_for(chat_id, reply_to_id):
+        aconn = store.connect()
+        ref = aconn.execute(REPLY_PREVIEW_QUERY, (reply_to_id, chat_id)).fetchone()
+        aconn.close()
+        if ref:
+            break
     if not ref:
         return None
     return {
@@ -568,10 +2539,18 @@ def _normalize_reply_target(conn: sqlite3.Connection, chat_id: int, reply_to: Op
         raise HTTPException(status_code=400, detail="Некорректный reply_to")
     if reply_id <= 0:
         raise HTTPException(status_code=400, detail="Некорректный reply_to")
-    exists = conn.execute(
+    mconn = message_conn(store_for_chat(chat_id), conn)
+    exists = mconn.execute(
         "SELECT id FROM messages WHERE id = ? AND chat_id = ? LIMIT 1",
         (reply_id, chat_id),
     ).fetchone()
+    release_message_conn(mconn, conn)
+    for store in [] if exists else archive_stores_for(chat_id, reply_id):
+        aconn = store.connect()
+        exists = aconn.execute("SELECT id FROM messages WHERE id = ? AND chat_id = ? LIMIT 1", (reply_id, chat_id)).fetchone()
+        aconn.close()
+        if exists:
+            break
     if not exists:
         raise HTTPException(status_code=400, detail="Сообщение для ответа не найдено")
     return reply_id
@@ -611,36 +2590,1231 @@ def serialize_message(
         "read_count": row["read_count"] if "read_count" in keys else 0,
     }
 
-async def push_to_user(user_id: int, payload: dict):
-    connections = active_connections.get(user_id, set()).copy()
-    dead = []
-    for ws in connections:
-        try:
-            await ws.send_json(payload)
-        except Exception:
-            dead.append(ws)
-    for ws in dead:
-        active_connections.get(user_id, set()).discard(ws)
+# Исходящий трафик сокета разделён на полосы: сигналинг звонков, чат, фоновая синхронизация
+WS_LANES = ("call", "chat", "bulk")
+WS_LANE_WEIGHTS = {"call": 8, "chat": 3, "bulk": 1}
+WS_LANE_LIMITS = {
+    "call": int(os.getenv("WS_CALL_QUEUE_LIMIT", "256")),
+    "chat": int(os.getenv("WS_CHAT_QUEUE_LIMIT", "512")),
+    "bulk": int(os.getenv("WS_BULK_QUEUE_LIMIT", "256")),
+}
+# Сколько при остановке ждать, пока сокеты допишут свои очереди. SHUTDOWN_DELAY_SEC —
+# пауза перед этим: /readyz уже 503, а HTTP ещё обслуживается, пока балансировщик
+# не уберёт экземпляр из ротации
+WS_DRAIN_SEC = float(os.getenv("WS_DRAIN_SEC", "5"))
+SHUTDOWN_DELAY_SEC = float(os.getenv("SHUTDOWN_DELAY_SEC", "0"))
+WS_CHAT_FRAME_TYPES = {
+    "hello",
+    "message:new",
+    "message:deleted_all",
+    "message:deleted_me",
+    "friend:request",
+    "friend:accepted",
+    "chat:added",
+    "user:blocked",
+    "group:invite",
+    "group:invite_answer",
+    "group:deleted",
+}
+WS_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+def frame_lane(msg_type: str) -> str:
+    if msg_type.startswith("call:") or msg_type == "pong":
+        return "call"
+    if msg_type in WS_CHAT_FRAME_TYPES:
+        return "chat"
+    return "bulk"
+
+class LaneStats:
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * (len(WS_LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, latency_ms: float):
+        self.sent += 1
+        self.latency_sum += latency_ms
+        if latency_ms > self.latency_max:
+            self.latency_max = latency_ms
+        for idx, bound in enumerate(WS_LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.buckets[idx] += 1
+                return
+        self.buckets[-1] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "latency_avg_ms": round(self.latency_sum / self.sent, 3) if self.sent else 0.0,
+            "latency_max_ms": round(self.latency_max, 3),
+            "latency_buckets_ms": dict(zip([*map(str, WS_LATENCY_BUCKETS_MS), "+Inf"], self.buckets)),
+        }
+
+ws_lane_stats = {lane: LaneStats() for lane in WS_LANES}
+
+# Цикл событий держит на задачи только слабые ссылки: задачу «запустил и забыл»
+# без ссылки сборщик мусора может уничтожить посреди работы
+detached_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
+
+class WsOutbox:
+    # Очередь исходящих кадров одного сокета с взвешенной выборкой по полосам.
+    # Кадры звонков всегда вытесняют остальные: после каждого кадра чата/фона
+    # планировщик возвращается к полосе call, если в ней что-то появилось.
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.queues: dict[str, deque] = {lane: deque() for lane in WS_LANES}
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def enqueue(self, text: str, lane: str) -> bool:
+        if self.closed:
+            return False
+        queue = self.queues[lane]
+        if len(queue) >= WS_LANE_LIMITS[lane]:
+            ws_lane_stats[lane].dropped += 1
+            if lane != "bulk":
+                # Медленный клиент: без сигналинга и сообщений он всё равно рассинхронизирован,
+                # закрываем сокет, клиент переподключится и перечитает состояние
+                logger.warning("ws outbox overflow on lane=%s, closing slow consumer", lane)
+                self.close(code=1013)
+                return False
+            queue.popleft()
+        queue.append((time.perf_counter(), text))
+        self.wakeup.set()
+        return True
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                if not any(self.queues.values()):
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                for lane in WS_LANES:
+                    queue = self.queues[lane]
+                    for _ in range(WS_LANE_WEIGHTS[lane]):
+                        if not queue:
+                            break
+                        enqueued_at, text = queue.popleft()
+                        await self.ws.send_text(text)
+                        ws_lane_stats[lane].observe((time.perf_counter() - enqueued_at) * 1000)
+                        if lane != "call" and self.queues["call"]:
+                            break
+                    if lane != "call" and self.queues["call"]:
+                        break
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.closed = True
+
+    def close(self, code: Optional[int] = None):
+        if self.closed:
+            return
+        self.closed = True
+        for queue in self.queues.values():
+            queue.clear()
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+        if code is not None:
+            spawn(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+ws_outboxes: dict[WebSocket, WsOutbox] = {}
+
+def _encode_frame(payload: dict) -> str:
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+def send_frame(ws: WebSocket, payload: dict, text: Optional[str] = None) -> bool:
+    outbox = ws_outboxes.get(ws)
+    if outbox is None:
+        return False
+    return outbox.enqueue(text if text is not None else _encode_frame(payload), frame_lane(payload.get("type", "")))
+
+async def send_many(sockets: list[WebSocket], payload: dict):
+    if sockets:
+        text = _encode_frame(payload)
+        for ws in sockets:
+            send_frame(ws, payload, text)
+
+async def push_to_users(user_ids, payload: dict):
+    text = None
+    for user_id in set(user_ids):
+        connections = active_connections.get(user_id)
+        if not connections:
+            continue
+        if text is None:
+            text = _encode_frame(payload)
+        dead = [ws for ws in connections if not send_frame(ws, payload, text)]
+        for ws in dead:
+            connections.discard(ws)
+
+async def push_to_user(user_id: int, payload: dict):
+    await push_to_users((user_id,), payload)
+
+async def broadcast_to_chat(chat_id: int, payload: dict):
+    conn = get_db()
+    members = conn.execute("SELECT user_id FROM chat_members WHERE chat_id = ?", (chat_id,)).fetchall()
+    conn.close()
+    await push_to_users([m["user_id"] for m in members], payload)
+
+# Входящий поток: размер кадра и token bucket на тип сообщения для сокета и для пользователя
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(64 * 1024)))
+# Жёсткий предел сервера (websockets закрывает сокет с 1009 ещё до приложения) —
+# с запасом над WS_MAX_FRAME_BYTES, чтобы кадры между ними проходили через
+# счётчики oversize и эскалацию WS_THROTTLE_CLOSE_AFTER
+WS_SERVER_MAX_FRAME_BYTES = int(os.getenv("WS_SERVER_MAX_FRAME_BYTES", str(WS_MAX_FRAME_BYTES * 4)))
+WS_USER_RATE_FACTOR = float(os.getenv("WS_USER_RATE_FACTOR", "2"))
+WS_THROTTLE_CLOSE_AFTER = int(os.getenv("WS_THROTTLE_CLOSE_AFTER", "100"))
+WS_THROTTLE_WINDOW_SEC = 10.0
+# (токенов в секунду, ёмкость)
+WS_RATE_LIMITS = {
+    "ping": (1.0, 5),
+    "call:join": (1.0, 4),
+    "call:leave": (1.0, 4),
+    "call:state": (5.0, 15),
+    "call:signal": (60.0, 240),
+    "chat:read": (5.0, 20),
+    "*": (10.0, 30),
+}
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def allow(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+def _rate_limit_key(msg_type: str) -> str:
+    return msg_type if msg_type in WS_RATE_LIMITS else "*"
+
+def _new_bucket(key: str, factor: float = 1.0) -> TokenBucket:
+    rate, capacity = WS_RATE_LIMITS[key]
+    return TokenBucket(rate * factor, capacity * factor)
+
+WS_THROTTLE_STATS_MAX = 1024
+
+user_rate_buckets: dict[int, dict[str, TokenBucket]] = {}
+# Счётчики нарушителей для /api/admin/ws переживают отключение, но хранятся
+# только для WS_THROTTLE_STATS_MAX последних пользователей
+ws_throttle_stats: OrderedDict[int, dict] = OrderedDict()
+
+def _throttle_counter(user_id: int) -> dict:
+    stats = ws_throttle_stats.get(user_id)
+    if stats is None:
+        stats = ws_throttle_stats[user_id] = {"dropped": 0, "oversize": 0, "closed": 0, "by_type": {}}
+        while len(ws_throttle_stats) > WS_THROTTLE_STATS_MAX:
+            ws_throttle_stats.popitem(last=False)
+    else:
+        ws_throttle_stats.move_to_end(user_id)
+    return stats
+
+class InboundLimiter:
+    # Лимиты входящих кадров одного сокета. Нарушения копятся в скользящем окне:
+    # сначала кадры просто отбрасываются, при систематическом флуде сокет закрывается.
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.buckets: dict[str, TokenBucket] = {}
+        self.violations: deque = deque()
+
+    def allow(self, msg_type: str) -> bool:
+        key = _rate_limit_key(msg_type)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _new_bucket(key)
+        user_buckets = user_rate_buckets.setdefault(self.user_id, {})
+        user_bucket = user_buckets.get(key)
+        if user_bucket is None:
+            user_bucket = user_buckets[key] = _new_bucket(key, WS_USER_RATE_FACTOR)
+        if bucket.allow(now) and user_bucket.allow(now):
+            return True
+        stats = _throttle_counter(self.user_id)
+        stats["dropped"] += 1
+        stats["by_type"][key] = stats["by_type"].get(key, 0) + 1
+        self._violation(now)
+        return False
+
+    def oversize(self):
+        _throttle_counter(self.user_id)["oversize"] += 1
+        self._violation(time.monotonic())
+
+    def _violation(self, now: float):
+        self.violations.append(now)
+        while self.violations and now - self.violations[0] > WS_THROTTLE_WINDOW_SEC:
+            self.violations.popleft()
+
+    def should_close(self) -> bool:
+        if len(self.violations) >= WS_THROTTLE_CLOSE_AFTER:
+            _throttle_counter(self.user_id)["closed"] += 1
+            return True
+        return False
+
+RTC_ICE_BATCH_MS = max(int(os.getenv("RTC_ICE_BATCH_MS", "0") or 0), 0)
+
+class IceCandidateBatcher:
+    # Склеивает всплески trickle-ICE кандидатов в один кадр call:signal_batch на пару участников
+    def __init__(self, delay_ms: int):
+        self.delay = delay_ms / 1000
+        self.pending: dict[tuple[int, int, int], list] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.delay > 0
+
+    def add(self, chat_id: int, from_user: int, to_user: int, signal: dict):
+        key = (chat_id, from_user, to_user)
+        batch = self.pending.get(key)
+        if batch is None:
+            self.pending[key] = [signal]
+            asyncio.get_running_loop().call_later(self.delay, lambda: spawn(self.flush(key)))
+        else:
+            batch.append(signal)
+
+    async def flush(self, key: tuple[int, int, int]):
+        signals = self.pending.pop(key, None)
+        if not signals:
+            return
+        chat_id, from_user, to_user = key
+        target_ws = call_registry.room(chat_id).get(to_user)
+        if target_ws is None:
+            return
+        if len(signals) == 1:
+            payload = {"type": "call:signal", "payload": {"chat_id": chat_id, "from_user": from_user, "signal": signals[0]}}
+        else:
+            payload = {"type": "call:signal_batch", "payload": {"chat_id": chat_id, "from_user": from_user, "signals": signals}}
+        send_frame(target_ws, payload)
+
+ice_batcher = IceCandidateBatcher(RTC_ICE_BATCH_MS)
+
+PRESENCE_TICK_SEC = float(os.getenv("PRESENCE_TICK_SEC", "1"))
+PRESENCE_MIN_INTERVAL_SEC = float(os.getenv("PRESENCE_MIN_INTERVAL_SEC", "5"))
+PRESENCE_FLUSH_SEC = float(os.getenv("PRESENCE_FLUSH_SEC", "30"))
+
+def _show_last_seen_mode(conn: sqlite3.Connection, user_id: int) -> str:
+    row = conn.execute("SELECT show_last_seen FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    return row["show_last_seen"] if row else "friends"
+
+def last_seen_visible(conn: sqlite3.Connection, viewer_id: int, target_id: int, mode: Optional[str] = None) -> bool:
+    if viewer_id == target_id:
+        return True
+    mode = mode or _show_last_seen_mode(conn, target_id)
+    if mode == "everyone":
+        return not is_any_block(conn, viewer_id, target_id)
+    if mode == "friends":
+        return is_friend(conn, target_id, viewer_id)
+    return False
+
+class PresenceTracker:
+    # Онлайн-статус живёт в памяти и управляется подключениями/heartbeat сокетов.
+    # last_seen пишется в БД пачками раз в PRESENCE_FLUSH_SEC, а изменения статуса
+    # рассылаются друзьям не чаще PRESENCE_MIN_INTERVAL_SEC на пользователя.
+    def __init__(self):
+        self.online: dict[int, int] = {}
+        self.last_seen: dict[int, str] = {}
+        self.dirty: set[int] = set()
+        self.changes: dict[int, bool] = {}
+        self.announced: dict[int, tuple[bool, float]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def is_online(self, user_id: int) -> bool:
+        return self.online.get(user_id, 0) > 0
+
+    def snapshot(self, user_id: int, stored_last_seen: Optional[str] = None) -> dict:
+        return {
+            "user_id": user_id,
+            "online": self.is_online(user_id),
+            "last_seen": self.last_seen.get(user_id, stored_last_seen),
+        }
+
+    def _touch(self, user_id: int):
+        self.last_seen[user_id] = now_iso()
+        self.dirty.add(user_id)
+
+    def connect(self, user_id: int):
+        self.online[user_id] = self.online.get(user_id, 0) + 1
+        self._touch(user_id)
+        if self.online[user_id] == 1:
+            self.changes[user_id] = True
+
+    def heartbeat(self, user_id: int):
+        self._touch(user_id)
+
+    def disconnect(self, user_id: int):
+        left = self.online.get(user_id, 0) - 1
+        self._touch(user_id)
+        if left > 0:
+            self.online[user_id] = left
+            return
+        self.online.pop(user_id, None)
+        self.changes[user_id] = False
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        next_flush = time.monotonic() + PRESENCE_FLUSH_SEC
+        while True:
+            await asyncio.sleep(PRESENCE_TICK_SEC)
+            try:
+                await self.announce()
+                if time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + PRESENCE_FLUSH_SEC
+                    await self.flush()
+            except Exception as exc:
+                logger.warning("presence tick failed: %s", exc)
+
+    async def flush(self):
+        # Пачка забирается на цикле: _touch() продолжает пополнять новый dirty,
+        # пока поток пишет в базу
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        batch = [(self.last_seen[uid], uid) for uid in dirty if uid in self.last_seen]
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as exc:
+            self.dirty |= dirty
+            logger.warning("presence flush failed, %d users requeued: %s", len(dirty), exc)
+            return
+        self._prune(dirty)
+
+    @staticmethod
+    def _write(batch: list[tuple[str, int]]):
+        conn = get_db()
+        try:
+            with db_lock, conn:
+                conn.executemany("UPDATE users SET last_seen = ? WHERE id = ?", batch)
+        finally:
+            conn.close()
+
+    def _prune(self, flushed: set[int]):
+        # Ушедшие пользователи с записанным last_seen больше не нужны в памяти:
+        # snapshot() возьмёт значение из базы. announced держим, пока действует
+        # ограничение частоты, иначе переподключение сразу разошлётся заново
+        now = time.monotonic()
+        for user_id in flushed:
+            if self.is_online(user_id) or user_id in self.dirty or user_id in self.changes:
+                continue
+            self.last_seen.pop(user_id, None)
+            announced = self.announced.get(user_id)
+            if announced is not None and now - announced[1] >= PRESENCE_MIN_INTERVAL_SEC:
+                del self.announced[user_id]
+
+    async def announce(self):
+        now = time.monotonic()
+        updates = []
+        for user_id, online in list(self.changes.items()):
+            prev_state, prev_at = self.announced.get(user_id, (None, 0.0))
+            if now - prev_at < PRESENCE_MIN_INTERVAL_SEC:
+                continue
+            del self.changes[user_id]
+            if prev_state == online:
+                continue
+            self.announced[user_id] = (online, now)
+            updates.append(user_id)
+        if not updates:
+            return
+        marks = ",".join("?" * len(updates))
+        conn = get_db()
+        hidden = {
+            r["user_id"]
+            for r in conn.execute(f"SELECT user_id FROM user_settings WHERE show_last_seen = 'nobody' AND user_id IN ({marks})", updates).fetchall()
+        }
+        friend_rows = conn.execute(f"SELECT user_id, friend_id FROM friends WHERE user_id IN ({marks})", updates).fetchall()
+        conn.close()
+        per_recipient: dict[int, list[dict]] = {}
+        for r in friend_rows:
+            if r["user_id"] in hidden or not active_connections.get(r["friend_id"]):
+                continue
+            per_recipient.setdefault(r["friend_id"], []).append(self.snapshot(r["user_id"]))
+        for recipient_id, users in per_recipient.items():
+            await push_to_user(recipient_id, {"type": "presence:update", "payload": {"users": users}})
+
+presence = PresenceTracker()
+
+SINGLEFLIGHT_TTL_SEC = float(os.getenv("SINGLEFLIGHT_TTL_MS", "0")) / 1000
+
+class SingleFlight:
+    # Одинаковые параллельные чтения (ключ: эндпоинт, параметры, область видимости)
+    # выполняют один общий запрос в пуле потоков. По желанию результат живёт ещё
+    # SINGLEFLIGHT_TTL_MS. Персональная фильтрация делается вызывающим кодом поверх.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.inflight: dict[tuple, asyncio.Task] = {}
+        self.cache: dict[tuple, tuple[float, object]] = {}
+        self.generation = 0
+        self.executed = 0
+        self.shared = 0
+        self.cache_hits = 0
+
+    def stats(self) -> dict:
+        return {
+            "executed": self.executed,
+            "shared": self.shared,
+            "cache_hits": self.cache_hits,
+            "inflight": len(self.inflight),
+            "cached": len(self.cache),
+            "ttl_ms": int(self.ttl * 1000),
+        }
+
+    async def do(self, key: tuple, fn, *args):
+        if self.ttl > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    self.cache_hits += 1
+                    return cached[1]
+                self.cache.pop(key, None)
+        # Запрос идёт отдельной задачей, а все вызывающие (и первый тоже) ждут её
+        # через shield: отмена первого (клиент ушёл) не оставляет остальных без ответа
+        task = self.inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.executed += 1
+            task = asyncio.create_task(asyncio.to_thread(fn, *args))
+            self.inflight[key] = task
+            generation = self.generation
+            task.add_done_callback(lambda done: self._finish(key, done, generation))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: tuple, task: asyncio.Task, generation: int):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        # forget() во время запроса: результат мог прочитать данные до изменения
+        if self.ttl > 0 and generation == self.generation:
+            self.cache[key] = (time.monotonic() + self.ttl, task.result())
+
+    def forget(self, *prefix):
+        self.generation += 1
+        for key in [k for k in self.cache if k[:len(prefix)] == prefix]:
+            self.cache.pop(key, None)
+        # Новые вызовы не должны присоединяться к запросу, начатому до изменения
+        for key in [k for k in self.inflight if k[:len(prefix)] == prefix]:
+            self.inflight.pop(key, None)
+
+single_flight = SingleFlight(SINGLEFLIGHT_TTL_SEC)
+
+def _fetch_chat_members(chat_id: int) -> list[dict]:
+    conn = get_db()
+    rows = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar, cm.role FROM chat_members cm JOIN users u ON u.id = cm.user_id WHERE cm.chat_id = ? ORDER BY CASE cm.role WHEN 'owner' THEN 0 WHEN 'admin' THEN 1 ELSE 2 END, u.nickname", (chat_id,)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+def _fetch_user_card(user_id: int) -> Optional[dict]:
+    conn = get_db()
+    row = conn.execute(
+        "SELECT u.id, u.username, u.nickname, u.avatar, u.about, u.last_seen, "
+        "COALESCE(s.allow_friend_requests, 'everyone') AS allow_friend_requests, "
+        "COALESCE(s.show_last_seen, 'friends') AS show_last_seen "
+        "FROM users u LEFT JOIN user_settings s ON s.user_id = u.id WHERE u.id = ?",
+        (user_id,),
+    ).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def _fetch_assets(user_id: int, kind: str) -> list[dict]:
+    conn = get_db()
+    items = _load_assets(conn, user_id, kind)
+    conn.close()
+    return items
+
+CHAT_CACHE_TAIL = 200
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CHAT_CACHE_READER_BYTES = 16
+
+class ChatTail:
+    __slots__ = ("messages", "readers", "deleted_for", "complete", "bytes")
+
+    def __init__(self, complete: bool):
+        self.messages: OrderedDict[int, dict] = OrderedDict()
+        self.readers: dict[int, set[int]] = {}
+        self.deleted_for: dict[int, set[int]] = {}
+        self.complete = complete
+        self.bytes = 0
+
+class ChatTailCache:
+    # Хвост последних CHAT_CACHE_TAIL сериализованных сообщений активных чатов.
+    # Персональная часть (удалённые "у себя", read_count) хранится рядом и
+    # применяется при выдаче. Вытеснение LRU целыми чатами по бюджету памяти.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[int, ChatTail] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "chats": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def get(self, chat_id: int, user_id: int, limit: int) -> Optional[list[dict]]:
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(chat_id)
+        items = self._visible(entry, user_id, limit)
+        if items is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return items
+
+    def _visible(self, entry: ChatTail, user_id: int, limit: int) -> Optional[list[dict]]:
+        picked = []
+        for msg_id in reversed(entry.messages):
+            if user_id in entry.deleted_for.get(msg_id, ()):
+                continue
+            picked.append(msg_id)
+            if len(picked) == limit:
+                break
+        if len(picked) < limit and not entry.complete:
+            return None
+        return [
+            {**entry.messages[msg_id], "read_count": len(entry.readers.get(msg_id, ()))}
+            for msg_id in reversed(picked)
+        ]
+
+    def fill(self, chat_id: int, user_id: int, limit: int, conn: sqlite3.Connection) -> Optional[list[dict]]:
+        rows = conn.execute(
+            "SELECT m.*, u.username, u.nickname, u.avatar FROM messages m JOIN users u ON u.id = m.user_id "
+            "WHERE m.chat_id = ? ORDER BY m.id DESC LIMIT ?",
+            (chat_id, CHAT_CACHE_TAIL),
+        ).fetchall()
+        # Если часть истории уже в архиве, хвост неполон, даже когда он короткий
+        archived = conn.execute("SELECT 1 FROM archive_ranges WHERE chat_id = ? LIMIT 1", (chat_id,)).fetchone()
+        entry = ChatTail(complete=len(rows) < CHAT_CACHE_TAIL and not archived)
+        reply_cache: dict[int, Optional[dict]] = {}
+        authors: dict[int, int] = {}
+        for r in reversed(rows):
+            data = serialize_message(r, conn=conn, reply_cache=reply_cache)
+            data.pop("read_count", None)
+            entry.messages[r["id"]] = data
+            authors[r["id"]] = r["user_id"]
+            entry.bytes += self._size(data)
+        if rows:
+            ids = list(entry.messages)
+            marks = ",".join("?" * len(ids))
+            for r in conn.execute(f"SELECT message_id, user_id FROM message_reads WHERE message_id IN ({marks})", ids).fetchall():
+                if r["user_id"] != authors[r["message_id"]]:
+                    entry.readers.setdefault(r["message_id"], set()).add(r["user_id"])
+                    entry.bytes += CHAT_CACHE_READER_BYTES
+            for r in conn.execute(f"SELECT message_id, user_id FROM message_deleted_for WHERE message_id IN ({marks})", ids).fetchall():
+                entry.deleted_for.setdefault(r["message_id"], set()).add(r["user_id"])
+                entry.bytes += CHAT_CACHE_READER_BYTES
+        self._store(chat_id, entry)
+        return self._visible(entry, user_id, limit)
+
+    def append(self, chat_id: int, data: dict):
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            return
+        item = dict(data)
+        item.pop("read_count", None)
+        item.pop("client_id", None)
+        entry.messages[item["id"]] = item
+        entry.bytes += self._size(item)
+        self.total_bytes += self._size(item)
+        while len(entry.messages) > CHAT_CACHE_TAIL:
+            self._forget(entry, next(iter(entry.messages)))
+            entry.complete = False
+        self._evict()
+
+    def mark_read(self, chat_id: int, reader_id: int, up_to_id: int):
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            return
+        for msg_id, item in entry.messages.items():
+            if msg_id > up_to_id:
+                break
+            if item["user_id"] == reader_id:
+                continue
+            readers = entry.readers.setdefault(msg_id, set())
+            if reader_id not in readers:
+                readers.add(reader_id)
+                entry.bytes += CHAT_CACHE_READER_BYTES
+                self.total_bytes += CHAT_CACHE_READER_BYTES
+
+    def delete_for(self, chat_id: int, message_id: int, user_id: int):
+        entry = self.entries.get(chat_id)
+        if entry is not None and message_id in entry.messages:
+            entry.deleted_for.setdefault(message_id, set()).add(user_id)
+
+    def delete_all(self, chat_id: int, message_id: int):
+        entry = self.entries.get(chat_id)
+        if entry is None or message_id not in entry.messages:
+            return
+        self._forget(entry, message_id)
+        for item in entry.messages.values():
+            if item["reply_to_message_id"] == message_id:
+                item["reply_preview"] = None
+
+    def drop(self, chat_id: int):
+        entry = self.entries.pop(chat_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.bytes
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def _forget(self, entry: ChatTail, message_id: int):
+        item = entry.messages.pop(message_id)
+        freed = self._size(item) + CHAT_CACHE_READER_BYTES * (
+            len(entry.readers.pop(message_id, ())) + len(entry.deleted_for.pop(message_id, ()))
+        )
+        entry.bytes -= freed
+        self.total_bytes -= freed
+
+    def _store(self, chat_id: int, entry: ChatTail):
+        self.drop(chat_id)
+        self.entries[chat_id] = entry
+        self.total_bytes += entry.bytes
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.bytes
+            self.evictions += 1
+
+    @staticmethod
+    def _size(item: dict) -> int:
+        return 200 + sum(len(v) for v in item.values() if isinstance(v, str))
+
+chat_tail_cache = ChatTailCache(CHAT_CACHE_MAX_BYTES)
+
+READ_FLUSH_SEC = float(os.getenv("READ_FLUSH_MS", "500")) / 1000
+READ_FLUSHED_CACHE_SIZE = 100_000
+
+class ReadReceiptAggregator:
+    # Подтверждения прочтения копятся в памяти: на пару (чат, пользователь) хранится
+    # только максимальный up_to_id. Раз в READ_FLUSH_MS всё пишется одной транзакцией,
+    # а участникам чата уходит одно событие message:read со всеми читателями.
+    def __init__(self):
+        self.pending: dict[tuple[int, int], int] = {}
+        self.flushed: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, chat_id: int, user_id: int, up_to_id: int):
+        key = (chat_id, user_id)
+        if up_to_id <= max(self.pending.get(key, 0), self.flushed.get(key, 0)):
+            return
+        self.pending[key] = up_to_id
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(READ_FLUSH_SEC)
+            try:
+                await self.flush()
+            except Exception as exc:
+                logger.warning("read receipts flush failed: %s", exc)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        # Поток только пишет в базу: кэш хвостов и flushed меняются здесь, на цикле
+        floors = {key: self.flushed.get(key, 0) for key in batch}
+        try:
+            await asyncio.to_thread(self._write, batch, floors)
+        except Exception as exc:
+            # Повтор безопасен: INSERT OR IGNORE, а уже записанные шарды просто ничего не добавят
+            for key, up_to_id in batch.items():
+                self.pending[key] = max(self.pending.get(key, 0), up_to_id)
+            logger.warning("read receipts flush failed, %d readers requeued: %s", len(batch), exc)
+            return
+        for key, up_to_id in batch.items():
+            chat_tail_cache.mark_read(key[0], key[1], up_to_id)
+            self.flushed[key] = max(up_to_id, self.flushed.get(key, 0))
+            self.flushed.move_to_end(key)
+        while len(self.flushed) > READ_FLUSHED_CACHE_SIZE:
+            self.flushed.popitem(last=False)
+        per_chat: dict[int, list[dict]] = {}
+        for (chat_id, user_id), up_to_id in batch.items():
+            per_chat.setdefault(chat_id, []).append({"reader_id": user_id, "up_to_id": up_to_id})
+        for chat_id, reads in per_chat.items():
+            await broadcast_to_chat(chat_id, {"type": "message:read", "payload": {"chat_id": chat_id, "reads": reads}})
+
+    def _write(self, batch: dict[tuple[int, int], int], floors: dict[tuple[int, int], int]):
+        read_at = now_iso()
+        per_store: dict[MessageStore, list[tuple[tuple[int, int], int]]] = {}
+        for key, up_to_id in batch.items():
+            per_store.setdefault(store_for_chat(key[0]), []).append((key, up_to_id))
+        for store, items in per_store.items():
+            conn = store.connect()
+            try:
+                with store.lock, conn:
+                    for (chat_id, user_id), up_to_id in items:
+                        conn.execute(
+                            "INSERT OR IGNORE INTO message_reads(message_id, user_id, read_at) "
+                            "SELECT m.id, ?, ? FROM messages m WHERE m.chat_id = ? AND m.user_id != ? AND m.id > ? AND m.id <= ?",
+                            (user_id, read_at, chat_id, user_id, floors[(chat_id, user_id)], up_to_id),
+                        )
+            finally:
+                conn.close()
+
+read_receipts = ReadReceiptAggregator()
+
+def last_foreign_message_id(conn: sqlite3.Connection, chat_id: int, user_id: int) -> Optional[int]:
+    mconn = message_conn(store_for_chat(chat_id), conn)
+    last = mconn.execute(
+        "SELECT id FROM messages WHERE chat_id = ? AND user_id != ? ORDER BY id DESC LIMIT 1",
+        (chat_id, user_id),
+    ).fetchone()
+    release_message_conn(mconn, conn)
+    return last["id"] if last else None
+
+MEMORY_SOFT_LIMIT_MB = int(os.getenv("MEMORY_SOFT_LIMIT_MB", "0"))
+MEMORY_CHECK_SEC = float(os.getenv("MEMORY_CHECK_SEC", "5"))
+UPLOAD_INFLIGHT_LIMIT_MB = int(os.getenv("UPLOAD_INFLIGHT_LIMIT_MB", "256"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+TRACEMALLOC_MAX_SECONDS = 60
+# Одно окно tracemalloc за раз: stop() первого окна сломал бы снимок второго
+tracemalloc_window = asyncio.Lock()
+
+def process_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # Вне Linux доступен только пик, а не текущий RSS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def deep_sizeof(obj, limit: int = 100_000) -> int:
+    # Оценка по контейнерам: обходим dict/list/set/tuple/deque и вложенные строки,
+    # прочие объекты (сокеты, задачи) считаем по sys.getsizeof без рекурсии
+    seen: set[int] = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+    return total
+
+class AccountedResponse(Response):
+    # Расшифрованное тело держится в памяти до конца отправки — учитываем его
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            memory_guard.inflight_media -= len(self.body)
+
+class MemoryGuard:
+    # Учёт памяти по подсистемам и мягкий лимит: при RSS выше MEMORY_SOFT_LIMIT_MB
+    # сбрасываем кэши и отклоняем новые загрузки, пока память не опустится ниже 90%
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.inflight_uploads = 0
+        self.inflight_media = 0
+        self.shedding = False
+        self.sheds = 0
+        self.rejected_uploads = 0
+
+    @property
+    def soft_limit(self) -> int:
+        return MEMORY_SOFT_LIMIT_MB * 1024 * 1024
+
+    def start(self):
+        if self.task is None and self.soft_limit:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(MEMORY_CHECK_SEC)
+            self.check()
+
+    def check(self):
+        rss = process_rss_bytes()
+        if rss > self.soft_limit:
+            if not self.shedding:
+                logger.warning("rss %s MB over soft limit %s MB, shedding caches", rss >> 20, MEMORY_SOFT_LIMIT_MB)
+            self.shedding = True
+            self.shed()
+        elif rss < self.soft_limit * 0.9:
+            self.shedding = False
+
+    def shed(self):
+        self.sheds += 1
+        chat_tail_cache.clear()
+        single_flight.cache.clear()
+        block_cache.clear()
+        gc.collect()
+        try:
+            # Без malloc_trim освобождённые арены glibc не возвращаются ОС и RSS не падает
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+    def admit_upload(self, size: int):
+        if self.shedding:
+            self.rejected_uploads += 1
+            raise HTTPException(status_code=503, detail="Сервер перегружен, повторите загрузку позже")
+        if self.inflight_uploads + size > UPLOAD_INFLIGHT_LIMIT_MB * 1024 * 1024:
+            self.rejected_uploads += 1
+            raise HTTPException(status_code=503, detail="Слишком много одновременных загрузок, повторите позже")
+        # Заявленный размер резервируется сразу, иначе параллельные загрузки
+        # проходят проверку до того, как их байты учтены
+        self.inflight_uploads += size
+        return size
+
+    def subsystems(self) -> dict:
+        return {
+            "chat_tail_cache": chat_tail_cache.total_bytes,
+            "single_flight_cache": deep_sizeof(single_flight.cache),
+            "block_cache": deep_sizeof(block_cache.sets),
+            "call_rooms": deep_sizeof(call_registry.rooms) + deep_sizeof(call_registry.states),
+            "active_connections": deep_sizeof(active_connections),
+            "ws_outbox_queued": sum(outbox_bytes(o) for o in list(ws_outboxes.values())),
+            "presence": deep_sizeof([presence.online, presence.last_seen, presence.changes, presence.announced]),
+            "read_receipts": deep_sizeof([read_receipts.pending, read_receipts.flushed]),
+            "uploads_inflight": self.inflight_uploads,
+            "media_inflight": self.inflight_media,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "rss_bytes": process_rss_bytes(),
+            "soft_limit_bytes": self.soft_limit,
+            "upload_inflight_limit_bytes": UPLOAD_INFLIGHT_LIMIT_MB * 1024 * 1024,
+            "shedding": self.shedding,
+            "sheds": self.sheds,
+            "rejected_uploads": self.rejected_uploads,
+            "subsystems": self.subsystems(),
+        }
+
+memory_guard = MemoryGuard()
+
+def outbox_bytes(outbox: WsOutbox) -> int:
+    return sum(len(text) for queue in outbox.queues.values() for _, text in list(queue))
+
+async def read_upload(file: UploadFile, max_bytes: int, kind: str, too_large: str) -> bytes:
+    # Файл читается кусками: превышение лимита видно сразу, а не после чтения
+    # всего тела, и байты в полёте учитываются в бюджете загрузок
+    counted = memory_guard.admit_upload(file.size or 0)
+    chunks = []
+    total = 0
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > counted:
+                memory_guard.inflight_uploads += total - counted
+                counted = total
+            if total > max_bytes:
+                raise HTTPException(status_code=400, detail=too_large)
+            chunks.append(chunk)
+        upload_size_bytes.observe(total, kind)
+        return b"".join(chunks)
+    finally:
+        memory_guard.inflight_uploads -= counted
+
+register_metric(GaugeFunc("process_resident_memory_bytes", "Resident set size of the process", process_rss_bytes))
+register_metric(GaugeFunc("memory_shedding", "1 while the soft memory limit is exceeded", lambda: int(memory_guard.shedding)))
+register_metric(GaugeFunc("uploads_inflight_bytes", "Upload bytes currently buffered in memory", lambda: memory_guard.inflight_uploads))
+
+PROFILE_MAX_SECONDS = 60
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "50"))
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{Path(code.co_filename).name}:{code.co_name}"
+
+def collapse_stack(frame) -> str:
+    # Стек в порядке от корня к листу, как его ждут flamegraph.pl и speedscope
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+class SamplingProfiler:
+    # Периодические снимки sys._current_frames() из отдельного потока. Снимок
+    # стоит микросекунды, поэтому профиль можно снимать прямо на проде
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        # Берётся на цикле событий без ожидания: второй запрос сразу получает 409
+        return self.lock.acquire(blocking=False)
+
+    def release(self):
+        self.lock.release()
+
+    def sample(self, seconds: float, interval_sec: float, thread_filter: Optional[int] = None) -> tuple[dict[str, int], int]:
+        counts: dict[str, int] = {}
+        samples = 0
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (thread_filter is not None and ident != thread_filter):
+                    continue
+                key = names.get(ident, str(ident)) + ";" + collapse_stack(frame)
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            time.sleep(interval_sec)
+        return counts, samples
+
+sampling_profiler = SamplingProfiler()
+
+event_loop_lag_seconds = register_metric(Histogram("event_loop_lag_seconds", "Delay of a periodic event loop tick"))
+
+class LoopLagMonitor:
+    # Корутина отмечает пульс цикла событий, а сторожевой поток, заметив, что
+    # пульса нет дольше порога, снимает стек потока цикла — то, что его держит
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.loop_thread: Optional[int] = None
+        self.heartbeat = time.monotonic()
+        self.stalls = 0
+        self.max_lag_ms = 0.0
+        self.recent: deque = deque(maxlen=20)
+
+    def start(self):
+        if LOOP_LAG_THRESHOLD_MS <= 0 or self.task is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self._tick())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.task is not None,
+            "threshold_ms": LOOP_LAG_THRESHOLD_MS,
+            "stalls": self.stalls,
+            "max_lag_ms": round(self.max_lag_ms, 3),
+            "recent": list(self.recent),
+        }
+
+    async def _tick(self):
+        interval = LOOP_LAG_INTERVAL_MS / 1000
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = max(now - started - interval, 0.0)
+            event_loop_lag_seconds.observe(lag)
+            self.max_lag_ms = max(self.max_lag_ms, lag * 1000)
+            if lag * 1000 >= LOOP_LAG_THRESHOLD_MS and self.recent and self.recent[-1]["total_ms"] is None:
+                # Сторож видел зависание в процессе; полную длительность знаем только сейчас
+                self.recent[-1]["total_ms"] = round((now - started) * 1000, 1)
+            self.heartbeat = now
+
+    def _watch(self):
+        threshold = LOOP_LAG_THRESHOLD_MS / 1000
+        reported = 0.0
+        while not self.stopped.wait(LOOP_LAG_INTERVAL_MS / 1000):
+            beat = self.heartbeat
+            blocked = time.monotonic() - beat
+            # Один отчёт на зависание: следующий только после нового пульса
+            if blocked < threshold or beat == reported:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            reported = beat
+            stack = collapse_stack(frame)
+            self.stalls += 1
+            self.recent.append({"at": now_iso(), "blocked_ms": round(blocked * 1000, 1), "total_ms": None, "stack": stack})
+            logger.warning("event loop blocked for %.0f ms in %s", blocked * 1000, stack)
+
+loop_monitor = LoopLagMonitor()
+
+async def _start_background_tasks():
+    presence.start()
+    read_receipts.start()
+    archiver.start()
+    retention.start()
+    jobs.start()
+    loop_monitor.start()
+    memory_guard.start()
+
+async def _stop_background_tasks():
+    await memory_guard.stop()
+    await loop_monitor.stop()
+    await jobs.stop()
+    await retention.stop()
+    await archiver.stop()
+    await read_receipts.stop()
+    await presence.stop()
+
+def process_age_ms() -> Optional[float]:
+    # Сколько прошло с запуска процесса (Linux): холодный старт включает импорт fastapi
+    try:
+        start_ticks = int(Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()[19])
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round((uptime - start_ticks / os.sysconf("SC_CLK_TCK")) * 1000, 1)
+
+async def _startup():
+    started = time.perf_counter()
+    init_runtime()
+    await _start_background_tasks()
+    runtime_state["init_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    runtime_state["process_to_ready_ms"] = process_age_ms()
+    runtime_state["ready"] = True
+    logger.info(
+        "ready: init %s ms, %s ms since process start",
+        runtime_state["init_ms"], runtime_state["process_to_ready_ms"],
+    )
+
+async def _shutdown():
+    await drain_websockets()
+    await _stop_background_tasks()
+
+async def drain_websockets(timeout: Optional[float] = None):
+    # Плавная остановка: /readyz сразу отвечает 503, новые сокеты не принимаются,
+    # уже поставленные в очередь кадры дописываются, затем сокеты закрываются
+    # с кодом 1012 (service restart) — клиент переподключится с разбросом
+    if runtime_state["draining"]:
+        return
+    runtime_state["draining"] = True
+    if SHUTDOWN_DELAY_SEC > 0:
+        await asyncio.sleep(SHUTDOWN_DELAY_SEC)
+    timeout = WS_DRAIN_SEC if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(o.queued() for o in ws_outboxes.values() if not o.closed):
+        await asyncio.sleep(0.05)
+    outboxes = list(ws_outboxes.values())
+    if outboxes:
+        logger.info("closing %s websocket(s) for shutdown", len(outboxes))
+    for outbox in outboxes:
+        outbox.close()
+    await asyncio.gather(*(outbox._close_socket(1012) for outbox in outboxes), return_exceptions=True)
+
+@app.get("/healthz")
+async def healthz():
+    return {"ok": True}
 
-async def broadcast_to_chat(chat_id: int, payload: dict):
-    conn = get_db()
-    members = conn.execute("SELECT user_id FROM chat_members WHERE chat_id = ?", (chat_id,)).fetchall()
-    conn.close()
-    for m in members:
-        await push_to_user(m["user_id"], payload)
+@app.get("/readyz")
+async def readyz():
+    body = {
+        "ready": runtime_state["ready"] and not runtime_state["draining"],
+        "draining": runtime_state["draining"],
+        "init_ms": runtime_state["init_ms"],
+        "process_to_ready_ms": runtime_state["process_to_ready_ms"],
+    }
+    if body["ready"]:
+        try:
+            conn = get_db()
+            conn.execute("SELECT 1 FROM app_meta LIMIT 1").fetchall()
+            conn.close()
+        except sqlite3.Error as exc:
+            body.update(ready=False, error=str(exc))
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     response = templates.TemplateResponse("index.html", {"request": request})
     response.headers["Permissions-Policy"] = "camera=(self), microphone=(self), display-capture=(self)"
+    # Страница ссылается на статику с хэшем в имени — её саму нужно перепроверять
+    response.headers["Cache-Control"] = "no-cache"
     return response
 
+def _rtc_config() -> dict:
+    return {"ice_servers": ICE_SERVERS, "ice_policy": "all"}
+
 @app.get("/api/rtc-config")
 async def rtc_config():
-    return {"ice_servers": ICE_SERVERS, "ice_policy": "all"}
+    return _rtc_config()
 
-@app.get("/media/{file_name}")
-async def media_file(file_name: str, request: Request, token: str = ""):
+def _media_user(request: Request, token: str):
     user = None
     if token:
         user = get_user_by_token(token)
@@ -651,13 +3825,40 @@ async def media_file(file_name: str, request: Request, token: str = ""):
             user = get_user_by_token(bearer)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    return user
+
+@app.get("/media/thumb/{file_name}")
+async def media_thumbnail(file_name: str, request: Request, token: str = ""):
+    _media_user(request, token)
+    safe = Path(file_name).name
+    source = UPLOAD_DIR / safe
+    if Image is None or not (mimetypes.guess_type(safe)[0] or "").startswith("image/") or not source.exists():
+        raise HTTPException(status_code=404, detail="Превью нет")
+    try:
+        payload = await asyncio.to_thread(render_media_thumb, source)
+    except Exception as exc:
+        logger.warning("thumbnail for %s failed: %s", safe, exc)
+        raise HTTPException(status_code=404, detail="Превью нет")
+    media_bytes_served.inc(amount=len(payload))
+    response = Response(content=payload, media_type="image/jpeg")
+    # Имя файла вложения уникально и не меняется, значит, и превью тоже
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+@app.get("/media/{file_name}")
+async def media_file(file_name: str, request: Request, token: str = ""):
+    _media_user(request, token)
     safe = Path(file_name).name
     target = UPLOAD_DIR / safe
     if not target.exists():
         raise HTTPException(status_code=404, detail="Файл не найден")
+    started = time.perf_counter()
     payload = read_encrypted_file(target)
+    media_decrypt_seconds.observe(time.perf_counter() - started)
+    media_bytes_served.inc(amount=len(payload))
+    memory_guard.inflight_media += len(payload)
     ctype = mimetypes.guess_type(safe)[0] or "application/octet-stream"
-    response = Response(content=payload, media_type=ctype)
+    response = AccountedResponse(content=payload, media_type=ctype)
     response.headers["Permissions-Policy"] = "camera=(self), microphone=(self), display-capture=(self)"
     return response
 
@@ -681,8 +3882,8 @@ async def register(data: RegisterIn, request: Request):
     try:
         with db_lock, conn:
             conn.execute(
-                "INSERT INTO users(username, password_hash, nickname, created_at) VALUES (?, ?, ?, ?)",
-                (username, hash_password(data.password), nickname, now_iso()),
+                "INSERT INTO users(username, password_hash, nickname, nickname_key, created_at) VALUES (?, ?, ?, ?, ?)",
+                (username, hash_password(data.password), nickname, nickname_key(nickname), now_iso()),
             )
             user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
             ensure_settings(conn, user["id"])
@@ -742,10 +3943,19 @@ async def delete_account(user=Depends(get_current_user)):
                     conn.execute("UPDATE chat_members SET role = 'owner' WHERE chat_id = ? AND user_id = ?", (ch["id"], new_owner["user_id"]))
             else:
                 conn.execute("DELETE FROM chats WHERE id = ?", (ch["id"],))
+                enqueue_job(conn, "purge_chat", {"chat_id": ch["id"]})
         conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM chat_members WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        enqueue_job(conn, "purge_user", {"user_id": user_id, "avatar": user["avatar"]})
     conn.close()
+    jobs.notify()
+    chat_tail_cache.clear()
+    single_flight.forget()
+    block_cache.clear()
+    # Собеседники узнают об уходе сразу, не дожидаясь, пока закроются сокеты
+    for chat_id, peers in call_registry.leave_user(user_id):
+        await send_many(peers, {"type": "call:user_left", "payload": {"chat_id": chat_id, "user_id": user_id}})
     for ws in active_connections.get(user_id, set()).copy():
         try:
             await ws.close(code=1000)
@@ -810,6 +4020,7 @@ async def update_settings(data: SettingsIn, user=Depends(get_current_user)):
         )
         settings = get_settings(conn, user["id"])
     conn.close()
+    single_flight.forget("user_card", user["id"])
     return settings
 
 @app.get("/api/blocks")
@@ -836,6 +4047,7 @@ async def block_user(target_id: int, user=Depends(get_current_user)):
         conn.execute("DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)", (user["id"], target_id, target_id, user["id"]))
         conn.execute("DELETE FROM friend_requests WHERE (from_user_id = ? AND to_user_id = ?) OR (from_user_id = ? AND to_user_id = ?)", (user["id"], target_id, target_id, user["id"]))
     conn.close()
+    block_cache.invalidate(user["id"], target_id)
     await push_to_user(target_id, {"type": "user:blocked", "payload": {"by": user["id"]}})
     return {"ok": True}
 
@@ -845,6 +4057,7 @@ async def unblock_user(target_id: int, user=Depends(get_current_user)):
     with db_lock, conn:
         conn.execute("DELETE FROM blocked_users WHERE blocker_id = ? AND blocked_id = ?", (user["id"], target_id))
     conn.close()
+    block_cache.invalidate(user["id"], target_id)
     return {"ok": True}
 
 @app.post("/api/profile")
@@ -854,9 +4067,15 @@ async def update_profile(data: ProfileIn, user=Depends(get_current_user)):
         raise HTTPException(status_code=400, detail="Ник не может быть пустым")
     conn = get_db()
     with db_lock, conn:
-        conn.execute("UPDATE users SET nickname = ?, about = ? WHERE id = ?", (nickname, data.about.strip()[:250], user["id"]))
+        conn.execute(
+            "UPDATE users SET nickname = ?, nickname_key = ?, about = ? WHERE id = ?",
+            (nickname, nickname_key(nickname), data.about.strip()[:250], user["id"]),
+        )
         updated = conn.execute("SELECT * FROM users WHERE id = ?", (user["id"],)).fetchone()
     conn.close()
+    # Ник и аватар вшиты в закэшированные сообщения и списки участников
+    chat_tail_cache.clear()
+    single_flight.forget()
     return serialize_user(updated)
 
 @app.post("/api/profile/avatar")
@@ -864,15 +4083,18 @@ async def upload_avatar(file: UploadFile = File(...), user=Depends(get_current_u
     ext = Path(file.filename or "avatar.png").suffix or ".png"
     name = f"avatar_{user['id']}_{uuid.uuid4().hex}{ext}"
     target = UPLOAD_DIR / name
-    content = await file.read()
-    if len(content) > 7 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="Файл до 7MB")
+    content = await read_upload(file, 7 * 1024 * 1024, "avatar", "Файл до 7MB")
     write_encrypted_file(target, content)
     conn = get_db()
     with db_lock, conn:
         conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (name, user["id"]))
         updated = conn.execute("SELECT * FROM users WHERE id = ?", (user["id"],)).fetchone()
+        if user["avatar"]:
+            enqueue_job(conn, "file_gc", {"paths": [user["avatar"]]})
     conn.close()
+    jobs.notify()
+    chat_tail_cache.clear()
+    single_flight.forget()
     return serialize_user(updated)
 
 @app.post("/api/groups/{chat_id}/avatar")
@@ -889,41 +4111,130 @@ async def upload_group_avatar(chat_id: int, file: UploadFile = File(...), user=D
     if member["role"] not in {"owner", "admin"}:
         conn.close()
         raise HTTPException(status_code=403, detail="Менять аватар группы могут owner/admin")
-    payload = await file.read()
-    if len(payload) > 7 * 1024 * 1024:
+    try:
+        payload = await read_upload(file, 7 * 1024 * 1024, "group_avatar", "Файл до 7MB")
+    except HTTPException:
         conn.close()
-        raise HTTPException(status_code=400, detail="Файл до 7MB")
+        raise
     ext = Path(file.filename or "group_avatar.png").suffix or ".png"
     name = f"group_avatar_{chat_id}_{uuid.uuid4().hex}{ext}"
     write_encrypted_file(UPLOAD_DIR / name, payload)
     with db_lock, conn:
         conn.execute("UPDATE chats SET avatar = ? WHERE id = ?", (name, chat_id))
+        if chat["avatar"]:
+            enqueue_job(conn, "file_gc", {"paths": [chat["avatar"]]})
     conn.close()
+    jobs.notify()
     return {"ok": True, "avatar": name, "file_url": f"/media/{name}"}
 
+def _retention_payload(conn: sqlite3.Connection, chat_id: int) -> dict:
+    row = conn.execute("SELECT max_age_days, max_count, updated_at FROM chat_retention WHERE chat_id = ?", (chat_id,)).fetchone()
+    own = {"max_age_days": row["max_age_days"] if row else None, "max_count": row["max_count"] if row else None}
+    return {
+        "chat_id": chat_id,
+        "policy": own,
+        "global": {"max_age_days": RETENTION_MAX_AGE_DAYS or None, "max_count": RETENTION_MAX_PER_CHAT or None},
+        "effective": {k: v or None for k, v in effective_retention(own["max_age_days"], own["max_count"]).items()},
+        "updated_at": row["updated_at"] if row else None,
+    }
+
+@app.get("/api/chats/{chat_id}/retention")
+async def get_chat_retention(chat_id: int, user=Depends(get_current_user)):
+    conn = get_db()
+    if not can_access_chat(conn, user["id"], chat_id):
+        conn.close()
+        raise HTTPException(status_code=403, detail="Нет доступа")
+    result = _retention_payload(conn, chat_id)
+    conn.close()
+    return result
+
+@app.put("/api/chats/{chat_id}/retention")
+async def set_chat_retention(chat_id: int, data: RetentionIn, user=Depends(get_current_user)):
+    for value in (data.max_age_days, data.max_count):
+        if value is not None and value < 1:
+            raise HTTPException(status_code=400, detail="Значения политики должны быть положительными")
+    conn = get_db()
+    chat = get_chat(conn, chat_id)
+    member = get_chat_member(conn, chat_id, user["id"]) if chat else None
+    if not member:
+        conn.close()
+        raise HTTPException(status_code=403, detail="Нет доступа")
+    if chat["type"] == "group" and member["role"] not in {"owner", "admin"}:
+        conn.close()
+        raise HTTPException(status_code=403, detail="Менять хранение истории группы могут owner/admin")
+    with db_lock, conn:
+        if data.max_age_days is None and data.max_count is None:
+            conn.execute("DELETE FROM chat_retention WHERE chat_id = ?", (chat_id,))
+        else:
+            conn.execute(
+                "INSERT INTO chat_retention(chat_id, max_age_days, max_count, updated_by, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET max_age_days = excluded.max_age_days, max_count = excluded.max_count, "
+                "updated_by = excluded.updated_by, updated_at = excluded.updated_at",
+                (chat_id, data.max_age_days, data.max_count, user["id"], now_iso()),
+            )
+    result = _retention_payload(conn, chat_id)
+    conn.close()
+    return result
+
+USER_SEARCH_LIMIT = 20
+USER_SEARCH_PREFIX_LIMIT = 50
+USER_SEARCH_TRIGRAM_LIMIT = 200
+
+def _user_search_candidates(conn: sqlite3.Connection, q: str) -> dict[int, sqlite3.Row]:
+    # Префиксы берём диапазоном по индексам (username уникален, ник по nickname_key),
+    # подстроки от 3 символов — из триграммного индекса. Каждый запрос ограничен,
+    # так что время не растёт вместе с числом пользователей
+    cols = "u.id, u.username, u.nickname, u.avatar, u.about, u.nickname_key"
+    upper = q + "\U0010ffff"
+    found: dict[int, sqlite3.Row] = {}
+    queries = [
+        (f"SELECT {cols} FROM users u WHERE u.username >= ? AND u.username < ? ORDER BY u.username LIMIT ?", (q, upper, USER_SEARCH_PREFIX_LIMIT)),
+        (f"SELECT {cols} FROM users u WHERE u.nickname_key >= ? AND u.nickname_key < ? ORDER BY u.nickname_key LIMIT ?", (q, upper, USER_SEARCH_PREFIX_LIMIT)),
+    ]
+    if len(q) >= 3 and USER_TRIGRAM_ENABLED:
+        match = '"' + q.replace('"', '""') + '"'
+        queries.append((f"SELECT {cols} FROM users_fts JOIN users u ON u.id = users_fts.rowid WHERE users_fts MATCH ? LIMIT ?", (match, USER_SEARCH_TRIGRAM_LIMIT)))
+    elif len(q) >= 3:
+        queries.append((f"SELECT {cols} FROM users u WHERE u.username LIKE ? OR u.nickname LIKE ? LIMIT ?", (f"%{q}%", f"%{q}%", USER_SEARCH_TRIGRAM_LIMIT)))
+    for query, params in queries:
+        for r in conn.execute(query, params).fetchall():
+            found.setdefault(r["id"], r)
+    return found
+
+def _user_search_rank(row: sqlite3.Row, q: str) -> tuple:
+    username = row["username"]
+    nick = row["nickname_key"] or nickname_key(row["nickname"])
+    if q in (username, nick):
+        rank = 0
+    elif username.startswith(q) or nick.startswith(q):
+        rank = 1
+    else:
+        rank = 2
+    return rank, len(username), row["id"]
+
 @app.get("/api/users/search")
 async def search_users(q: str = "", user=Depends(get_current_user)):
     q = q.strip().lower()
     if len(q) < 2:
         return []
+    q = q[:64]
     conn = get_db()
-    rows = conn.execute(
-        "SELECT id, username, nickname, avatar, about FROM users WHERE id != ? AND (username LIKE ? OR nickname LIKE ?) AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE (b.blocker_id = ? AND b.blocked_id = users.id) OR (b.blocker_id = users.id AND b.blocked_id = ?)) LIMIT 20",
-        (user["id"], f"%{q}%", f"%{q}%", user["id"], user["id"]),
-    ).fetchall()
+    blocked = block_cache.get(conn, user["id"])
+    candidates = _user_search_candidates(conn, q)
     conn.close()
-    return [dict(r) for r in rows]
+    found = [r for r in candidates.values() if r["id"] != user["id"] and r["id"] not in blocked]
+    found.sort(key=lambda r: _user_search_rank(r, q))
+    return [
+        {"id": r["id"], "username": r["username"], "nickname": r["nickname"], "avatar": r["avatar"], "about": r["about"]}
+        for r in found[:USER_SEARCH_LIMIT]
+    ]
 
 @app.get("/api/users/{target_id}")
 async def get_user_profile(target_id: int, user=Depends(get_current_user)):
-    conn = get_db()
-    target = conn.execute(
-        "SELECT id, username, nickname, avatar, about FROM users WHERE id = ?",
-        (target_id,),
-    ).fetchone()
+    target = await single_flight.do(("user_card", target_id), _fetch_user_card, target_id)
     if not target:
-        conn.close()
         raise HTTPException(status_code=404, detail="Пользователь не найден")
+    conn = get_db()
 
     is_self = target_id == user["id"]
     blocked_by_me = is_blocked(conn, user["id"], target_id) if not is_self else False
@@ -947,10 +4258,14 @@ async def get_user_profile(target_id: int, user=Depends(get_current_user)):
             (target_id, user["id"]),
         ).fetchone()
         if not is_friend_with_me and not outgoing_request and not incoming_request:
-            target_settings = get_settings(conn, target_id)
-            can_send_friend_request = target_settings["allow_friend_requests"] == "everyone"
+            can_send_friend_request = target["allow_friend_requests"] == "everyone"
 
     profile = serialize_user(target)
+    if last_seen_visible(conn, user["id"], target_id, target["show_last_seen"]):
+        seen = presence.snapshot(target_id, target["last_seen"])
+        profile.update({"online": seen["online"], "last_seen": seen["last_seen"]})
+    else:
+        profile.update({"online": None, "last_seen": None})
     profile.update(
         {
             "is_self": is_self,
@@ -968,36 +4283,15 @@ async def get_user_profile(target_id: int, user=Depends(get_current_user)):
 
 @app.get("/api/assets")
 async def list_assets(kind: str = "", user=Depends(get_current_user)):
-    conn = get_db()
-    params: list = [user["id"]]
-    query = "SELECT id, kind, title, file_path, file_name, mime_type, created_at FROM custom_assets WHERE user_id = ?"
-    if kind in {"emoji", "sticker"}:
-        query += " AND kind = ?"
-        params.append(kind)
-    query += " ORDER BY id DESC"
-    rows = conn.execute(query, params).fetchall()
-    conn.close()
-    return [
-        {
-            "id": r["id"],
-            "kind": r["kind"],
-            "title": r["title"] or "",
-            "file_url": f"/media/{r['file_path']}",
-            "file_name": r["file_name"],
-            "mime_type": r["mime_type"],
-            "created_at": r["created_at"],
-        }
-        for r in rows
-    ]
+    kind = kind if kind in {"emoji", "sticker"} else ""
+    return FastJSONResponse(await single_flight.do(("assets", user["id"], kind), _fetch_assets, user["id"], kind))
 
 @app.post("/api/assets")
 async def upload_asset(kind: str = Form(...), title: str = Form(""), file: UploadFile = File(...), user=Depends(get_current_user)):
     if kind not in {"emoji", "sticker"}:
         raise HTTPException(status_code=400, detail="kind должен быть emoji или sticker")
-    payload = await file.read()
     max_size = 2 * 1024 * 1024 if kind == "emoji" else 6 * 1024 * 1024
-    if len(payload) > max_size:
-        raise HTTPException(status_code=400, detail=f"Слишком большой файл (до {max_size // (1024*1024)}MB)")
+    payload = await read_upload(file, max_size, kind, f"Слишком большой файл (до {max_size // (1024*1024)}MB)")
     ext = Path(file.filename or "asset.bin").suffix
     safe_name = f"asset_{user['id']}_{uuid.uuid4().hex}{ext}"
     write_encrypted_file(UPLOAD_DIR / safe_name, payload)
@@ -1010,15 +4304,8 @@ async def upload_asset(kind: str = Form(...), title: str = Form(""), file: Uploa
         aid = cur.lastrowid
         row = conn.execute("SELECT id, kind, title, file_path, file_name, mime_type, created_at FROM custom_assets WHERE id = ?", (aid,)).fetchone()
     conn.close()
-    return {
-        "id": row["id"],
-        "kind": row["kind"],
-        "title": row["title"] or "",
-        "file_url": f"/media/{row['file_path']}",
-        "file_name": row["file_name"],
-        "mime_type": row["mime_type"],
-        "created_at": row["created_at"],
-    }
+    single_flight.forget("assets", user["id"])
+    return serialize_asset(row)
 
 @app.delete("/api/assets/{asset_id}")
 async def delete_asset(asset_id: int, user=Depends(get_current_user)):
@@ -1029,7 +4316,10 @@ async def delete_asset(asset_id: int, user=Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Стикер/эмодзи не найден")
     with db_lock, conn:
         conn.execute("DELETE FROM custom_assets WHERE id = ?", (asset_id,))
+        enqueue_job(conn, "file_gc", {"paths": [row["file_path"]]})
     conn.close()
+    jobs.notify()
+    single_flight.forget("assets", user["id"])
     return {"ok": True}
 
 @app.post("/api/friends/request")
@@ -1065,9 +4355,9 @@ async def send_friend_request(data: FriendRequestIn, user=Depends(get_current_us
 @app.get("/api/friends/requests")
 async def incoming_requests(user=Depends(get_current_user)):
     conn = get_db()
-    rows = conn.execute("SELECT fr.id, fr.created_at, u.id as user_id, u.username, u.nickname, u.avatar FROM friend_requests fr JOIN users u ON u.id = fr.from_user_id WHERE fr.to_user_id = ? AND fr.status = 'pending' ORDER BY fr.id DESC", (user["id"],)).fetchall()
+    items = _load_incoming_requests(conn, user["id"])
     conn.close()
-    return [dict(r) for r in rows]
+    return items
 
 @app.post("/api/friends/request/{request_id}/accept")
 async def accept_request(request_id: int, user=Depends(get_current_user)):
@@ -1098,9 +4388,9 @@ async def reject_request(request_id: int, user=Depends(get_current_user)):
 @app.get("/api/friends")
 async def list_friends(user=Depends(get_current_user)):
     conn = get_db()
-    rows = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar, u.about FROM friends f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE (b.blocker_id = ? AND b.blocked_id = f.friend_id) OR (b.blocker_id = f.friend_id AND b.blocked_id = ?)) ORDER BY u.nickname", (user["id"], user["id"], user["id"])).fetchall()
+    items = _load_friends(conn, user["id"], _load_block_set(conn, user["id"]))
     conn.close()
-    return [dict(r) for r in rows]
+    return FastJSONResponse(items)
 
 @app.post("/api/chats/direct")
 async def open_direct(data: DirectIn, user=Depends(get_current_user)):
@@ -1190,7 +4480,11 @@ async def delete_group(chat_id: int, user=Depends(get_current_user)):
     members = conn.execute("SELECT user_id FROM chat_members WHERE chat_id = ?", (chat_id,)).fetchall()
     with db_lock, conn:
         conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        enqueue_job(conn, "purge_chat", {"chat_id": chat_id})
     conn.close()
+    jobs.notify()
+    chat_tail_cache.drop(chat_id)
+    single_flight.forget("chat_members", chat_id)
     for m in members:
         await push_to_user(m["user_id"], {"type": "group:deleted", "payload": {"chat_id": chat_id}})
     return {"ok": True}
@@ -1218,10 +4512,9 @@ async def leave_chat(chat_id: int, user=Depends(get_current_user)):
             (chat_id,),
         ).fetchone()
 
-        if chat["type"] == "direct":
-            conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-        elif not remaining:
+        if chat["type"] == "direct" or not remaining:
             conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            enqueue_job(conn, "purge_chat", {"chat_id": chat_id})
         elif chat["created_by"] == user["id"]:
             new_owner_id = remaining["user_id"]
             conn.execute("UPDATE chats SET created_by = ? WHERE id = ?", (new_owner_id, chat_id))
@@ -1230,6 +4523,10 @@ async def leave_chat(chat_id: int, user=Depends(get_current_user)):
                 (chat_id, new_owner_id),
             )
     conn.close()
+    single_flight.forget("chat_members", chat_id)
+    if chat["type"] == "direct" or not remaining:
+        jobs.notify()
+        chat_tail_cache.drop(chat_id)
     return {"ok": True, "new_owner_id": new_owner_id}
 
 @app.post("/api/groups/{chat_id}/invite")
@@ -1260,6 +4557,7 @@ async def invite_group_member(chat_id: int, data: DirectIn, user=Depends(get_cur
     with db_lock, conn:
         conn.execute("INSERT OR IGNORE INTO chat_members(chat_id, user_id, role, joined_at) VALUES (?, ?, 'member', ?)", (chat_id, data.user_id, now_iso()))
     conn.close()
+    single_flight.forget("chat_members", chat_id)
     await push_to_user(data.user_id, {"type": "chat:added", "payload": {"chat_id": chat_id}})
     await broadcast_to_chat(chat_id, {"type": "group:member_added", "payload": {"chat_id": chat_id, "user_id": data.user_id}})
     return {"ok": True}
@@ -1292,6 +4590,7 @@ async def kick_group_member(chat_id: int, target_user_id: int, user=Depends(get_
     with db_lock, conn:
         conn.execute("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, target_user_id))
     conn.close()
+    single_flight.forget("chat_members", chat_id)
     payload = {"chat_id": chat_id, "user_id": target_user_id}
     await push_to_user(target_user_id, {"type": "group:member_removed", "payload": payload})
     await broadcast_to_chat(chat_id, {"type": "group:member_removed", "payload": payload})
@@ -1331,6 +4630,7 @@ async def update_group_member_role(chat_id: int, target_user_id: int, data: Memb
         else:
             conn.execute("UPDATE chat_members SET role = ? WHERE chat_id = ? AND user_id = ?", (new_role, chat_id, target_user_id))
     conn.close()
+    single_flight.forget("chat_members", chat_id)
     for uid, role in role_updates:
         await broadcast_to_chat(chat_id, {"type": "group:member_role", "payload": {"chat_id": chat_id, "user_id": uid, "role": role}})
     return {"ok": True}
@@ -1381,9 +4681,9 @@ async def invite_group_member_by_username(chat_id: int, data: UsernameIn, user=D
 @app.get("/api/groups/invites")
 async def group_invites(user=Depends(get_current_user)):
     conn = get_db()
-    rows = conn.execute("SELECT gi.id, gi.chat_id, gi.inviter_id, gi.invitee_id, gi.status, gi.created_at, c.title as chat_title, u.username as inviter_username, u.nickname as inviter_nickname FROM group_invites gi JOIN chats c ON c.id = gi.chat_id JOIN users u ON u.id = gi.inviter_id WHERE gi.invitee_id = ? AND gi.status = 'pending' ORDER BY gi.id DESC", (user["id"],)).fetchall()
+    items = _load_group_invites(conn, user["id"])
     conn.close()
-    return [dict(r) for r in rows]
+    return items
 
 @app.post("/api/groups/invites/{invite_id}/accept")
 async def accept_group_invite(invite_id: int, user=Depends(get_current_user)):
@@ -1400,6 +4700,7 @@ async def accept_group_invite(invite_id: int, user=Depends(get_current_user)):
         conn.execute("UPDATE group_invites SET status = 'accepted' WHERE id = ?", (invite_id,))
         conn.execute("INSERT OR IGNORE INTO chat_members(chat_id, user_id, role, joined_at) VALUES (?, ?, 'member', ?)", (invite["chat_id"], user["id"], now_iso()))
     conn.close()
+    single_flight.forget("chat_members", invite["chat_id"])
     await push_to_user(invite["inviter_id"], {"type": "group:invite_answer", "payload": {"invite_id": invite_id, "accepted": True}})
     await push_to_user(user["id"], {"type": "chat:added", "payload": {"chat_id": invite["chat_id"]}})
     return {"ok": True}
@@ -1420,30 +4721,42 @@ async def reject_group_invite(invite_id: int, user=Depends(get_current_user)):
 @app.get("/api/chats")
 async def get_chats(user=Depends(get_current_user)):
     conn = get_db()
-    rows = conn.execute("SELECT c.id, c.type, c.title, c.avatar, c.created_by, (SELECT m.text FROM messages m WHERE m.chat_id = c.id ORDER BY m.id DESC LIMIT 1) as last_text, (SELECT m.created_at FROM messages m WHERE m.chat_id = c.id ORDER BY m.id DESC LIMIT 1) as last_at FROM chats c JOIN chat_members cm ON cm.chat_id = c.id WHERE cm.user_id = ? ORDER BY COALESCE(last_at, c.created_at) DESC", (user["id"],)).fetchall()
-    items = []
-    for r in rows:
-        item = dict(r)
-        if item["type"] == "direct":
-            peer = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar FROM chat_members cm JOIN users u ON u.id = cm.user_id WHERE cm.chat_id = ? AND cm.user_id != ? LIMIT 1", (item["id"], user["id"])).fetchone()
-            if not peer:
-                continue
-            if is_any_block(conn, user["id"], peer["id"]):
-                continue
-            item["title"] = peer["nickname"]
-            item["peer"] = dict(peer)
-            can_call, _ = can_call_user(conn, user["id"], peer["id"])
-            item["can_call"] = can_call
-        else:
-            item["can_call"] = True
-            item["can_delete"] = item["created_by"] == user["id"]
-            role = conn.execute("SELECT role FROM chat_members WHERE chat_id = ? AND user_id = ?", (item["id"], user["id"])).fetchone()
-            count = conn.execute("SELECT COUNT(*) as total FROM chat_members WHERE chat_id = ?", (item["id"],)).fetchone()
-            item["my_role"] = role["role"] if role else "member"
-            item["member_count"] = count["total"] if count else 0
-        items.append(item)
+    items = _load_chat_list(conn, user["id"], _load_block_set(conn, user["id"]))
     conn.close()
-    return items
+    return FastJSONResponse(items)
+
+@app.get("/api/bootstrap")
+async def bootstrap(stream: bool = False, user=Depends(get_current_user)):
+    # Всё стартовое состояние клиента одним запросом и в одной читающей транзакции
+    conn = get_db()
+
+    def sections():
+        try:
+            conn.execute("BEGIN")
+            user_id = user["id"]
+            yield "me", serialize_user(user)
+            row = conn.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+            yield "settings", dict(row) if row else {"user_id": user_id, **SettingsIn().model_dump()}
+            yield "rtc", _rtc_config()
+            blocked = _load_block_set(conn, user_id)
+            yield "chats", _load_chat_list(conn, user_id, blocked)
+            friends = _load_friends(conn, user_id, blocked)
+            yield "friends", friends
+            yield "presence", _load_friend_presence(conn, [f["id"] for f in friends])
+            yield "friend_requests", _load_incoming_requests(conn, user_id)
+            yield "group_invites", _load_group_invites(conn, user_id)
+            yield "assets", _load_assets(conn, user_id)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    if stream:
+        def ndjson():
+            for name, data in sections():
+                yield json.dumps({"section": name, "data": data}, ensure_ascii=False) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    return dict(sections())
 
 @app.get("/api/chats/{chat_id}/members")
 async def chat_members(chat_id: int, user=Depends(get_current_user)):
@@ -1451,29 +4764,253 @@ async def chat_members(chat_id: int, user=Depends(get_current_user)):
     if not can_access_chat(conn, user["id"], chat_id):
         conn.close()
         raise HTTPException(status_code=403, detail="Нет доступа")
-    rows = conn.execute("SELECT u.id, u.username, u.nickname, u.avatar, cm.role FROM chat_members cm JOIN users u ON u.id = cm.user_id WHERE cm.chat_id = ? ORDER BY CASE cm.role WHEN 'owner' THEN 0 WHEN 'admin' THEN 1 ELSE 2 END, u.nickname", (chat_id,)).fetchall()
     conn.close()
-    return [dict(r) for r in rows]
+    return FastJSONResponse(await single_flight.do(("chat_members", chat_id), _fetch_chat_members, chat_id))
 
 @app.get("/api/chats/{chat_id}/messages")
-async def chat_messages(chat_id: int, limit: int = 100, user=Depends(get_current_user)):
+async def chat_messages(chat_id: int, limit: int = 100, before_id: Optional[int] = None, user=Depends(get_current_user)):
     conn = get_db()
     if not can_access_chat(conn, user["id"], chat_id):
         conn.close()
         raise HTTPException(status_code=403, detail="Нет доступа")
     limit = min(max(limit, 1), 200)
-    rows = conn.execute(
+    if chat_tail_cache.enabled and before_id is None:
+        items = chat_tail_cache.get(chat_id, user["id"], limit)
+        if items is not None:
+            conn.close()
+            return FastJSONResponse(items)
+    mconn = message_conn(store_for_chat(chat_id), conn)
+    if chat_tail_cache.enabled and before_id is None:
+        items = chat_tail_cache.fill(chat_id, user["id"], limit, mconn)
+        if items is not None:
+            release_message_conn(mconn, conn)
+            conn.close()
+            return FastJSONResponse(items)
+    cursor = before_id or (1 << 62)
+    rows = mconn.execute(
         "SELECT m.*, u.username, u.nickname, u.avatar, "
         "(SELECT COUNT(DISTINCT r.user_id) FROM message_reads r WHERE r.message_id = m.id AND r.user_id != m.user_id) as read_count "
         "FROM messages m JOIN users u ON u.id = m.user_id "
-        "WHERE m.chat_id = ? AND NOT EXISTS (SELECT 1 FROM message_deleted_for d WHERE d.message_id = m.id AND d.user_id = ?) "
+        "WHERE m.chat_id = ? AND m.id < ? AND NOT EXISTS (SELECT 1 FROM message_deleted_for d WHERE d.message_id = m.id AND d.user_id = ?) "
         "ORDER BY m.id DESC LIMIT ?",
-        (chat_id, user["id"], limit)
+        (chat_id, cursor, user["id"], limit)
     ).fetchall()
     reply_cache: dict[int, Optional[dict]] = {}
-    items = [serialize_message(r, conn=conn, reply_cache=reply_cache) for r in reversed(rows)]
+    items = [serialize_message(r, conn=mconn, reply_cache=reply_cache) for r in rows]
+    if len(items) < limit:
+        # Горячая база кончилась — продолжаем из архива с того же курсора
+        if rows:
+            cursor = rows[-1]["id"]
+        items.extend(load_archived_messages(mconn, chat_id, user["id"], cursor, limit - len(items)))
+    release_message_conn(mconn, conn)
     conn.close()
-    return items
+    items.reverse()
+    return FastJSONResponse(items)
+
+MEDIA_GALLERY_KINDS = ("image", "video", "voice", "file", "circle")
+# Сторона превью в галерее; превью видео нет — для него нужен ffmpeg
+MEDIA_THUMB_PX = int(os.getenv("MEDIA_THUMB_PX", "320"))
+
+def media_thumb_path(file_name: str) -> Path:
+    return UPLOAD_DIR / "thumbs" / f"{file_name}.jpg"
+
+def media_thumb_url(kind: str, file_path: str) -> Optional[str]:
+    if Image is None or kind != "image":
+        return None
+    return f"/media/thumb/{file_path}"
+
+def render_media_thumb(source: Path) -> bytes:
+    # Превью строится при первом запросе и хранится зашифрованным рядом с вложениями;
+    # release_files удаляет его вместе с исходником
+    target = media_thumb_path(source.name)
+    if target.exists():
+        return read_encrypted_file(target)
+    with Image.open(io.BytesIO(read_encrypted_file(source))) as img:
+        # JPEG декодируется сразу в уменьшенном масштабе, без полного растра
+        img.draft("RGB", (MEDIA_THUMB_PX, MEDIA_THUMB_PX))
+        thumb = ImageOps.exif_transpose(img).convert("RGB")
+    thumb.thumbnail((MEDIA_THUMB_PX, MEDIA_THUMB_PX))
+    out = io.BytesIO()
+    thumb.save(out, "JPEG", quality=80, optimize=True)
+    payload = out.getvalue()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+    write_encrypted_file(tmp, payload)
+    os.replace(tmp, target)
+    return payload
+
+def _load_media_page(
+    conn: sqlite3.Connection,
+    chat_id: int,
+    user_id: int,
+    kind: str,
+    before_id: Optional[int],
+    limit: int,
+) -> list[sqlite3.Row]:
+    # Условие file_path IS NOT NULL обязательно: без него планировщик не возьмёт
+    # частичный индекс idx_messages_chat_media
+    return conn.execute(
+        "SELECT m.id, m.user_id, m.kind, m.file_path, m.file_name, m.mime_type, m.file_size, m.created_at "
+        "FROM messages m "
+        "WHERE m.chat_id = ? AND m.kind = ? AND m.file_path IS NOT NULL AND m.id < ? "
+        "AND NOT EXISTS (SELECT 1 FROM message_deleted_for d WHERE d.message_id = m.id AND d.user_id = ?) "
+        "ORDER BY m.id DESC LIMIT ?",
+        (chat_id, kind, before_id or (1 << 62), user_id, limit),
+    ).fetchall()
+
+@app.get("/api/chats/{chat_id}/media")
+async def chat_media(
+    chat_id: int,
+    kind: str = "",
+    before_id: Optional[int] = None,
+    limit: int = 60,
+    user=Depends(get_current_user),
+):
+    if kind and kind not in MEDIA_GALLERY_KINDS:
+        raise HTTPException(status_code=400, detail="Неизвестный тип вложений")
+    limit = min(max(limit, 1), 200)
+    conn = get_db()
+    if not can_access_chat(conn, user["id"], chat_id):
+        conn.close()
+        raise HTTPException(status_code=403, detail="Нет доступа")
+    # Без фильтра по типу — по странице из каждого диапазона индекса и слияние по id
+    rows = []
+    mconn = message_conn(store_for_chat(chat_id), conn)
+    for k in (kind,) if kind else MEDIA_GALLERY_KINDS:
+        rows.extend(_load_media_page(mconn, chat_id, user["id"], k, before_id, limit + 1))
+    release_message_conn(mconn, conn)
+    conn.close()
+    rows.sort(key=lambda r: r["id"], reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [
+        {
+            "id": r["id"],
+            "user_id": r["user_id"],
+            "kind": r["kind"],
+            "file_url": f"/media/{r['file_path']}",
+            "thumb_url": media_thumb_url(r["kind"], r["file_path"]),
+            "file_name": r["file_name"],
+            "mime_type": r["mime_type"],
+            "size": r["file_size"],
+            "created_at": r["created_at"],
+        }
+        for r in rows
+    ]
+    return {"items": items, "has_more": has_more, "next_before_id": rows[-1]["id"] if has_more else None}
+
+SEARCH_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def fts_query(q: str, chat_id: Optional[int] = None) -> str:
+    # Пользовательский ввод не должен попадать в синтаксис MATCH: берём слова,
+    # квотируем их, последнее слово ищем по префиксу
+    tokens = SEARCH_TOKEN_RE.findall(q)[:8]
+    if not tokens:
+        return ""
+    parts = [f'"{t}"' for t in tokens]
+    parts[-1] += "*"
+    match = "{text file_name} : (" + " ".join(parts) + ")"
+    if chat_id is not None:
+        match = f'chat_id : "{int(chat_id)}" AND {match}'
+    return match
+
+def search_messages(
+    conn: sqlite3.Connection,
+    user_id: int,
+    q: str,
+    chat_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = 30,
+    sort: str = "recent",
+    offset: int = 0,
+) -> list[sqlite3.Row]:
+    match = fts_query(q, chat_id)
+    if not match:
+        return []
+    where = ["messages_fts MATCH ?"]
+    params: list = [match]
+    if before_id and sort == "recent":
+        where.append("messages_fts.rowid < ?")
+        params.append(before_id)
+    order = "bm25(messages_fts, 1.0, 0.5, 0.0), m.id DESC" if sort == "rank" else "messages_fts.rowid DESC"
+    query = (
+        "SELECT m.*, u.username, u.nickname, u.avatar, "
+        f"snippet(messages_fts, 0, '{SEARCH_MARK_OPEN}', '{SEARCH_MARK_CLOSE}', '…', 12) AS snippet, "
+        f"snippet(messages_fts, 1, '{SEARCH_MARK_OPEN}', '{SEARCH_MARK_CLOSE}', '…', 12) AS file_snippet, "
+        "bm25(messages_fts, 1.0, 0.5, 0.0) AS score "
+        "FROM messages_fts "
+        "JOIN messages m ON m.id = messages_fts.rowid "
+        "JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = ? "
+        "JOIN chats c ON c.id = m.chat_id "
+        "JOIN users u ON u.id = m.user_id "
+        f"WHERE {' AND '.join(where)} "
+        "AND NOT EXISTS (SELECT 1 FROM message_deleted_for d WHERE d.message_id = m.id AND d.user_id = ?) "
+        f"ORDER BY {order} LIMIT ? OFFSET ?"
+    )
+    return conn.execute(query, [user_id, *params, user_id, limit, offset if sort == "rank" else 0]).fetchall()
+
+@app.get("/api/search/messages")
+async def search_messages_endpoint(
+    q: str = "",
+    chat_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = 30,
+    sort: str = "recent",
+    offset: int = 0,
+    user=Depends(get_current_user),
+):
+    if not SEARCH_ENABLED:
+        raise HTTPException(status_code=503, detail="Поиск недоступен")
+    q = q.strip()
+    if len(q) < 2:
+        raise HTTPException(status_code=400, detail="Запрос слишком короткий")
+    sort = sort if sort in {"recent", "rank"} else "recent"
+    limit = min(max(limit, 1), 100)
+    offset = min(max(offset, 0), 1000)
+    conn = get_db()
+    if chat_id is not None and not can_access_chat(conn, user["id"], chat_id):
+        conn.close()
+        raise HTTPException(status_code=403, detail="Нет доступа")
+    hot = [store_for_chat(chat_id)] if chat_id is not None else list(message_stores)
+    if chat_id is not None:
+        mconn = message_conn(hot[0], conn)
+        months = chat_archive_months(mconn, chat_id, before_id or (1 << 62))
+        release_message_conn(mconn, conn)
+    else:
+        months = archive_months()
+    items = []
+    for pos, store in enumerate(hot + [archive_store(month) for month in months]):
+        if sort == "recent" and pos >= len(hot) and len(items) > limit:
+            # Архивы старше всего, что уже найдено: дальше идти незачем
+            break
+        # Каждый шард отдаёт свою верхушку, дальше сливаем; bm25 между шардами сравним приблизительно
+        mconn = message_conn(store, conn)
+        if sort == "rank":
+            rows = search_messages(mconn, user["id"], q[:200], chat_id, None, offset + limit + 1, sort, 0)
+        else:
+            rows = search_messages(mconn, user["id"], q[:200], chat_id, before_id, limit + 1, sort)
+        reply_cache: dict[int, Optional[dict]] = {}
+        for r in rows:
+            item = serialize_message(r, conn=mconn, reply_cache=reply_cache)
+            item["snippet"] = r["snippet"] if SEARCH_MARK_OPEN in (r["snippet"] or "") else (r["file_snippet"] or r["snippet"] or "")
+            item["score"] = round(-r["score"], 4)
+            items.append(item)
+        release_message_conn(mconn, conn)
+    conn.close()
+    if sort == "rank":
+        items.sort(key=lambda item: (-item["score"], -item["id"]))
+        items = items[offset:]
+    else:
+        items.sort(key=lambda item: item["id"], reverse=True)
+    has_more = len(items) > limit
+    items = items[:limit]
+    if not has_more:
+        cursor = {}
+    elif sort == "rank":
+        cursor = {"next_offset": offset + limit}
+    else:
+        cursor = {"next_before_id": items[-1]["id"]}
+    return {"items": items, "has_more": has_more, **cursor}
 
 @app.post("/api/chats/{chat_id}/messages")
 async def send_message(
@@ -1501,40 +5038,43 @@ async def send_message(
     file_path = None
     file_name = None
     mime_type = None
+    file_size = None
     if file:
         ext = Path(file.filename or "file.bin").suffix
         safe_name = f"{uuid.uuid4().hex}{ext}"
-        payload = await file.read()
-        if len(payload) > 50 * 1024 * 1024:
+        try:
+            payload = await read_upload(file, 50 * 1024 * 1024, "message", "Файл до 50MB")
+        except HTTPException:
             conn.close()
-            raise HTTPException(status_code=400, detail="Файл до 50MB")
+            raise
         write_encrypted_file(UPLOAD_DIR / safe_name, payload)
         file_path = safe_name
         file_name = file.filename
         mime_type = file.content_type
+        file_size = len(payload)
     if not text.strip() and not file_path:
         conn.close()
         raise HTTPException(status_code=400, detail="Пустое сообщение")
-    with db_lock, conn:
-        cursor = conn.execute(
-            "INSERT INTO messages(chat_id, user_id, kind, text, file_path, file_name, mime_type, reply_to_message_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                chat_id,
-                user["id"],
-                kind,
-                text.strip(),
-                file_path,
-                file_name,
-                mime_type,
-                reply_to_id,
-                now_iso(),
-            ),
-        )
-        msg_id = cursor.lastrowid
-    row = conn.execute("SELECT m.*, u.username, u.nickname, u.avatar FROM messages m JOIN users u ON u.id = m.user_id WHERE m.id = ?", (msg_id,)).fetchone()
-    data = serialize_message(row, conn=conn)
+    store = store_for_chat(chat_id)
+    mconn = message_conn(store, conn)
+    msg_id = store.insert_message(mconn, {
+        "chat_id": chat_id,
+        "user_id": user["id"],
+        "kind": kind,
+        "text": text.strip(),
+        "file_path": file_path,
+        "file_name": file_name,
+        "mime_type": mime_type,
+        "file_size": file_size,
+        "reply_to_message_id": reply_to_id,
+        "created_at": now_iso(),
+    })
+    row = mconn.execute("SELECT m.*, u.username, u.nickname, u.avatar FROM messages m JOIN users u ON u.id = m.user_id WHERE m.id = ?", (msg_id,)).fetchone()
+    data = serialize_message(row, conn=mconn)
+    chat_tail_cache.append(chat_id, data)
     if client_id:
         data["client_id"] = client_id
+    release_message_conn(mconn, conn)
     conn.close()
     await broadcast_to_chat(chat_id, {"type": "message:new", "payload": data})
     return data
@@ -1563,26 +5103,25 @@ async def send_asset_message(
     if not asset:
         conn.close()
         raise HTTPException(status_code=404, detail="Стикер/эмодзи не найден")
-    with db_lock, conn:
-        cur = conn.execute(
-            "INSERT INTO messages(chat_id, user_id, kind, text, file_path, file_name, mime_type, reply_to_message_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                chat_id,
-                user["id"],
-                asset["kind"],
-                text.strip(),
-                asset["file_path"],
-                asset["file_name"],
-                asset["mime_type"],
-                reply_to_id,
-                now_iso(),
-            ),
-        )
-        msg_id = cur.lastrowid
-    row = conn.execute("SELECT m.*, u.username, u.nickname, u.avatar FROM messages m JOIN users u ON u.id = m.user_id WHERE m.id = ?", (msg_id,)).fetchone()
-    data = serialize_message(row, conn=conn)
+    store = store_for_chat(chat_id)
+    mconn = message_conn(store, conn)
+    msg_id = store.insert_message(mconn, {
+        "chat_id": chat_id,
+        "user_id": user["id"],
+        "kind": asset["kind"],
+        "text": text.strip(),
+        "file_path": asset["file_path"],
+        "file_name": asset["file_name"],
+        "mime_type": asset["mime_type"],
+        "reply_to_message_id": reply_to_id,
+        "created_at": now_iso(),
+    })
+    row = mconn.execute("SELECT m.*, u.username, u.nickname, u.avatar FROM messages m JOIN users u ON u.id = m.user_id WHERE m.id = ?", (msg_id,)).fetchone()
+    data = serialize_message(row, conn=mconn)
+    chat_tail_cache.append(chat_id, data)
     if client_id:
         data["client_id"] = client_id
+    release_message_conn(mconn, conn)
     conn.close()
     await broadcast_to_chat(chat_id, {"type": "message:new", "payload": data})
     return data
@@ -1592,57 +5131,271 @@ async def delete_message(message_id: int, mode: str = "me", user=Depends(get_cur
     if mode not in {"me", "all"}:
         raise HTTPException(status_code=400, detail="mode должен быть me или all")
     conn = get_db()
-    row = conn.execute("SELECT id, chat_id, user_id FROM messages WHERE id = ?", (message_id,)).fetchone()
+    store, mconn, row = locate_message(message_id, conn)
     if not row:
         conn.close()
         raise HTTPException(status_code=404, detail="Сообщение не найдено")
     chat_id = row["chat_id"]
     if not can_access_chat(conn, user["id"], chat_id):
+        release_message_conn(mconn, conn)
         conn.close()
         raise HTTPException(status_code=403, detail="Нет доступа")
     if mode == "me":
-        with db_lock, conn:
-            conn.execute("INSERT OR IGNORE INTO message_deleted_for(message_id, user_id, created_at) VALUES (?, ?, ?)", (message_id, user["id"], now_iso()))
+        with store.lock, mconn:
+            mconn.execute("INSERT OR IGNORE INTO message_deleted_for(message_id, user_id, created_at) VALUES (?, ?, ?)", (message_id, user["id"], now_iso()))
+        release_message_conn(mconn, conn)
         conn.close()
+        chat_tail_cache.delete_for(chat_id, message_id, user["id"])
         await push_to_user(user["id"], {"type": "message:deleted_me", "payload": {"chat_id": chat_id, "message_id": message_id}})
         return {"ok": True}
     if row["user_id"] != user["id"]:
+        release_message_conn(mconn, conn)
         conn.close()
         raise HTTPException(status_code=403, detail="Удалять у всех может только автор сообщения")
-    with db_lock, conn:
-        conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+    files = delete_message_rows(store, mconn, [message_id])
+    release_message_conn(mconn, conn)
+    if files:
+        with db_lock, conn:
+            enqueue_job(conn, "file_gc", {"paths": files})
+        jobs.notify()
     conn.close()
+    chat_tail_cache.delete_all(chat_id, message_id)
     await broadcast_to_chat(chat_id, {"type": "message:deleted_all", "payload": {"chat_id": chat_id, "message_id": message_id}})
     return {"ok": True}
 
 @app.post("/api/chats/{chat_id}/read")
-async def mark_read(chat_id: int, user=Depends(get_current_user)):
+async def mark_read(chat_id: int, data: Optional[ReadIn] = None, user=Depends(get_current_user)):
     conn = get_db()
     if not can_access_chat(conn, user["id"], chat_id):
         conn.close()
         raise HTTPException(status_code=403, detail="Нет доступа")
-    last = conn.execute(
-        "SELECT id FROM messages WHERE chat_id = ? AND user_id != ? ORDER BY id DESC LIMIT 1",
-        (chat_id, user["id"]),
-    ).fetchone()
-    if not last:
-        conn.close()
+    last_id = last_foreign_message_id(conn, chat_id, user["id"])
+    conn.close()
+    if not last_id:
         return {"ok": True}
+    up_to_id = min(data.up_to_id, last_id) if data and data.up_to_id else last_id
+    read_receipts.add(chat_id, user["id"], up_to_id)
+    return {"ok": True, "up_to_id": up_to_id}
+
+class WsLaneMetrics:
+    # Гистограммы отправки уже копятся в LaneStats, здесь только перевод в секунды
+    def render(self) -> list[str]:
+        name = "ws_send_latency_seconds"
+        buckets = tuple(bound / 1000 for bound in WS_LATENCY_BUCKETS_MS)
+        lines = [f"# HELP {name} Time a frame waited in the socket outbox", f"# TYPE {name} histogram"]
+        for lane, stats in ws_lane_stats.items():
+            lines.extend(_render_histogram_rows(name, ("lane",), (lane,), buckets, stats.buckets, stats.latency_sum / 1000))
+        lines += ["# HELP ws_frames_dropped_total Frames dropped on outbox overflow", "# TYPE ws_frames_dropped_total counter"]
+        lines += [f'ws_frames_dropped_total{{lane="{lane}"}} {stats.dropped}' for lane, stats in ws_lane_stats.items()]
+        return lines
+
+register_metric(WsLaneMetrics())
+register_metric(GaugeFunc("ws_connections", "Open WebSocket connections", lambda: len(ws_outboxes)))
+register_metric(GaugeFunc(
+    "ws_users_online", "Users with at least one open socket",
+    lambda: sum(1 for conns in active_connections.values() if conns)))
+register_metric(GaugeFunc(
+    "ws_outbox_queued_frames", "Frames waiting in socket outboxes",
+    lambda: {(lane,): sum(len(o.queues[lane]) for o in list(ws_outboxes.values())) for lane in WS_LANES},
+    ("lane",)))
+register_metric(GaugeFunc("call_rooms_active", "Active call rooms", lambda: len(call_registry.rooms)))
+register_metric(GaugeFunc(
+    "call_participants", "Users currently in calls", lambda: sum(len(room) for room in list(call_registry.rooms.values()))))
+register_metric(GaugeFunc("chat_tail_cache_bytes", "Approximate size of the chat tail cache", lambda: chat_tail_cache.total_bytes))
+
+def require_metrics_access(request: Request):
+    # Скрейпер Prometheus умеет только Authorization: Bearer, поэтому токен админа принимаем и так
+    auth = request.headers.get("Authorization", "")
+    if ADMIN_TOKEN and auth.startswith("Bearer "):
+        supplied = auth.replace("Bearer ", "", 1).strip()
+        if secrets.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            return
+    require_admin(request)
+
+@app.get("/metrics", dependencies=[Depends(require_metrics_access)])
+async def metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/admin/queries", dependencies=[Depends(require_admin)])
+async def admin_queries(limit: int = 20, sort: str = "total"):
+    if sort not in {"total", "max", "count", "slow"}:
+        raise HTTPException(status_code=400, detail="sort: total, max, count или slow")
+    return {
+        "enabled": query_profiler.enabled,
+        "sample": query_profiler.sample,
+        "slow_ms": query_profiler.slow_sec * 1000,
+        "sampled": query_profiler.sampled,
+        "slow": query_profiler.slow,
+        "templates": len(query_profiler.entries),
+        "items": query_profiler.top(min(max(limit, 1), 200), sort),
+    }
+
+@app.post("/api/admin/queries/reset", dependencies=[Depends(require_admin)])
+async def admin_queries_reset():
+    query_profiler.reset()
+    return {"ok": True}
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = 10, interval_ms: float = 5, scope: str = "all"):
+    if scope not in {"all", "loop"}:
+        raise HTTPException(status_code=400, detail="scope: all или loop")
+    if not sampling_profiler.acquire():
+        raise HTTPException(status_code=409, detail="Профилирование уже идёт")
+    try:
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+        interval = min(max(interval_ms, 1), 1000) / 1000
+        loop_thread = threading.get_ident() if scope == "loop" else None
+        counts, samples = await asyncio.to_thread(sampling_profiler.sample, seconds, interval, loop_thread)
+    finally:
+        sampling_profiler.release()
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+    return Response(content=body, media_type="text/plain; charset=utf-8", headers={"X-Profile-Samples": str(samples)})
+
+@app.get("/api/admin/loop", dependencies=[Depends(require_admin)])
+async def admin_loop_stats():
+    return loop_monitor.stats()
+
+@app.get("/api/admin/memory", dependencies=[Depends(require_admin)])
+async def admin_memory(connections: int = 20):
+    owners = {ws: uid for uid, conns in active_connections.items() for ws in conns}
+    sockets = [
+        {
+            "user_id": owners.get(ws),
+            "queued_frames": outbox.queued(),
+            "queued_bytes": outbox_bytes(outbox),
+            "lanes": {lane: len(outbox.queues[lane]) for lane in WS_LANES},
+        }
+        for ws, outbox in list(ws_outboxes.items())
+    ]
+    sockets.sort(key=lambda item: item["queued_bytes"], reverse=True)
+    return {**memory_guard.stats(), "connections": sockets[: min(max(connections, 1), 500)]}
+
+@app.post("/api/admin/memory/shed", dependencies=[Depends(require_admin)])
+async def admin_memory_shed():
+    before = process_rss_bytes()
+    memory_guard.shed()
+    return {"rss_before": before, "rss_after": process_rss_bytes()}
+
+@app.get("/api/admin/memory/allocations", dependencies=[Depends(require_admin)])
+async def admin_memory_allocations(seconds: float = 10, limit: int = 25, group_by: str = "lineno"):
+    # tracemalloc включается только на время окна: в обычной работе он стоит дорого
+    if group_by not in {"lineno", "filename", "traceback"}:
+        raise HTTPException(status_code=400, detail="group_by: lineno, filename или traceback")
+    if tracemalloc_window.locked():
+        raise HTTPException(status_code=409, detail="Снимок памяти уже снимается")
+    async with tracemalloc_window:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(10 if group_by == "traceback" else 1)
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(min(max(seconds, 0.1), TRACEMALLOC_MAX_SECONDS))
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), group_by)
+    return {
+        "seconds": seconds,
+        "items": [
+            {
+                "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                "size_diff": stat.size_diff,
+                "size": stat.size,
+                "count_diff": stat.count_diff,
+            }
+            for stat in diff[: min(max(limit, 1), 200)]
+        ],
+    }
+
+@app.get("/api/admin/cache", dependencies=[Depends(require_admin)])
+async def admin_cache_stats():
+    return {"chat_tail": chat_tail_cache.stats(), "single_flight": single_flight.stats()}
+
+@app.get("/api/admin/archive", dependencies=[Depends(require_admin)])
+async def admin_archive_stats():
+    return archiver.stats()
+
+@app.post("/api/admin/archive/run", dependencies=[Depends(require_admin)])
+async def admin_archive_run():
+    if ARCHIVE_AFTER_DAYS <= 0:
+        raise HTTPException(status_code=400, detail="Архивирование выключено (ARCHIVE_AFTER_DAYS)")
+    return await archiver.run()
+
+@app.get("/api/admin/jobs", dependencies=[Depends(require_admin)])
+async def admin_jobs(status: str = "", kind: str = "", limit: int = 50):
+    limit = min(max(limit, 1), 500)
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if kind:
+        where.append("kind = ?")
+        params.append(kind)
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT * FROM jobs" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY id DESC LIMIT ?",
+        (*params, limit),
+    ).fetchall()
+    conn.close()
+    return {**jobs.stats(), "items": [serialize_job(r) for r in rows]}
+
+@app.get("/api/admin/jobs/{job_id}", dependencies=[Depends(require_admin)])
+async def admin_job(job_id: int):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return serialize_job(row)
+
+@app.post("/api/admin/jobs/{job_id}/retry", dependencies=[Depends(require_admin)])
+async def admin_job_retry(job_id: int):
+    conn = get_db()
     with db_lock, conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO message_reads(message_id, user_id, read_at) "
-            "SELECT m.id, ?, ? FROM messages m WHERE m.chat_id = ? AND m.user_id != ?",
-            (user["id"], now_iso(), chat_id, user["id"]),
-        )
+        row = conn.execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'failed' RETURNING *",
+            (now_iso(), now_iso(), job_id),
+        ).fetchone()
     conn.close()
-    await broadcast_to_chat(chat_id, {
-        "type": "message:read",
-        "payload": {"chat_id": chat_id, "reader_id": user["id"], "up_to_id": last["id"]},
-    })
-    return {"ok": True}
+    if not row:
+        raise HTTPException(status_code=409, detail="Повторить можно только упавшую задачу")
+    jobs.notify()
+    return serialize_job(row)
+
+@app.get("/api/admin/retention", dependencies=[Depends(require_admin)])
+async def admin_retention_stats():
+    return retention.stats()
+
+@app.post("/api/admin/retention/run", dependencies=[Depends(require_admin)])
+async def admin_retention_run():
+    return await retention.run()
+
+@app.get("/api/admin/ws", dependencies=[Depends(require_admin)])
+async def admin_ws_stats():
+    return {
+        "connections": len(ws_outboxes),
+        "users_online": sum(1 for conns in active_connections.values() if conns),
+        "queued": {
+            lane: sum(len(outbox.queues[lane]) for outbox in ws_outboxes.values())
+            for lane in WS_LANES
+        },
+        "lanes": {lane: stats.snapshot() for lane, stats in ws_lane_stats.items()},
+        "call_rooms": len(call_registry.rooms),
+        "throttled": sorted(
+            ({"user_id": uid, **stats} for uid, stats in ws_throttle_stats.items()),
+            key=lambda item: item["dropped"] + item["oversize"],
+            reverse=True,
+        )[:50],
+    }
 
 @app.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
+    if runtime_state["draining"]:
+        await ws.close(code=1012)
+        return
     token = ws.query_params.get("token", "")
     user = get_user_by_token(token)
     if not user:
@@ -1650,19 +5403,61 @@ async def ws_endpoint(ws: WebSocket):
         return
     user_id = user["id"]
     await ws.accept()
+    outbox = WsOutbox(ws)
+    ws_outboxes[ws] = outbox
+    outbox.start()
     active_connections.setdefault(user_id, set()).add(ws)
+    presence.connect(user_id)
+    limiter = InboundLimiter(user_id)
     try:
-        await ws.send_json({"type": "hello", "payload": {"user_id": user_id}})
+        send_frame(ws, {"type": "hello", "payload": {"user_id": user_id}})
         while True:
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            raw = frame.get("text")
+            if raw is None:
+                data = frame.get("bytes") or b""
+                size = len(data)
+                raw = data.decode("utf-8", errors="replace")
+            else:
+                # Лимит в байтах; кодировать нужно, только если символов хватает на превышение
+                size = len(raw) if len(raw) * 4 <= WS_MAX_FRAME_BYTES else len(raw.encode("utf-8"))
+            if size > WS_MAX_FRAME_BYTES:
+                limiter.oversize()
+                if limiter.should_close():
+                    await ws.close(code=1009)
+                    break
+                continue
             try:
-                msg = await ws.receive_json()
-            except Exception:
-                # Обрыв соединения или некорректный JSON - прерываем цикл WS для этого клиента
+                msg = json.loads(raw)
+            except ValueError:
+                # Некорректный JSON - прерываем цикл WS для этого клиента
+                break
+            if not isinstance(msg, dict):
                 break
-                
-            msg_type = msg.get("type")
+
+            msg_type = str(msg.get("type") or "")
+            if not limiter.allow(msg_type):
+                if limiter.should_close():
+                    logger.warning("ws flood from user=%s, closing socket", user_id)
+                    await ws.close(code=1008)
+                    break
+                continue
+            if msg_type.startswith("call:"):
+                _call_dbg(msg.get("chat_id"), msg_type)
             if msg_type == "ping":
-                await ws.send_json({"type": "pong"})
+                presence.heartbeat(user_id)
+                send_frame(ws, {"type": "pong"})
+                continue
+            if msg_type == "chat:read":
+                chat_id = int(msg.get("chat_id", 0))
+                conn = get_db()
+                last_id = last_foreign_message_id(conn, chat_id, user_id) if can_access_chat(conn, user_id, chat_id) else None
+                conn.close()
+                if last_id:
+                    requested = int(msg.get("up_to_id") or 0)
+                    read_receipts.add(chat_id, user_id, min(requested, last_id) if requested > 0 else last_id)
                 continue
             if msg_type == "call:join":
                 chat_id = int(msg.get("chat_id", 0))
@@ -1680,79 +5475,63 @@ async def ws_endpoint(ws: WebSocket):
                     if not allowed:
                         conn.close()
                         continue
-                room = call_rooms.setdefault(chat_id, {})
-                was_empty = len(room) == 0
-                room[user_id] = ws
                 state = {
                     "mic": bool(msg.get("mic", True)),
                     "cam": bool(msg.get("cam", False)),
                     "screen": bool(msg.get("screen", False)),
                 }
-                call_states.setdefault(chat_id, {})[user_id] = state
-                others = [uid for uid in room.keys() if uid != user_id]
-                states = call_states.get(chat_id, {})
-                member_rows = conn.execute("SELECT user_id FROM chat_members WHERE chat_id = ?", (chat_id,)).fetchall()
+                was_empty = call_registry.join(chat_id, user_id, ws, state)
+                others = [uid for uid in call_registry.room(chat_id).keys() if uid != user_id]
+                states = call_registry.room_states(chat_id)
+                member_rows = conn.execute("SELECT user_id FROM chat_members WHERE chat_id = ?", (chat_id,)).fetchall() if was_empty else []
                 conn.close()
                 if was_empty:
-                    for m in member_rows:
-                        uid = m["user_id"]
-                        if uid == user_id:
-                            continue
-                        await push_to_user(uid, {"type": "call:ring", "payload": {"chat_id": chat_id, "from_user": user_id, "chat_type": chat["type"]}})
-                await ws.send_json({"type": "call:participants", "payload": {"chat_id": chat_id, "users": others, "states": states}})
-                for uid, peer_ws in room.items():
-                    if uid != user_id:
-                        try:
-                            await peer_ws.send_json({"type": "call:user_joined", "payload": {"chat_id": chat_id, "user_id": user_id, "state": state}})
-                        except Exception:
-                            pass
+                    await push_to_users(
+                        [m["user_id"] for m in member_rows if m["user_id"] != user_id],
+                        {"type": "call:ring", "payload": {"chat_id": chat_id, "from_user": user_id, "chat_type": chat["type"]}},
+                    )
+                send_frame(ws, {"type": "call:participants", "payload": {"chat_id": chat_id, "users": others, "states": states}})
+                await send_many(
+                    call_registry.peers(chat_id, user_id),
+                    {"type": "call:user_joined", "payload": {"chat_id": chat_id, "user_id": user_id, "state": state}},
+                )
                 continue
             if msg_type == "call:leave":
                 chat_id = int(msg.get("chat_id", 0))
-                room = call_rooms.get(chat_id, {})
-                if room.get(user_id) is ws:
-                    room.pop(user_id, None)
-                    call_states.get(chat_id, {}).pop(user_id, None)
-                    for peer_ws in room.values():
-                        try:
-                            await peer_ws.send_json({"type": "call:user_left", "payload": {"chat_id": chat_id, "user_id": user_id}})
-                        except Exception:
-                            pass
-                    if not room:
-                        call_rooms.pop(chat_id, None)
-                        call_states.pop(chat_id, None)
+                peers = call_registry.leave(chat_id, user_id, ws)
+                if peers:
+                    await send_many(peers, {"type": "call:user_left", "payload": {"chat_id": chat_id, "user_id": user_id}})
                 continue
             if msg_type == "call:state":
                 chat_id = int(msg.get("chat_id", 0))
-                room = call_rooms.get(chat_id, {})
-                if room.get(user_id) is not ws:
+                if not call_registry.is_in_room(chat_id, user_id, ws):
                     continue
                 state = {
                     "mic": bool(msg.get("mic", True)),
                     "cam": bool(msg.get("cam", False)),
                     "screen": bool(msg.get("screen", False)),
                 }
-                call_states.setdefault(chat_id, {})[user_id] = state
-                for uid, peer_ws in room.items():
-                    if uid != user_id:
-                        try:
-                            await peer_ws.send_json({"type": "call:user_state", "payload": {"chat_id": chat_id, "user_id": user_id, "state": state}})
-                        except Exception:
-                            pass
+                call_registry.set_state(chat_id, user_id, state)
+                await send_many(
+                    call_registry.peers(chat_id, user_id),
+                    {"type": "call:user_state", "payload": {"chat_id": chat_id, "user_id": user_id, "state": state}},
+                )
                 continue
             if msg_type == "call:signal":
                 chat_id = int(msg.get("chat_id", 0))
                 to_user = int(msg.get("to_user", 0))
-                room = call_rooms.get(chat_id, {})
-                if room.get(user_id) is not ws:
+                if not call_registry.is_in_room(chat_id, user_id, ws):
                     continue
-                target_ws = room.get(to_user)
+                target_ws = call_registry.room(chat_id).get(to_user)
                 if target_ws:
                     signal = msg.get("signal") or {}
-                    try:
-                        await target_ws.send_json({"type": "call:signal", "payload": {"chat_id": chat_id, "from_user": user_id, "signal": signal}})
-                    except Exception:
-                        pass
+                    if ice_batcher.enabled:
+                        if isinstance(signal, dict) and signal.get("candidate") is not None:
+                            ice_batcher.add(chat_id, user_id, to_user, signal)
+                            continue
+                        # Описание SDP не должно обгонять уже накопленные кандидаты
+                        await ice_batcher.flush((chat_id, user_id, to_user))
+                    send_frame(target_ws, {"type": "call:signal", "payload": {"chat_id": chat_id, "from_user": user_id, "signal": signal}})
                 continue
     except WebSocketDisconnect:
         pass
@@ -1760,23 +5539,17 @@ async def ws_endpoint(ws: WebSocket):
         logger.error(f"WebSocket unhandled loop error: {err}")
     finally:
         active_connections.get(user_id, set()).discard(ws)
-        for chat_id in list(call_rooms.keys()):
-            room = call_rooms.get(chat_id, {})
-            if room.get(user_id) is ws:
-                room.pop(user_id, None)
-                call_states.get(chat_id, {}).pop(user_id, None)
-                for peer_ws in list(room.values()):
-                    try:
-                        await peer_ws.send_json({"type": "call:user_left", "payload": {"chat_id": chat_id, "user_id": user_id}})
-                    except Exception:
-                        pass
-            if not room:
-                call_rooms.pop(chat_id, None)
-                call_states.pop(chat_id, None)
+        presence.disconnect(user_id)
+        if not active_connections.get(user_id):
+            user_rate_buckets.pop(user_id, None)
+        ws_outboxes.pop(ws, None)
+        outbox.close()
+        for chat_id, peers in call_registry.leave_socket(ws, user_id):
+            await send_many(peers, {"type": "call:user_left", "payload": {"chat_id": chat_id, "user_id": user_id}})
 
 if __name__ == "__main__":
     import uvicorn
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
     _log_access_urls(host, port)
-    uvicorn.run("app:app", host=host, port=port, reload=True)
+    uvicorn.run("app:app", host=host, port=port, reload=True, ws_max_size=WS_SERVER_MAX_FRAME_BYTES)
@@ -0,0 +1,125 @@
+"""Бенчмарк поиска по сообщениям на синтетической базе.
+
+    python bench/bench_search.py --messages 3000000 --chats 2000 --users 500
+
+База создаётся во временном каталоге (или --db), сообщения пишутся пачками
+напрямую в SQLite, затем индекс собирается так же, как scripts/build_search_index.py.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+WORDS = (
+    "привет как дела сегодня завтра встреча проект отчёт файл фото видео звонок "
+    "hello world deploy release backend frontend sqlite index search query message "
+    "кофе обед вечер ночь утро музыка фильм книга дорога поезд самолёт город дом"
+).split()
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db")
+    parser.add_argument("--messages", type=int, default=3_000_000)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    db_path = Path(args.db or Path(tempfile.mkdtemp()) / "bench.db").resolve()
+    os.environ["DB_PATH"] = str(db_path)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+    app.init_runtime()
+
+    rnd = random.Random(args.seed)
+    # Редкие слова нужны, чтобы отдельно измерить селективные запросы
+    rare = [f"редкое{i}" for i in range(20)]
+    conn = app.get_db()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(id, username, password_hash, nickname, created_at) VALUES (?, ?, '', ?, '')",
+            [(u, f"user{u}", f"User {u}") for u in range(1, args.users + 1)],
+        )
+        conn.executemany(
+            "INSERT INTO chats(id, type, title, created_by, created_at) VALUES (?, 'group', ?, 1, '')",
+            [(c, f"chat {c}") for c in range(1, args.chats + 1)],
+        )
+        members = set()
+        for c in range(1, args.chats + 1):
+            for u in rnd.sample(range(1, args.users + 1), min(8, args.users)):
+                members.add((c, u))
+        conn.executemany(
+            "INSERT INTO chat_members(chat_id, user_id, role, joined_at) VALUES (?, ?, 'member', '')",
+            sorted(members),
+        )
+    # Пишем через триггеры (видна цена индекса на запись), потом отдельно
+    # пересобираем индекс пачками — как scripts/build_search_index.py --rebuild
+    started = time.perf_counter()
+    batch = []
+    for i in range(1, args.messages + 1):
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 14)))
+        if i % 5000 == 0:
+            text += " " + rnd.choice(rare)
+        batch.append((rnd.randint(1, args.chats), rnd.randint(1, args.users), text))
+        if len(batch) == 50_000 or i == args.messages:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO messages(chat_id, user_id, kind, text, created_at) VALUES (?, ?, 'text', ?, '')",
+                    batch,
+                )
+            batch.clear()
+    insert_sec = time.perf_counter() - started
+    with conn:
+        conn.execute("DELETE FROM messages_fts")
+        app.set_meta(conn, "messages_fts_backfill_upto", args.messages)
+    conn.close()
+
+    started = time.perf_counter()
+    app.backfill_message_index(batch=20_000)
+    conn = app.get_db()
+    with conn:
+        conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+    index_sec = time.perf_counter() - started
+    db_mb = sum(f.stat().st_size for f in db_path.parent.glob(db_path.name + "*")) / 2**20
+    print(f"messages={args.messages} insert={insert_sec:.1f}s index={index_sec:.1f}s db={db_mb:.0f}MB")
+
+    def in_chat(member, q):
+        return member["user_id"], q, member["chat_id"], "recent"
+
+    member_rows = conn.execute("SELECT chat_id, user_id FROM chat_members").fetchall()
+    cases = {
+        "common_global": lambda: (rnd.randint(1, args.users), rnd.choice(WORDS), None, "recent"),
+        "common_chat": lambda: in_chat(rnd.choice(member_rows), rnd.choice(WORDS)),
+        "prefix_global": lambda: (rnd.randint(1, args.users), rnd.choice(WORDS)[:3], None, "recent"),
+        "rare_global": lambda: (rnd.randint(1, args.users), rnd.choice(rare), None, "recent"),
+        "two_words_rank": lambda: (rnd.randint(1, args.users), f"{rnd.choice(WORDS)} {rnd.choice(WORDS)}", None, "rank"),
+    }
+    for name, make in cases.items():
+        timings = []
+        hits = 0
+        for _ in range(args.queries):
+            user_id, q, chat_id, sort = make()
+            t0 = time.perf_counter()
+            rows = app.search_messages(conn, user_id, q, chat_id, None, 31, sort)
+            timings.append((time.perf_counter() - t0) * 1000)
+            hits += len(rows)
+        print(
+            f"{name:16} p50={statistics.median(timings):7.2f}ms p95={percentile(timings, 0.95):7.2f}ms "
+            f"p99={percentile(timings, 0.99):7.2f}ms avg_hits={hits / args.queries:.1f}"
+        )
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
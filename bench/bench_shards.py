@@ -0,0 +1,102 @@
+"""Пропускная способность записи сообщений в зависимости от числа шардов.
+
+Для каждого значения --shards запускается отдельный процесс со своей базой
+(MESSAGE_SHARDS читается при импорте app). Писатели в потоках вставляют
+сообщения тем же путём, что и send_message: MessageStore.insert_message
+с блокировкой шарда и FTS-триггером.
+
+    python bench/bench_shards.py --shards 0 1 2 4 8 --writers 8 --seconds 5 [--hot 0.5]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def run_child(args) -> None:
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+    app.init_runtime()
+
+    conn = app.get_db()
+    with conn:
+        conn.execute("INSERT INTO users(id, username, password_hash, nickname, created_at) VALUES (1, 'bench', '', 'bench', '')")
+        conn.executemany(
+            "INSERT INTO chats(id, type, title, created_by, created_at) VALUES (?, 'group', ?, 1, '')",
+            [(c, f"chat {c}") for c in range(1, args.chats + 1)],
+        )
+    conn.close()
+
+    counts = [0] * args.writers
+    stop = time.perf_counter() + args.seconds
+
+    def writer(slot: int) -> None:
+        rnd = random.Random(slot)
+        conns = {}
+        while time.perf_counter() < stop:
+            # Доля --hot записей уходит в один «горячий» чат
+            chat_id = 1 if rnd.random() < args.hot else rnd.randint(1, args.chats)
+            store = app.store_for_chat(chat_id)
+            mconn = conns.get(store) or conns.setdefault(store, store.connect())
+            store.insert_message(mconn, {
+                "chat_id": chat_id,
+                "user_id": 1,
+                "kind": "text",
+                "text": "benchmark message number %d from writer %d" % (counts[slot], slot),
+                "created_at": app.now_iso(),
+            })
+            counts[slot] += 1
+        for c in conns.values():
+            c.close()
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"shards": app.MESSAGE_SHARDS, "messages": sum(counts), "per_sec": round(sum(counts) / elapsed)}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--hot", type=float, default=0.0, help="доля записей в один чат")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    for shards in args.shards:
+        workdir = Path(tempfile.mkdtemp())
+        env = dict(
+            os.environ,
+            DB_PATH=str(workdir / "bench.db"),
+            SHARD_DIR=str(workdir / "shards"),
+            UPLOAD_DIR=str(workdir / "uploads"),
+            MESSAGE_SHARDS=str(shards),
+            LOG_LEVEL="WARNING",
+        )
+        cmd = [
+            sys.executable, __file__, "--child",
+            "--writers", str(args.writers), "--seconds", str(args.seconds),
+            "--chats", str(args.chats), "--hot", str(args.hot),
+        ]
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"shards={shards:<3} writers={args.writers} hot={args.hot:.2f} -> {result['per_sec']} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Холодный старт и остановка продакшен-сервера (serve.py).
+
+    python bench/cold_start.py --runs 5
+    python bench/cold_start.py --db /tmp/bench.db --runs 5 --out start.json
+    python bench/cold_start.py --cold-pyc
+
+Каждый прогон запускает `python serve.py` на копии базы и считает время от
+запуска процесса до первого ответа /healthz, до 200 на /readyz и до первого
+авторизованного GET /api/chats. Из /readyz берутся init_ms (lifespan:
+миграции, шарды, ключи, фоновые задачи) и process_to_ready_ms по часам
+самого процесса. Затем открываются --sockets WebSocket, сервер получает
+SIGTERM и замеряется время до закрытия сокетов (1012) и выхода процесса.
+
+--cold-pyc запускает каждый прогон с пустым PYTHONPYCACHEPREFIX — так
+выглядит контейнер без байткода, собранного при сборке образа.
+Без --db база генерируется bench/seed.py во временном каталоге.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import seed as seeding  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def first_ok(client, path: str, started: float, headers: dict | None = None, timeout: float = 60.0) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            response = await client.get(path, headers=headers)
+            if response.status_code == 200:
+                return (time.perf_counter() - started) * 1000
+        except Exception:
+            pass
+        await asyncio.sleep(0.005)
+    raise SystemExit(f"{path} не ответил за {timeout:.0f}s")
+
+
+async def one_run(db_path: Path, workdir: Path, args, run: int) -> dict:
+    import httpx
+    from websockets.asyncio.client import connect
+
+    env = dict(
+        os.environ,
+        DB_PATH=str(db_path),
+        UPLOAD_DIR=str(workdir / "uploads"),
+        HOST="127.0.0.1",
+        PORT=str(args.port),
+        LOG_LEVEL="warning",
+    )
+    if args.cold_pyc:
+        env["PYTHONPYCACHEPREFIX"] = str(workdir / f"pyc-{run}")
+    base = f"http://127.0.0.1:{args.port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(ROOT / "serve.py")], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        async with httpx.AsyncClient(base_url=base, timeout=5) as client:
+            healthz_ms = await first_ok(client, "/healthz", started)
+            readyz_ms = await first_ok(client, "/readyz", started)
+            chats_ms = await first_ok(client, "/api/chats", started, {"Authorization": f"Bearer {seeding.token_for(1)}"})
+            ready = (await client.get("/readyz")).json()
+        sockets = [
+            await connect(f"ws://127.0.0.1:{args.port}/ws?token={seeding.token_for(1)}", ping_interval=None)
+            for _ in range(args.sockets)
+        ]
+        for ws in sockets:
+            await ws.recv()
+        stop_started = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        codes = []
+        for ws in sockets:
+            try:
+                while True:
+                    await ws.recv()
+            except Exception:
+                codes.append(ws.close_code)
+        sockets_closed_ms = (time.perf_counter() - stop_started) * 1000
+        while proc.poll() is None:
+            await asyncio.sleep(0.005)
+        exit_ms = (time.perf_counter() - stop_started) * 1000
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    return {
+        "healthz_ms": round(healthz_ms, 1),
+        "readyz_ms": round(readyz_ms, 1),
+        "first_api_ms": round(chats_ms, 1),
+        "init_ms": ready.get("init_ms"),
+        "process_to_ready_ms": ready.get("process_to_ready_ms"),
+        "sockets_closed_ms": round(sockets_closed_ms, 1),
+        "exit_ms": round(exit_ms, 1),
+        "close_codes": sorted(set(codes)),
+    }
+
+
+async def bench(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="cold-start-"))
+    source = Path(args.db).resolve() if args.db else None
+    if source is None:
+        source = workdir / "seed.db"
+        print("генерация базы...", file=sys.stderr)
+        # seed() импортирует app в этот процесс — серверу это не мешает
+        seeding.seed(source, users=args.users, groups=args.users // 10, directs=args.users, messages=args.messages)
+    runs = []
+    for run in range(args.runs):
+        db_path = workdir / f"run-{run}.db"
+        shutil.copyfile(source, db_path)
+        result = await one_run(db_path, workdir, args, run)
+        runs.append(result)
+        print(
+            f"run {run}: healthz={result['healthz_ms']}ms readyz={result['readyz_ms']}ms "
+            f"api={result['first_api_ms']}ms init={result['init_ms']}ms "
+            f"stop: sockets={result['sockets_closed_ms']}ms exit={result['exit_ms']}ms codes={result['close_codes']}",
+            file=sys.stderr,
+        )
+        db_path.unlink()
+    summary = {
+        key: round(percentile([r[key] for r in runs if r[key] is not None] or [0.0], 0.5), 1)
+        for key in ("healthz_ms", "readyz_ms", "first_api_ms", "init_ms", "process_to_ready_ms", "sockets_closed_ms", "exit_ms")
+    }
+    print(json.dumps({"p50": summary}, ensure_ascii=False))
+    return {
+        "meta": {"runs": args.runs, "cold_pyc": args.cold_pyc, "sockets": args.sockets, "db": str(args.db or "generated")},
+        "p50": summary,
+        "runs": runs,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="база от bench/seed.py (копируется на каждый прогон)")
+    parser.add_argument("--users", type=int, default=500, help="размер временной базы")
+    parser.add_argument("--messages", type=int, default=50_000, help="размер временной базы")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--sockets", type=int, default=50, help="WebSocket, открытых перед остановкой")
+    parser.add_argument("--port", type=int, default=8791)
+    parser.add_argument("--cold-pyc", action="store_true", help="без байткода: пустой PYTHONPYCACHEPREFIX на прогон")
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(bench(args))
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Сжатие ответов и кодирование JSON на списочных эндпоинтах.
+
+    python bench/seed.py --db /tmp/bench.db --messages 500000
+    python bench/compression_bench.py --db /tmp/bench.db --requests 200 --out compression.json
+    python bench/compression_bench.py --link-mbps 2 --rtt-ms 80
+
+Для каждого эндпоинта (get_chats, chat_messages на 200 сообщений с цитатами,
+list_friends, chat_members, list_assets, bootstrap) и каждого Accept-Encoding
+(identity, gzip, br — если установлен brotli) считаются: байты на проводе,
+степень сжатия, время сервера на запрос (p50, через httpx.ASGITransport) и
+процессорное время сжатия на запрос по http_compression_seconds_total.
+Оценка полного ответа на медленной сети — время сервера + RTT + байты /
+--link-mbps; по ней видно, где сжатие окупается, а где только тратит CPU.
+
+Отдельно сравнивается кодирование тех же данных: json.dumps (как в
+JSONResponse) против FastJSONResponse (orjson, если установлен), а также
+стоимость jsonable_encoder, которую списочные эндпоинты теперь обходят.
+Без --db база генерируется во временном каталоге с небольшими параметрами.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import seed as seeding  # noqa: E402
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def compression_cpu(app, encoding: str) -> float:
+    return app.compression_seconds.values.get((encoding,), 0.0)
+
+
+def pick_targets(app, assets: int) -> dict:
+    conn = app.get_db()
+    # Самая большая группа и самый «болтливый» чат её участника — худший случай для списков
+    chat_id, user_id = conn.execute(
+        "SELECT m.chat_id, MIN(m.user_id) FROM chat_members m JOIN chats c ON c.id = m.chat_id "
+        "WHERE c.type = 'group' GROUP BY m.chat_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    busiest = conn.execute(
+        "SELECT msg.chat_id FROM messages msg JOIN chat_members m ON m.chat_id = msg.chat_id AND m.user_id = ? "
+        "GROUP BY msg.chat_id ORDER BY COUNT(*) DESC LIMIT 1",
+        (user_id,),
+    ).fetchone()
+    friend_rich = conn.execute(
+        "SELECT user_id FROM friends GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    if assets and not conn.execute("SELECT 1 FROM custom_assets WHERE user_id = ? LIMIT 1", (user_id,)).fetchone():
+        with conn:
+            conn.executemany(
+                "INSERT INTO custom_assets(user_id, kind, title, file_path, file_name, mime_type, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 'image/png', ?)",
+                [
+                    (user_id, "emoji" if i % 3 else "sticker", f"asset {i}", f"asset_{user_id}_{i:032x}.png", f"asset{i}.png", app.now_iso())
+                    for i in range(assets)
+                ],
+            )
+    conn.close()
+    return {
+        "user_id": user_id,
+        "group_id": chat_id,
+        "messages_chat_id": busiest[0] if busiest else chat_id,
+        "friends_user_id": friend_rich[0] if friend_rich else user_id,
+    }
+
+
+def build_cases(targets: dict) -> dict:
+    def auth(user_id: int) -> dict:
+        return {"Authorization": f"Bearer {seeding.token_for(user_id)}"}
+
+    return {
+        "get_chats": ("/api/chats", auth(targets["user_id"])),
+        "chat_messages": (f"/api/chats/{targets['messages_chat_id']}/messages?limit=200", auth(targets["user_id"])),
+        "list_friends": ("/api/friends", auth(targets["friends_user_id"])),
+        "chat_members": (f"/api/chats/{targets['group_id']}/members", auth(targets["user_id"])),
+        "list_assets": ("/api/assets", auth(targets["user_id"])),
+        "bootstrap": ("/api/bootstrap", auth(targets["user_id"])),
+    }
+
+
+async def run_case(app, client, path: str, headers: dict, encoding: str, total: int) -> dict:
+    timings = []
+    wire = 0
+    raw_size = 0
+    cpu_before = compression_cpu(app, encoding)
+    for _ in range(total):
+        t0 = time.perf_counter()
+        async with client.stream("GET", path, headers={**headers, "Accept-Encoding": encoding}) as response:
+            body = b"".join([chunk async for chunk in response.aiter_raw()])
+        timings.append((time.perf_counter() - t0) * 1000)
+        if response.status_code != 200:
+            raise SystemExit(f"{path}: {response.status_code}")
+        wire = len(body)
+        got = response.headers.get("content-encoding", "identity")
+        if encoding != "identity" and got not in {encoding, "identity"}:
+            raise SystemExit(f"{path}: ждали {encoding}, пришёл {got}")
+    if encoding == "identity":
+        raw_size = wire
+    return {
+        "wire_bytes": wire,
+        "raw_bytes": raw_size,
+        "server_p50_ms": round(percentile(timings, 0.5), 3),
+        "server_p95_ms": round(percentile(timings, 0.95), 3),
+        "compress_cpu_ms": round((compression_cpu(app, encoding) - cpu_before) * 1000 / total, 4),
+    }
+
+
+def encoder_costs(app, payload, repeats: int) -> dict:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    def timed(fn) -> float:
+        started = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return round((time.perf_counter() - started) * 1000 / repeats, 4)
+
+    return {
+        "jsonable_encoder_ms": timed(lambda: jsonable_encoder(payload)),
+        "json_render_ms": timed(lambda: JSONResponse(payload)),
+        "fast_render_ms": timed(lambda: app.FastJSONResponse(payload)),
+        "fast_backend": "orjson" if app.orjson is not None else "json",
+    }
+
+
+async def bench(args) -> dict:
+    import httpx
+
+    if args.db:
+        app = seeding.load_app(Path(args.db).resolve())
+    else:
+        db_path = Path(tempfile.mkdtemp()) / "bench.db"
+        print("генерация базы...", file=sys.stderr)
+        seeding.seed(db_path, users=args.users, groups=args.users // 10, directs=args.users, messages=args.messages)
+        app = seeding.load_app(db_path)
+    targets = pick_targets(app, args.assets)
+    cases = build_cases(targets)
+    encodings = ["identity", "gzip"] + (["br"] if app.brotli is not None else [])
+    link_bytes_per_ms = args.link_mbps * 1_000_000 / 8 / 1000
+
+    results = {}
+    await app._start_background_tasks()
+    try:
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in args.cases or list(cases):
+                path, headers = cases[name]
+                await run_case(app, client, path, headers, "identity", args.warmup)
+                per_encoding = {}
+                for encoding in encodings:
+                    per_encoding[encoding] = await run_case(app, client, path, headers, encoding, args.requests)
+                raw = per_encoding["identity"]["raw_bytes"]
+                for encoding, row in per_encoding.items():
+                    row["ratio"] = round(row["wire_bytes"] / raw, 3) if raw else 1.0
+                    row["est_total_ms"] = round(row["server_p50_ms"] + args.rtt_ms + row["wire_bytes"] / link_bytes_per_ms, 1)
+                response = await client.get(path, headers=headers)
+                results[name] = {
+                    "encodings": per_encoding,
+                    "encoder": encoder_costs(app, response.json(), args.encoder_repeats),
+                }
+                line = " ".join(
+                    f"{enc}={row['wire_bytes']}B/{row['server_p50_ms']}ms/cpu {row['compress_cpu_ms']}ms/~{row['est_total_ms']}ms"
+                    for enc, row in per_encoding.items()
+                )
+                enc = results[name]["encoder"]
+                print(
+                    f"{name:14} {line} | jsonable={enc['jsonable_encoder_ms']}ms "
+                    f"json={enc['json_render_ms']}ms {enc['fast_backend']}={enc['fast_render_ms']}ms"
+                )
+    finally:
+        await app._stop_background_tasks()
+    return {
+        "meta": {
+            "targets": targets,
+            "encodings": encodings,
+            "requests": args.requests,
+            "link_mbps": args.link_mbps,
+            "rtt_ms": args.rtt_ms,
+            "gzip_level": app.COMPRESS_GZIP_LEVEL,
+            "brotli_quality": app.COMPRESS_BROTLI_QUALITY if app.brotli is not None else None,
+            "min_bytes": app.COMPRESS_MIN_BYTES,
+        },
+        "cases": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="база от bench/seed.py; без неё генерируется временная")
+    parser.add_argument("--users", type=int, default=1000, help="размер временной базы")
+    parser.add_argument("--messages", type=int, default=100_000, help="размер временной базы")
+    parser.add_argument("--assets", type=int, default=60, help="сколько стикеров/эмодзи добавить выбранному пользователю")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--encoder-repeats", type=int, default=50)
+    parser.add_argument("--link-mbps", type=float, default=5.0, help="пропускная способность для оценки полного ответа")
+    parser.add_argument("--rtt-ms", type=float, default=40.0)
+    parser.add_argument("--cases", nargs="*", help="get_chats chat_messages list_friends chat_members list_assets bootstrap")
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(bench(args))
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
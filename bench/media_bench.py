@@ -0,0 +1,453 @@
+"""Бенчмарк медиа: шифрование, загрузка, отдача и форматы хранения.
+
+    python bench/media_bench.py
+    python bench/media_bench.py --sizes 64K 1M 10M 50M --repeats 5 --out media.json
+    python bench/media_bench.py --sections formats --sizes 50M
+
+Все файлы генерируются (random.Random(--seed), несжимаемые, как видео и JPEG),
+каталог uploads/ из репозитория не используется. Разделы:
+
+  crypto    write_encrypted_file / read_encrypted_file по размерам: МБ/с и
+            прирост размера на диске;
+  upload    POST /api/chats/{id}/messages с файлом: МБ/с и пиковый прирост RSS;
+  serve     GET /media/{file}: задержка для аватарки и большого видео,
+            пиковый RSS и пропускная способность при параллельных скачиваниях;
+  range     GET /media/{file} с заголовком Range: поддерживается ли 206 и во
+            что обходится чтение 1 МБ из середины;
+  formats   альтернативные форматы хранения на тех же данных: без шифрования,
+            текущий Fernet, AES-GCM и ChaCha20-Poly1305 одним блоком и AES-GCM
+            блоками по --chunk (позволяет отдавать Range и стримить без
+            расшифровки всего файла).
+
+Запросы идут через httpx.ASGITransport в приложение в том же процессе, так
+что сеть не мешает, а RSS процесса — это RSS сервера. Чтения идут из кэша
+страниц ОС: замеряется CPU и память, а не диск. Пиковый RSS считается как
+прирост относительно RSS перед замером; память, которую аллокатор оставил
+себе после прошлых прогонов, часть пика скрывает, поэтому размеры идут по
+возрастанию. media_file расшифровывает файл синхронно в обработчике, так что
+«параллельные» скачивания на деле выстраиваются в очередь на event loop —
+это и видно по aggregate_mb_s.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import seed as seeding  # noqa: E402
+
+MB = 1024 * 1024
+SUFFIXES = {"K": 1024, "M": MB, "G": 1024 * MB}
+CHUNK_MAGIC = b"LMC1"
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    if text[-1] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+    return int(text)
+
+
+def size_label(size: int) -> str:
+    for suffix, unit in (("M", MB), ("K", 1024)):
+        if size >= unit and size % unit == 0:
+            return f"{size // unit}{suffix}"
+    return str(size)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def timing(values: list[float]) -> dict:
+    return {
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "max_ms": round(max(values), 3),
+    }
+
+
+def mb_per_sec(size: int, ms: float) -> float:
+    return round(size / MB / (ms / 1000), 1) if ms else 0.0
+
+
+class RssPeak:
+    # Фоновый поток опрашивает RSS: ru_maxrss монотонен на весь процесс и
+    # после первого большого файла уже ничего не показывает
+    def __init__(self, read_rss, interval: float = 0.002):
+        self.read_rss = read_rss
+        self.interval = interval
+        self.base = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.base = self.peak = self.read_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.read_rss())
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.read_rss())
+
+    @property
+    def delta_mb(self) -> float:
+        return round((self.peak - self.base) / MB, 1)
+
+
+def payload_for(size: int, seed_value: int) -> bytes:
+    return random.Random(seed_value * 1_000_003 + size).randbytes(size)
+
+
+class PlainFormat:
+    name = "plain"
+
+    def write(self, path: Path, payload: bytes):
+        path.write_bytes(payload)
+
+    def read(self, path: Path) -> bytes:
+        return path.read_bytes()
+
+    def read_range(self, path: Path, start: int, length: int) -> bytes:
+        with path.open("rb") as fh:
+            fh.seek(start)
+            return fh.read(length)
+
+
+class FernetFormat:
+    # Текущий формат: токен Fernet (AES-128-CBC + HMAC) в base64
+    name = "fernet"
+
+    def __init__(self, app):
+        self.app = app
+
+    def write(self, path: Path, payload: bytes):
+        self.app.write_encrypted_file(path, payload)
+
+    def read(self, path: Path) -> bytes:
+        return self.app.read_encrypted_file(path)
+
+    def read_range(self, path: Path, start: int, length: int) -> bytes:
+        return self.read(path)[start:start + length]
+
+
+class AeadFormat:
+    # Один блок: nonce + шифртекст с тегом, без base64
+    def __init__(self, name: str, cipher_cls, key: bytes):
+        self.name = name
+        self.aead = cipher_cls(key)
+
+    def write(self, path: Path, payload: bytes):
+        nonce = os.urandom(12)
+        path.write_bytes(nonce + self.aead.encrypt(nonce, payload, None))
+
+    def read(self, path: Path) -> bytes:
+        blob = path.read_bytes()
+        return self.aead.decrypt(blob[:12], blob[12:], None)
+
+    def read_range(self, path: Path, start: int, length: int) -> bytes:
+        return self.read(path)[start:start + length]
+
+
+class ChunkedAeadFormat:
+    # Заголовок (магия, размер блока, 8 байт префикса nonce), затем блоки
+    # шифртекст+тег. Nonce = префикс + номер блока, номер же идёт в AAD,
+    # так что блоки нельзя переставить. Range расшифровывает только нужные блоки.
+    def __init__(self, key: bytes, chunk: int):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self.name = f"aesgcm-chunked-{size_label(chunk)}"
+        self.aead = AESGCM(key)
+        self.chunk = chunk
+
+    def _nonce(self, prefix: bytes, index: int) -> bytes:
+        return prefix + struct.pack(">I", index)
+
+    def write(self, path: Path, payload: bytes):
+        prefix = os.urandom(8)
+        with path.open("wb") as fh:
+            fh.write(CHUNK_MAGIC + struct.pack(">I", self.chunk) + prefix)
+            for index, offset in enumerate(range(0, len(payload), self.chunk)):
+                aad = struct.pack(">I", index)
+                fh.write(self.aead.encrypt(self._nonce(prefix, index), payload[offset:offset + self.chunk], aad))
+
+    def _chunks(self, fh, first: int, last: int):
+        header = fh.read(16)
+        chunk = struct.unpack(">I", header[4:8])[0]
+        prefix = header[8:16]
+        fh.seek(16 + first * (chunk + 16))
+        for index in range(first, last + 1):
+            blob = fh.read(chunk + 16)
+            if not blob:
+                break
+            yield self.aead.decrypt(self._nonce(prefix, index), blob, struct.pack(">I", index))
+
+    def read(self, path: Path) -> bytes:
+        with path.open("rb") as fh:
+            return b"".join(self._chunks(fh, 0, 2**32 - 1))
+
+    def read_range(self, path: Path, start: int, length: int) -> bytes:
+        first, last = start // self.chunk, (start + length - 1) // self.chunk
+        with path.open("rb") as fh:
+            data = b"".join(self._chunks(fh, first, last))
+        offset = start - first * self.chunk
+        return data[offset:offset + length]
+
+
+def build_formats(app, chunk: int) -> list:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    key = os.urandom(32)
+    return [
+        PlainFormat(),
+        FernetFormat(app),
+        AeadFormat("aesgcm", AESGCM, key),
+        AeadFormat("chacha20poly1305", ChaCha20Poly1305, key),
+        ChunkedAeadFormat(key, chunk),
+    ]
+
+
+def bench_formats(app, workdir: Path, sizes: list[int], repeats: int, seed_value: int, chunk: int, only: list[str] | None = None) -> dict:
+    results = {}
+    range_len = min(MB, min(sizes))
+    for fmt in build_formats(app, chunk):
+        if only and fmt.name not in only:
+            continue
+        per_size = {}
+        for size in sizes:
+            payload = payload_for(size, seed_value)
+            path = workdir / f"{fmt.name}-{size}.bin"
+            writes, reads, ranges = [], [], []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                fmt.write(path, payload)
+                writes.append((time.perf_counter() - t0) * 1000)
+                t0 = time.perf_counter()
+                data = fmt.read(path)
+                reads.append((time.perf_counter() - t0) * 1000)
+                assert data == payload, fmt.name
+                start = max(size // 2 - range_len // 2, 0)
+                t0 = time.perf_counter()
+                part = fmt.read_range(path, start, range_len)
+                ranges.append((time.perf_counter() - t0) * 1000)
+                assert part == payload[start:start + range_len], fmt.name
+            del data
+            # Пик аллокаций Python при полном чтении — отдельным проходом,
+            # tracemalloc замедляет выделение памяти и исказил бы время
+            tracemalloc.start()
+            fmt.read(path)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            read_ms = percentile(reads, 0.5)
+            write_ms = percentile(writes, 0.5)
+            per_size[size_label(size)] = {
+                "write_ms": round(write_ms, 3),
+                "write_mb_s": mb_per_sec(size, write_ms),
+                "read_ms": round(read_ms, 3),
+                "read_mb_s": mb_per_sec(size, read_ms),
+                "range_read_ms": round(percentile(ranges, 0.5), 3),
+                "disk_overhead_pct": round(100 * (path.stat().st_size - size) / size, 2),
+                "read_peak_alloc_mb": round(peak / MB, 1),
+            }
+            path.unlink()
+        results[fmt.name] = per_size
+    return results
+
+
+async def bench_upload(app, client, chat_id: int, headers: dict, sizes: list[int], repeats: int, seed_value: int) -> dict:
+    results = {}
+    for size in sizes:
+        payload = payload_for(size, seed_value)
+        timings = []
+        peak = 0.0
+        for _ in range(repeats):
+            with RssPeak(app.process_rss_bytes) as rss:
+                t0 = time.perf_counter()
+                response = await client.post(
+                    f"/api/chats/{chat_id}/messages",
+                    headers=headers,
+                    data={"kind": "video"},
+                    files={"file": ("clip.mp4", payload, "video/mp4")},
+                )
+                timings.append((time.perf_counter() - t0) * 1000)
+            if response.status_code != 200:
+                raise SystemExit(f"загрузка {size_label(size)}: {response.status_code} {response.text}")
+            peak = max(peak, rss.delta_mb)
+        median = percentile(timings, 0.5)
+        results[size_label(size)] = {
+            **timing(timings),
+            "mb_s": mb_per_sec(size, median),
+            "rss_peak_delta_mb": peak,
+        }
+    return results
+
+
+def store_media(app, size: int, seed_value: int, ext: str) -> str:
+    name = f"bench-{size_label(size)}-{seed_value}{ext}"
+    app.write_encrypted_file(app.UPLOAD_DIR / name, payload_for(size, seed_value))
+    return name
+
+
+async def bench_serve(app, client, headers: dict, args) -> dict:
+    results = {}
+    for label, size, ext, requests in (
+        ("avatar", args.avatar_size, ".jpg", args.avatar_requests),
+        ("video", args.video_size, ".mp4", args.repeats),
+    ):
+        name = store_media(app, size, args.seed, ext)
+        timings = []
+        with RssPeak(app.process_rss_bytes) as rss:
+            for _ in range(requests):
+                t0 = time.perf_counter()
+                response = await client.get(f"/media/{name}", headers=headers)
+                timings.append((time.perf_counter() - t0) * 1000)
+                assert response.status_code == 200 and len(response.content) == size
+        results[label] = {
+            "size": size_label(size),
+            "requests": requests,
+            **timing(timings),
+            "mb_s": mb_per_sec(size, percentile(timings, 0.5)),
+            "rss_peak_delta_mb": rss.delta_mb,
+        }
+
+    name = store_media(app, args.concurrent_size, args.seed, ".mp4")
+    for concurrency in args.concurrency:
+        timings = []
+
+        async def download():
+            t0 = time.perf_counter()
+            response = await client.get(f"/media/{name}", headers=headers)
+            timings.append((time.perf_counter() - t0) * 1000)
+            assert response.status_code == 200
+
+        with RssPeak(app.process_rss_bytes) as rss:
+            started = time.perf_counter()
+            await asyncio.gather(*(download() for _ in range(concurrency)))
+            wall = time.perf_counter() - started
+        results[f"concurrent_{concurrency}x{size_label(args.concurrent_size)}"] = {
+            **timing(timings),
+            "aggregate_mb_s": round(concurrency * args.concurrent_size / MB / wall, 1),
+            "rss_peak_delta_mb": rss.delta_mb,
+        }
+    return results
+
+
+async def bench_range(app, client, headers: dict, args) -> dict:
+    size = args.video_size
+    name = store_media(app, size, args.seed, ".mp4")
+    start = size // 2
+    timings = []
+    status = None
+    returned = 0
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        response = await client.get(
+            f"/media/{name}", headers={**headers, "Range": f"bytes={start}-{start + MB - 1}"}
+        )
+        timings.append((time.perf_counter() - t0) * 1000)
+        status, returned = response.status_code, len(response.content)
+    return {
+        "size": size_label(size),
+        "supported": status == 206,
+        "status": status,
+        "bytes_requested": MB,
+        "bytes_returned": returned,
+        **timing(timings),
+    }
+
+
+def bench_crypto(app, workdir: Path, sizes: list[int], repeats: int, seed_value: int) -> dict:
+    fernet = bench_formats(app, workdir, sizes, repeats, seed_value, MB, only=["fernet"])["fernet"]
+    return {
+        label: {k: v for k, v in row.items() if k != "range_read_ms"}
+        for label, row in fernet.items()
+    }
+
+
+async def bench(args) -> dict:
+    import httpx
+
+    workdir = Path(tempfile.mkdtemp(prefix="media-bench-"))
+    os.environ["UPLOAD_DIR"] = str(workdir / "uploads")
+    db_path = workdir / "bench.db"
+    seeding.seed(db_path, users=4, groups=1, directs=0, messages=10)
+    app = seeding.load_app(db_path)
+    conn = app.get_db()
+    chat_id, user_id = conn.execute(
+        "SELECT chat_id, user_id FROM chat_members ORDER BY chat_id LIMIT 1"
+    ).fetchone()
+    conn.close()
+    headers = {"Authorization": f"Bearer {seeding.token_for(user_id)}"}
+    sizes = [parse_size(s) for s in args.sizes]
+    sections = args.sections or ["crypto", "upload", "serve", "range", "formats"]
+
+    results = {}
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        for section in sections:
+            print(f"{section}...", file=sys.stderr)
+            if section == "crypto":
+                results[section] = bench_crypto(app, workdir, sizes, args.repeats, args.seed)
+            elif section == "upload":
+                results[section] = await bench_upload(app, client, chat_id, headers, sizes, args.repeats, args.seed)
+            elif section == "serve":
+                results[section] = await bench_serve(app, client, headers, args)
+            elif section == "range":
+                results[section] = await bench_range(app, client, headers, args)
+            elif section == "formats":
+                results[section] = bench_formats(app, workdir, sizes, args.repeats, args.seed, parse_size(args.chunk))
+            print(json.dumps(results[section], ensure_ascii=False, indent=2))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "sizes": [size_label(s) for s in sizes],
+            "repeats": args.repeats,
+            "seed": args.seed,
+        },
+        **results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", nargs="*", help="crypto upload serve range formats")
+    parser.add_argument("--sizes", nargs="*", default=["64K", "1M", "10M", "50M"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--avatar-size", type=parse_size, default="48K")
+    parser.add_argument("--avatar-requests", type=int, default=200)
+    parser.add_argument("--video-size", type=parse_size, default="50M")
+    parser.add_argument("--concurrent-size", type=parse_size, default="10M")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16])
+    parser.add_argument("--chunk", default="64K", help="размер блока для aesgcm-chunked")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    args = parser.parse_args()
+
+    result = asyncio.run(bench(args))
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Бенчмарк горячих REST-эндпоинтов на сгенерированной базе.
+
+    python bench/seed.py --db /tmp/bench.db --messages 2000000
+    python bench/rest_bench.py --db /tmp/bench.db --requests 500 --concurrency 8 --out before.json
+    python bench/rest_bench.py --db /tmp/bench.db --out after.json --compare before.json
+
+Запросы идут через httpx.ASGITransport прямо в приложение, без сети и uvicorn.
+Для каждого сценария считаются p50/p95/p99, пропускная способность и число
+SQL-запросов на HTTP-запрос (по гистограмме db_query_duration_seconds из
+/metrics). Результат пишется в JSON, --compare печатает разницу с прошлым
+прогоном. Сценарии с записью (send_message, mark_read, login) меняют базу,
+поэтому для сравнения коммитов берите копию одной и той же исходной базы.
+Без --db база генерируется во временном каталоге с небольшими параметрами.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import seed as seeding  # noqa: E402
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def request_queries(app) -> int:
+    # Фоновые задачи (агрегатор прочтений и т.п.) в счёт запросов не входят
+    rows = list(app.db_query_seconds.values.items())
+    return sum(sum(row[:-1]) for labels, row in rows if labels[0] != "background")
+
+
+def build_cases(app, rnd: random.Random, info: dict) -> dict:
+    conn = app.get_db()
+    memberships = [tuple(r) for r in conn.execute("SELECT chat_id, user_id FROM chat_members").fetchall()]
+    usernames = [r[0] for r in conn.execute("SELECT username FROM users").fetchall()]
+    nicknames = [r[0] for r in conn.execute("SELECT nickname_key FROM users").fetchall()]
+    conn.close()
+    users = info["users"]
+
+    def auth(user_id: int) -> dict:
+        return {"Authorization": f"Bearer {seeding.token_for(user_id)}"}
+
+    def get_chats():
+        return "GET", "/api/chats", {"headers": auth(rnd.randint(1, users))}
+
+    def chat_messages():
+        chat_id, user_id = rnd.choice(memberships)
+        return "GET", f"/api/chats/{chat_id}/messages", {"headers": auth(user_id), "params": {"limit": 50}}
+
+    def send_message():
+        chat_id, user_id = rnd.choice(memberships)
+        return "POST", f"/api/chats/{chat_id}/messages", {"headers": auth(user_id), "data": {"text": "bench " + " ".join(rnd.sample(seeding.WORDS, 5))}}
+
+    def mark_read():
+        chat_id, user_id = rnd.choice(memberships)
+        return "POST", f"/api/chats/{chat_id}/read", {"headers": auth(user_id)}
+
+    def search_users():
+        # Поровну префиксы логинов, подстроки ников и промахи
+        source = rnd.choice((usernames, nicknames, None))
+        if source is None:
+            q = "zzq" + str(rnd.randint(0, 999))
+        else:
+            name = rnd.choice(source)
+            start = rnd.randint(0, max(len(name) - 3, 0)) if source is nicknames else 0
+            q = name[start:start + rnd.randint(3, 6)]
+        return "GET", "/api/users/search", {"headers": auth(rnd.randint(1, users)), "params": {"q": q}}
+
+    def get_user_profile():
+        return "GET", f"/api/users/{rnd.randint(1, users)}", {"headers": auth(rnd.randint(1, users))}
+
+    def login():
+        return "POST", "/api/login", {"json": {"username": rnd.choice(usernames), "password": info["password"]}}
+
+    return {
+        "get_chats": get_chats,
+        "chat_messages": chat_messages,
+        "send_message": send_message,
+        "mark_read": mark_read,
+        "search_users": search_users,
+        "get_user_profile": get_user_profile,
+        "login": login,
+    }
+
+
+async def run_case(app, client, make, total: int, concurrency: int) -> dict:
+    timings: list[float] = []
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            method, url, kwargs = make()
+            t0 = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            timings.append((time.perf_counter() - t0) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    queries_before = request_queries(app)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    queries = request_queries(app) - queries_before
+    return {
+        "requests": total,
+        "errors": errors,
+        "p50_ms": round(percentile(timings, 0.50), 3),
+        "p95_ms": round(percentile(timings, 0.95), 3),
+        "p99_ms": round(percentile(timings, 0.99), 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "rps": round(total / wall, 1),
+        "queries_per_request": round(queries / total, 2),
+    }
+
+
+def compare(current: dict, baseline: dict) -> None:
+    print(f"\nсравнение с {baseline['meta'].get('revision') or 'baseline'}:")
+    for name, result in current["cases"].items():
+        old = baseline["cases"].get(name)
+        if not old:
+            continue
+        parts = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "rps", "queries_per_request"):
+            if old[key]:
+                parts.append(f"{key}={100 * (result[key] - old[key]) / old[key]:+.1f}%")
+        print(f"{name:18} " + " ".join(parts))
+
+
+async def bench(args) -> dict:
+    import httpx
+
+    if args.db:
+        db_path = Path(args.db).resolve()
+        app = seeding.load_app(db_path)
+    else:
+        db_path = Path(tempfile.mkdtemp()) / "bench.db"
+        print("генерация базы...", file=sys.stderr)
+        seeding.seed(db_path, users=args.users, groups=args.users // 10, directs=args.users, messages=args.messages)
+        app = seeding.load_app(db_path)
+    conn = app.get_db()
+    info = json.loads(app.get_meta(conn, "bench_seed", "null") or "null")
+    conn.close()
+    if not info:
+        raise SystemExit(f"{db_path} не создана bench/seed.py")
+
+    rnd = random.Random(args.seed)
+    cases = build_cases(app, rnd, info)
+    selected = args.cases or list(cases)
+    await app._start_background_tasks()
+    results = {}
+    try:
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in selected:
+                make = cases[name]
+                # Прогрев: соединения, кэши страниц SQLite, single-flight
+                await run_case(app, client, make, min(args.warmup, args.requests), 1)
+                total = args.login_requests if name == "login" else args.requests
+                results[name] = await run_case(app, client, make, total, args.concurrency)
+                r = results[name]
+                print(
+                    f"{name:18} p50={r['p50_ms']:8.2f}ms p95={r['p95_ms']:8.2f}ms p99={r['p99_ms']:8.2f}ms "
+                    f"rps={r['rps']:8.1f} q/req={r['queries_per_request']:5.2f} errors={r['errors']}"
+                )
+    finally:
+        await app._stop_background_tasks()
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "dataset": info,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "cases": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="база от bench/seed.py; без неё генерируется временная")
+    parser.add_argument("--users", type=int, default=1000, help="размер временной базы")
+    parser.add_argument("--messages", type=int, default=100_000, help="размер временной базы")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--login-requests", type=int, default=100, help="login упирается в pbkdf2, ему хватит меньше")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cases", nargs="*", help="get_chats chat_messages send_message mark_read search_users get_user_profile login")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда записать JSON с результатами")
+    parser.add_argument("--compare", help="JSON прошлого прогона")
+    args = parser.parse_args()
+
+    result = asyncio.run(bench(args))
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.compare:
+        compare(result, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Генератор синтетической базы для бенчмарков.
+
+    python bench/seed.py --db /tmp/bench.db --users 5000 --groups 800 --messages 2000000
+
+Создаёт пользователей (у всех пароль --password и сессия с токеном bench-<id>),
+граф дружбы со степенным распределением, блокировки, личные чаты между
+друзьями и группы с перекошенными размерами (большинство маленьких, единицы
+на сотни участников). Сообщения распределяются по чатам по закону Ципфа,
+часть из них — ответы, для каждого участника пишутся прочтения хвоста чата.
+Параметры генерации сохраняются в app_meta (ключ bench_seed), их читает
+bench/rest_bench.py.
+
+Запись идёт напрямую в SQLite, мимо HTTP, поэтому база собирается без шардов;
+для замеров с шардами после генерации запустите scripts/reshard.py.
+"""
+import argparse
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+WORDS = (
+    "привет как дела сегодня завтра встреча проект отчёт файл фото видео звонок "
+    "hello world deploy release backend frontend sqlite index search query message "
+    "кофе обед вечер ночь утро музыка фильм книга дорога поезд самолёт город дом"
+).split()
+NAMES = (
+    "alex maria ivan olga dmitry anna sergey elena pavel irina nikita daria "
+    "kirill sofia maxim polina artem vera egor alina roman ksenia denis yulia"
+).split()
+BATCH = 50_000
+
+
+def token_for(user_id: int) -> str:
+    return f"bench-{user_id}"
+
+
+def load_app(db_path: Path):
+    # DB_PATH читается при импорте app, поэтому выставляем его заранее
+    os.environ["DB_PATH"] = str(db_path)
+    os.environ.setdefault("MESSAGE_SHARDS", "0")
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+    app.init_runtime()
+
+    return app
+
+
+def seed(
+    db_path: Path,
+    users: int = 2000,
+    groups: int = 300,
+    directs: int = 3000,
+    messages: int = 500_000,
+    friends: int = 20,
+    reply_share: float = 0.1,
+    read_tail: int = 30,
+    password: str = "benchpass",
+    seed_value: int = 1,
+) -> dict:
+    app = load_app(db_path)
+    rnd = random.Random(seed_value)
+    conn = app.get_db()
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        conn.close()
+        raise SystemExit(f"{db_path} уже не пустая, генерация идёт только в новую базу")
+    started = time.perf_counter()
+    # Один хэш на всех: pbkdf2 на каждого пользователя занял бы минуты
+    password_hash = app.hash_password(password)
+    now = datetime.now(timezone.utc)
+    created = (now - timedelta(days=365)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    user_rows = []
+    for uid in range(1, users + 1):
+        nickname = f"{rnd.choice(NAMES).title()} {rnd.choice(NAMES).title()}{uid}"
+        user_rows.append((uid, f"user{uid}", password_hash, nickname, app.nickname_key(nickname), created))
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(id, username, password_hash, nickname, nickname_key, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            user_rows,
+        )
+        conn.executemany("INSERT INTO user_settings(user_id) VALUES (?)", [(uid,) for uid in range(1, users + 1)])
+        conn.executemany(
+            "INSERT INTO sessions(token, user_id, created_at) VALUES (?, ?, ?)",
+            [(token_for(uid), uid, now.strftime("%Y-%m-%dT%H:%M:%SZ")) for uid in range(1, users + 1)],
+        )
+
+    # Дружба: степень по Парето, у «популярных» пользователей сотни друзей
+    pairs: set[tuple[int, int]] = set()
+    for uid in range(1, users + 1):
+        degree = min(int(rnd.paretovariate(1.5) * friends / 3), users - 1)
+        for other in rnd.sample(range(1, users + 1), min(degree + 1, users)):
+            if other != uid:
+                pairs.add((min(uid, other), max(uid, other)))
+    blocks = set()
+    for _ in range(users // 50):
+        a, b = rnd.sample(range(1, users + 1), 2)
+        if (min(a, b), max(a, b)) not in pairs:
+            blocks.add((a, b))
+    with conn:
+        conn.executemany(
+            "INSERT INTO friends(user_id, friend_id, created_at) VALUES (?, ?, ?)",
+            [row for a, b in pairs for row in ((a, b, created), (b, a, created))],
+        )
+        conn.executemany(
+            "INSERT INTO friend_requests(from_user_id, to_user_id, status, created_at) VALUES (?, ?, 'accepted', ?)",
+            [(a, b, created) for a, b in pairs],
+        )
+        conn.executemany(
+            "INSERT INTO blocked_users(blocker_id, blocked_id, created_at) VALUES (?, ?, ?)",
+            [(a, b, created) for a, b in blocks],
+        )
+
+    chats = []
+    members: list[tuple[int, int, str, str]] = []
+    chat_id = 0
+    for a, b in rnd.sample(sorted(pairs), min(directs, len(pairs))):
+        chat_id += 1
+        chats.append((chat_id, "direct", None, a, created))
+        members += [(chat_id, a, "member", created), (chat_id, b, "member", created)]
+    for _ in range(groups):
+        chat_id += 1
+        size = max(3, min(int(rnd.paretovariate(1.2) * 3), users, 1000))
+        group = rnd.sample(range(1, users + 1), size)
+        chats.append((chat_id, "group", f"group {chat_id}", group[0], created))
+        members += [(chat_id, uid, "owner" if i == 0 else "member", created) for i, uid in enumerate(group)]
+    with conn:
+        conn.executemany("INSERT INTO chats(id, type, title, created_by, created_at) VALUES (?, ?, ?, ?, ?)", chats)
+        conn.executemany("INSERT INTO chat_members(chat_id, user_id, role, joined_at) VALUES (?, ?, ?, ?)", members)
+
+    chat_members: dict[int, list[int]] = {}
+    for cid, uid, _, _ in members:
+        chat_members.setdefault(cid, []).append(uid)
+    chat_ids = [c[0] for c in chats]
+    rnd.shuffle(chat_ids)
+    # Ципф: вес чата обратно пропорционален его рангу
+    cumulative = list(itertools.accumulate(1 / rank for rank in range(1, len(chat_ids) + 1)))
+    last_in_chat: dict[int, int] = {}
+    step = timedelta(days=365) / max(messages, 1)
+    batch = []
+    for mid in range(1, messages + 1):
+        cid = chat_ids[bisect.bisect(cumulative, rnd.random() * cumulative[-1])]
+        reply_to = last_in_chat.get(cid) if rnd.random() < reply_share else None
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 14)))
+        at = (now - timedelta(days=365) + step * mid).strftime("%Y-%m-%dT%H:%M:%SZ")
+        batch.append((mid, cid, rnd.choice(chat_members[cid]), text, reply_to, at))
+        last_in_chat[cid] = mid
+        if len(batch) == BATCH or mid == messages:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO messages(id, chat_id, user_id, kind, text, reply_to_message_id, created_at) "
+                    "VALUES (?, ?, ?, 'text', ?, ?, ?)",
+                    batch,
+                )
+            batch.clear()
+
+    # Прочтения: каждый участник прочитал чат до случайной точки в хвосте,
+    # строки пишутся только для последних read_tail сообщений перед ней
+    reads = 0
+    with conn:
+        for cid, uids in chat_members.items():
+            tail = [r[0] for r in conn.execute(
+                "SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?", (cid, read_tail * 2)
+            ).fetchall()]
+            if not tail:
+                continue
+            for uid in uids:
+                upto = rnd.randrange(len(tail))
+                rows = [(mid, uid, created) for mid in tail[upto:upto + read_tail]]
+                conn.executemany("INSERT OR IGNORE INTO message_reads(message_id, user_id, read_at) VALUES (?, ?, ?)", rows)
+                reads += len(rows)
+        summary = {
+            "users": users,
+            "friend_pairs": len(pairs),
+            "blocks": len(blocks),
+            "direct_chats": sum(1 for c in chats if c[1] == "direct"),
+            "group_chats": groups,
+            "largest_group": max((len(v) for v in chat_members.values()), default=0),
+            "messages": messages,
+            "reads": reads,
+            "password": password,
+            "seed": seed_value,
+        }
+        app.set_meta(conn, "bench_seed", json.dumps(summary))
+    conn.execute("ANALYZE")
+    conn.close()
+    summary["seconds"] = round(time.perf_counter() - started, 1)
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=300)
+    parser.add_argument("--directs", type=int, default=3000)
+    parser.add_argument("--messages", type=int, default=500_000)
+    parser.add_argument("--friends", type=int, default=20, help="средняя степень графа дружбы")
+    parser.add_argument("--reply-share", type=float, default=0.1)
+    parser.add_argument("--read-tail", type=int, default=30)
+    parser.add_argument("--password", default="benchpass")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    summary = seed(
+        Path(args.db).resolve(),
+        users=args.users,
+        groups=args.groups,
+        directs=args.directs,
+        messages=args.messages,
+        friends=args.friends,
+        reply_share=args.reply_share,
+        read_tail=args.read_tail,
+        password=args.password,
+        seed_value=args.seed,
+    )
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
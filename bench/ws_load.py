@@ -0,0 +1,403 @@
+"""Нагрузочный тест WebSocket: рассылка в группы, прочтения и сигналинг звонков.
+
+    python bench/ws_load.py --users 3000 --group-size 200 --rate 50 --seconds 30
+    python bench/ws_load.py --users 1000 --slow-share 0.1 --slow-delay-ms 500
+    python bench/ws_load.py --users 400 --calls 50 --call-size 4 --signal-rate 20 --rate 0
+
+Без --url поднимается отдельный serve.py на временной базе. Пользователи,
+сессии (токен wsload-<id>) и группы пишутся прямо в SQLite сервера, поэтому
+для чужого сервера нужен и --db. Каждый пользователь держит один сокет и
+состоит ровно в одной группе. Отправители шлют сообщения через REST с меткой
+времени в тексте, задержка доставки считается по приходу message:new на
+каждый сокет группы. Медленные клиенты (--slow-share) читают с паузой, так
+видно, как сервер обходится с отстающими потребителями. Для звонков участники
+первых --calls групп заходят в комнату и обмениваются call:signal.
+
+CPU сервера берётся из /proc/<pid>/stat, поэтому тест рассчитан на Linux и
+запуск на одной машине. Для тысяч сокетов нужен достаточный ulimit -n:
+скрипт сам поднимает мягкий лимит до жёсткого.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+        "max_ms": round(max(values), 3) if values else 0.0,
+    }
+
+
+def process_cpu_seconds(pid: int) -> float:
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    # utime и stime — 14-е и 15-е поля, после отрезанных pid и comm
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    return soft
+
+
+def start_server(port: int, extra_env: list[str]):
+    workdir = Path(tempfile.mkdtemp(prefix="wsload-"))
+    env = dict(
+        os.environ,
+        DB_PATH=str(workdir / "messenger.db"),
+        UPLOAD_DIR=str(workdir / "uploads"),
+        LOG_LEVEL="WARNING",
+    )
+    env.update(HOST="127.0.0.1", PORT=str(port))
+    env.update(item.split("=", 1) for item in extra_env)
+    proc = subprocess.Popen([sys.executable, str(ROOT / "serve.py")], cwd=ROOT, env=env)
+    return proc, workdir / "messenger.db"
+
+
+async def wait_ready(client, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/api/rtc-config")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("сервер не поднялся")
+
+
+def seed(db_path: Path, users: int, group_size: int) -> dict[int, list[int]]:
+    conn = sqlite3.connect(db_path, timeout=30)
+    first = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]) + 1
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    ids = list(range(first, first + users))
+    groups: dict[int, list[int]] = {}
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(id, username, password_hash, nickname, nickname_key, created_at) VALUES (?, ?, '', ?, ?, ?)",
+            [(uid, f"wsload{uid}", f"Load {uid}", f"load {uid}", now) for uid in ids],
+        )
+        conn.executemany("INSERT INTO user_settings(user_id) VALUES (?)", [(uid,) for uid in ids])
+        conn.executemany(
+            "INSERT INTO sessions(token, user_id, created_at) VALUES (?, ?, ?)",
+            [(f"wsload-{uid}", uid, now) for uid in ids],
+        )
+        for start in range(0, users, group_size):
+            members = ids[start:start + group_size]
+            cur = conn.execute(
+                "INSERT INTO chats(type, title, created_by, created_at) VALUES ('group', ?, ?, ?)",
+                (f"load {start // group_size}", members[0], now),
+            )
+            groups[cur.lastrowid] = members
+            conn.executemany(
+                "INSERT INTO chat_members(chat_id, user_id, role, joined_at) VALUES (?, ?, ?, ?)",
+                [(cur.lastrowid, uid, "owner" if i == 0 else "member", now) for i, uid in enumerate(members)],
+            )
+    conn.close()
+    return groups
+
+
+class Client:
+    def __init__(self, user_id: int, chat_id: int, slow: bool):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.slow = slow
+        self.ws = None
+        self.closed_code = None
+
+
+class Stats:
+    def __init__(self):
+        self.message_latency = {"fast": [], "slow": []}
+        self.signal_latency = {"fast": [], "slow": []}
+        self.messages_sent = 0
+        self.messages_expected = 0
+        self.messages_failed = 0
+        self.signals_sent = 0
+        self.reads_sent = 0
+        self.close_codes: dict[str, int] = {}
+        # После окончания замера закрываем сокеты сами, это уже не обрывы
+        self.finished = False
+
+
+async def reader(client: Client, stats: Stats, args, rnd: random.Random):
+    lane = "slow" if client.slow else "fast"
+    try:
+        async for raw in client.ws:
+            now = time.time_ns()
+            msg = json.loads(raw)
+            kind = msg.get("type")
+            if kind == "message:new":
+                text = msg["payload"].get("text") or ""
+                if text.startswith("wsload "):
+                    sent = int(text.split()[1])
+                    stats.message_latency[lane].append((now - sent) / 1e6)
+                    if rnd.random() < args.read_share:
+                        await client.ws.send(json.dumps({"type": "chat:read", "chat_id": client.chat_id}))
+                        stats.reads_sent += 1
+            elif kind == "call:signal":
+                sent = (msg["payload"].get("signal") or {}).get("t")
+                if sent:
+                    stats.signal_latency[lane].append((now - sent) / 1e6)
+            elif kind == "call:signal_batch":
+                for signal in msg["payload"].get("signals", []):
+                    if signal.get("t"):
+                        stats.signal_latency[lane].append((now - signal["t"]) / 1e6)
+            if client.slow:
+                await asyncio.sleep(args.slow_delay_ms / 1000)
+    except Exception:
+        pass
+    finally:
+        client.closed_code = client.ws.close_code
+        if not stats.finished:
+            key = str(client.closed_code)
+            stats.close_codes[key] = stats.close_codes.get(key, 0) + 1
+
+
+async def connect_all(clients: list[Client], ws_url: str, parallel: int):
+    from websockets.asyncio.client import connect
+
+    gate = asyncio.Semaphore(parallel)
+
+    async def one(client: Client):
+        async with gate:
+            client.ws = await connect(
+                f"{ws_url}/ws?token=wsload-{client.user_id}",
+                ping_interval=None,
+                compression=None,
+                max_queue=4 if client.slow else 64,
+                open_timeout=60,
+                close_timeout=1,
+            )
+            await client.ws.recv()  # hello
+
+    await asyncio.gather(*(one(c) for c in clients))
+
+
+async def send_messages(http, groups: dict[int, list[int]], stats: Stats, args, rnd: random.Random, deadline: float):
+    if args.rate <= 0:
+        return
+    senders = [(chat_id, uid) for chat_id, members in groups.items() for uid in members[: args.senders_per_group]]
+    interval = 1 / args.rate
+    pending = set()
+    next_at = time.monotonic()
+    seq = 0
+
+    async def post(chat_id: int, uid: int, text: str):
+        try:
+            response = await http.post(
+                f"/api/chats/{chat_id}/messages",
+                data={"text": text},
+                headers={"Authorization": f"Bearer wsload-{uid}"},
+            )
+            if response.status_code == 200:
+                stats.messages_expected += len(groups[chat_id])
+            else:
+                stats.messages_failed += 1
+        except Exception:
+            stats.messages_failed += 1
+
+    while time.monotonic() < deadline:
+        chat_id, uid = rnd.choice(senders)
+        seq += 1
+        task = asyncio.create_task(post(chat_id, uid, f"wsload {time.time_ns()} {seq}"))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        stats.messages_sent += 1
+        next_at += interval
+        await asyncio.sleep(max(next_at - time.monotonic(), 0))
+    if pending:
+        await asyncio.gather(*pending)
+
+
+async def call_storm(rooms: dict[int, list[Client]], stats: Stats, args, rnd: random.Random, deadline: float):
+    for chat_id, members in rooms.items():
+        for client in members:
+            await client.ws.send(json.dumps({"type": "call:join", "chat_id": chat_id, "mic": True}))
+    await asyncio.sleep(1)
+    interval = 1 / args.signal_rate
+    payload = "x" * args.signal_bytes
+
+    async def member_loop(chat_id: int, client: Client, peers: list[Client]):
+        while time.monotonic() < deadline and client.closed_code is None:
+            target = rnd.choice(peers)
+            signal = {"t": time.time_ns()}
+            if rnd.random() < args.ice_share:
+                signal["candidate"] = payload
+            else:
+                signal.update(type="offer", sdp=payload)
+            try:
+                await client.ws.send(json.dumps({"type": "call:signal", "chat_id": chat_id, "to_user": target.user_id, "signal": signal}))
+            except Exception:
+                return
+            stats.signals_sent += 1
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*(
+        member_loop(chat_id, client, [p for p in members if p is not client])
+        for chat_id, members in rooms.items()
+        for client in members
+    ))
+
+
+async def run(args) -> dict:
+    import httpx
+
+    fd_limit = raise_fd_limit()
+    if fd_limit < args.users + 100:
+        print(f"ulimit -n = {fd_limit}, на {args.users} сокетов может не хватить", file=sys.stderr)
+    proc = None
+    if args.url:
+        if not args.db:
+            raise SystemExit("для внешнего сервера нужен --db с его базой")
+        base_url, db_path = args.url.rstrip("/"), Path(args.db)
+    else:
+        proc, db_path = start_server(args.port, args.server_env)
+        base_url = f"http://127.0.0.1:{args.port}"
+    server_pid = args.server_pid or (proc.pid if proc else None)
+    rnd = random.Random(args.seed)
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.http_connections, max_keepalive_connections=args.http_connections)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+            await wait_ready(http)
+            groups = seed(db_path, args.users, args.group_size)
+            clients = []
+            for chat_id, members in groups.items():
+                clients += [Client(uid, chat_id, rnd.random() < args.slow_share) for uid in members]
+            started = time.perf_counter()
+            await connect_all(clients, base_url.replace("http", "ws", 1), args.connect_parallel)
+            connect_sec = time.perf_counter() - started
+            print(f"подключено {len(clients)} сокетов за {connect_sec:.1f}s", file=sys.stderr)
+            readers = [asyncio.create_task(reader(c, stats, args, rnd)) for c in clients]
+            by_chat: dict[int, list[Client]] = {}
+            for c in clients:
+                by_chat.setdefault(c.chat_id, []).append(c)
+            rooms = {chat_id: members[: args.call_size] for chat_id, members in list(by_chat.items())[: args.calls]}
+
+            cpu_before = process_cpu_seconds(server_pid) if server_pid else None
+            own_before = resource.getrusage(resource.RUSAGE_SELF)
+            deadline = time.monotonic() + args.seconds
+            await asyncio.gather(
+                send_messages(http, groups, stats, args, rnd, deadline),
+                call_storm(rooms, stats, args, rnd, deadline) if rooms else asyncio.sleep(0),
+            )
+            await asyncio.sleep(args.drain)
+            cpu_after = process_cpu_seconds(server_pid) if server_pid else None
+            own_after = resource.getrusage(resource.RUSAGE_SELF)
+            server_ws = None
+            if args.admin_stats:
+                response = await http.get("/api/admin/ws", headers={"X-Admin-Token": os.getenv("ADMIN_TOKEN", "")})
+                server_ws = response.json() if response.status_code == 200 else None
+            stats.finished = True
+            delivered = sum(len(v) for v in stats.message_latency.values())
+            signals_delivered = sum(len(v) for v in stats.signal_latency.values())
+            for task in readers:
+                task.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            await asyncio.gather(*(c.ws.close() for c in clients), return_exceptions=True)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    events = delivered + signals_delivered
+    server_cpu = round(cpu_after - cpu_before, 3) if cpu_before is not None else None
+    client_cpu = (own_after.ru_utime + own_after.ru_stime) - (own_before.ru_utime + own_before.ru_stime)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in {"out"}},
+        "sockets": len(clients),
+        "groups": len(groups),
+        "connect_sec": round(connect_sec, 2),
+        "messages": {
+            "sent": stats.messages_sent,
+            "failed": stats.messages_failed,
+            "expected_deliveries": stats.messages_expected,
+            "delivered": delivered,
+            "lost": max(stats.messages_expected - delivered, 0),
+            "latency_fast": summarize(stats.message_latency["fast"]),
+            "latency_slow": summarize(stats.message_latency["slow"]),
+        },
+        "reads_sent": stats.reads_sent,
+        "signals": {
+            "sent": stats.signals_sent,
+            "delivered": signals_delivered,
+            "latency_fast": summarize(stats.signal_latency["fast"]),
+            "latency_slow": summarize(stats.signal_latency["slow"]),
+        },
+        "closed_by_server": {code: n for code, n in stats.close_codes.items() if code not in {"1000", "None"}},
+        "server_cpu_sec": server_cpu,
+        "server_cpu_us_per_event": round(server_cpu * 1e6 / events, 1) if server_cpu is not None and events else None,
+        "client_cpu_sec": round(client_cpu, 3),
+        "server_ws": server_ws,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="уже запущенный сервер, например http://127.0.0.1:8000")
+    parser.add_argument("--db", help="база внешнего сервера (туда пишутся тестовые пользователи)")
+    parser.add_argument("--server-pid", type=int, help="pid внешнего сервера для замера CPU")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--server-env", nargs="*", default=[], help="KEY=VALUE для своего сервера")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--senders-per-group", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=20, help="сообщений в секунду на весь тест")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--drain", type=float, default=3, help="ожидание доставки после конца нагрузки")
+    parser.add_argument("--read-share", type=float, default=0.3, help="доля полученных сообщений, на которые шлётся chat:read")
+    parser.add_argument("--slow-share", type=float, default=0.0)
+    parser.add_argument("--slow-delay-ms", type=float, default=200)
+    parser.add_argument("--calls", type=int, default=0, help="число комнат звонков")
+    parser.add_argument("--call-size", type=int, default=4)
+    parser.add_argument("--signal-rate", type=float, default=20, help="call:signal в секунду на участника")
+    parser.add_argument("--signal-bytes", type=int, default=600)
+    parser.add_argument("--ice-share", type=float, default=0.7, help="доля сигналов-кандидатов ICE")
+    parser.add_argument("--connect-parallel", type=int, default=200)
+    parser.add_argument("--http-connections", type=int, default=50)
+    parser.add_argument("--no-admin-stats", dest="admin_stats", action="store_false", help="не снимать /api/admin/ws (токен берётся из ADMIN_TOKEN)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text)
+    m = result["messages"]
+    print(
+        f"sockets={result['sockets']} sent={m['sent']} delivered={m['delivered']}/{m['expected_deliveries']} "
+        f"lost={m['lost']} fast p50/p95/p99={m['latency_fast']['p50_ms']}/{m['latency_fast']['p95_ms']}/"
+        f"{m['latency_fast']['p99_ms']}ms signals={result['signals']['delivered']}/{result['signals']['sent']} "
+        f"p95={result['signals']['latency_fast']['p95_ms']}ms closed={result['closed_by_server']} "
+        f"cpu/event={result['server_cpu_us_per_event']}us"
+    )
+
+
+if __name__ == "__main__":
+    main()
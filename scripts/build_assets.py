@@ -0,0 +1,316 @@
+"""Сборка статики: минификация, имена с хэшем содержимого и сжатые копии.
+
+    python scripts/build_assets.py
+    python scripts/build_assets.py --no-minify
+
+Для static/app.js и static/style.css в static/dist пишутся app.<хэш>.js и
+style.<хэш>.css, рядом — .gz (zlib 9) и .br (quality 11, если установлен
+brotli), и manifest.json с соответствием исходных имён собранным.
+Приложение читает манифест при старте: шаблон подставляет имена с хэшем,
+а /static/dist отдаёт их с Cache-Control: immutable и готовой сжатой
+копией вместо сжатия на лету. Манифест хранит sha256 исходников — если
+static/ изменили после сборки, сервер отдаёт исходный файл, а не старый.
+
+Минификация консервативная и без внешних зависимостей: из JS убираются
+комментарии, отступы и пробелы там, где они не разделяют токены; переводы
+строк, от которых может зависеть автоматическая вставка точки с запятой,
+остаются. Строки, шаблонные строки и регулярные выражения не меняются.
+Файлы предыдущей сборки из манифеста не удаляются, чтобы вкладки со старой
+страницей догрузили свои скрипты.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = Path(__file__).resolve().parent.parent
+
+WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$\\")
+# Пробел рядом с ними всегда лишний: такие символы не склеиваются в другой токен
+JS_SEPARATORS = frozenset("{}()[];,:")
+# Операторы можно прижать к слову или литералу, но не друг к другу (a - -b, a + ++b)
+JS_OPERATORS = frozenset("=<>!&|?*%^~+-/")
+# Перевод строки после них не участвует в ASI: return/throw/x++ ими не заканчиваются
+JS_NEWLINE_AFTER = frozenset("{([,;:=?&|<>")
+JS_NEWLINE_BEFORE = frozenset(")]},;")
+REGEX_KEYWORDS = frozenset({
+    "return", "typeof", "instanceof", "in", "of", "new", "delete", "void",
+    "throw", "case", "do", "else", "yield", "await",
+})
+
+
+def _is_word(ch: str) -> bool:
+    return ch in WORD_CHARS or ch > "\x7f"
+
+
+class _JsMinifier:
+    def __init__(self, source: str):
+        self.src = source
+        self.out: list[str] = []
+        self.pending = ""
+        self.last = ""
+
+    def run(self) -> str:
+        end = self.code(0, nested=False)
+        if end != len(self.src):
+            raise ValueError(f"лишняя '}}' на позиции {end}")
+        return "".join(self.out).strip() + "\n"
+
+    def emit(self, text: str, last: str):
+        if self.pending and self.out:
+            prev = self.out[-1][-1]
+            if not self._drop_space(prev, text[0], self.pending):
+                self.out.append(self.pending)
+        self.pending = ""
+        self.out.append(text)
+        self.last = last
+
+    @staticmethod
+    def _drop_space(prev: str, nxt: str, space: str) -> bool:
+        if space == "\n":
+            return prev in JS_NEWLINE_AFTER or nxt in JS_NEWLINE_BEFORE
+        if prev in JS_SEPARATORS or nxt in JS_SEPARATORS:
+            return True
+        wordish = "\"'`"
+        if prev in JS_OPERATORS and (_is_word(nxt) or nxt in wordish):
+            return True
+        return nxt in JS_OPERATORS and (_is_word(prev) or prev in wordish)
+
+    def space(self, kind: str):
+        if kind == "\n" or not self.pending:
+            self.pending = kind
+
+    def regex_allowed(self) -> bool:
+        if not self.last:
+            return True
+        if _is_word(self.last[-1]):
+            return self.last in REGEX_KEYWORDS
+        return self.last not in (")", "]", "}", "lit")
+
+    def code(self, i: int, nested: bool) -> int:
+        # nested: мы внутри ${...} шаблонной строки, возвращаемся на её '}'
+        src, n = self.src, len(self.src)
+        depth = 0
+        while i < n:
+            ch = src[i]
+            if ch in " \t\r\n\f\v\ufeff\u00a0\u2028\u2029":
+                self.space("\n" if ch in "\r\n\u2028\u2029" else " ")
+                i += 1
+            elif ch == "/" and src.startswith("//", i):
+                end = src.find("\n", i)
+                i = n if end < 0 else end
+            elif ch == "/" and src.startswith("/*", i):
+                end = src.find("*/", i + 2)
+                if end < 0:
+                    raise ValueError(f"незакрытый комментарий на позиции {i}")
+                self.space("\n" if "\n" in src[i:end] else " ")
+                i = end + 2
+            elif ch in "\"'":
+                end = self.string_end(i)
+                self.emit(src[i:end], "lit")
+                i = end
+            elif ch == "`":
+                i = self.template(i)
+            elif ch == "/" and self.regex_allowed():
+                end = self.regex_end(i)
+                self.emit(src[i:end], "lit")
+                i = end
+            elif _is_word(ch):
+                end = i
+                while end < n and _is_word(src[end]):
+                    end += 1
+                self.emit(src[i:end], src[i:end])
+                i = end
+            else:
+                if ch == "{":
+                    depth += 1
+                elif ch == "}":
+                    if nested and depth == 0:
+                        self.pending = ""
+                        return i
+                    depth -= 1
+                self.emit(ch, ch)
+                i += 1
+        if nested:
+            raise ValueError("незакрытая подстановка ${ в шаблонной строке")
+        return i
+
+    def string_end(self, i: int) -> int:
+        src, quote = self.src, self.src[i]
+        i += 1
+        while i < len(src):
+            if src[i] == "\\":
+                i += 2
+            elif src[i] == quote:
+                return i + 1
+            elif src[i] == "\n":
+                break
+            else:
+                i += 1
+        raise ValueError(f"незакрытая строка на позиции {i}")
+
+    def regex_end(self, i: int) -> int:
+        src = self.src
+        start, in_class = i, False
+        i += 1
+        while i < len(src) and src[i] != "\n":
+            ch = src[i]
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == "[":
+                in_class = True
+            elif ch == "]":
+                in_class = False
+            elif ch == "/" and not in_class:
+                i += 1
+                while i < len(src) and _is_word(src[i]):
+                    i += 1
+                return i
+            i += 1
+        raise ValueError(f"не удалось разобрать регулярное выражение на позиции {start}")
+
+    def template(self, i: int) -> int:
+        # Текст шаблона переносится как есть, включая переводы строк и отступы
+        src, n = self.src, len(self.src)
+        start = i
+        i += 1
+        while i < n:
+            ch = src[i]
+            if ch == "\\":
+                i += 2
+            elif ch == "`":
+                self.emit(src[start:i + 1], "lit")
+                return i + 1
+            elif src.startswith("${", i):
+                self.emit(src[start:i + 2], "${")
+                i = self.code(i + 2, nested=True)
+                start = i
+                i += 1
+            else:
+                i += 1
+        raise ValueError(f"незакрытая шаблонная строка на позиции {start}")
+
+
+def minify_js(source: str) -> str:
+    return _JsMinifier(source).run()
+
+
+# Пробел вокруг них в CSS не значим; ':' — только после (a :hover != a:hover),
+# '+' и '-' не трогаем из-за calc()
+CSS_SEPARATORS = frozenset("{};,>")
+
+
+def minify_css(source: str) -> str:
+    out: list[str] = []
+    pending = False
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        if ch.isspace():
+            pending = True
+            i += 1
+            continue
+        if source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            pending = True
+            continue
+        if ch in "\"'":
+            end = i + 1
+            while end < n and source[end] != ch:
+                end += 2 if source[end] == "\\" else 1
+            token = source[i:end + 1]
+        else:
+            token = ch
+        prev = out[-1][-1] if out else ""
+        if pending and prev and prev not in CSS_SEPARATORS and prev != ":" and token[0] not in CSS_SEPARATORS:
+            out.append(" ")
+        pending = False
+        if token == "}" and prev == ";":
+            out.pop()
+        out.append(token)
+        i += len(token)
+    return "".join(out) + "\n"
+
+
+ASSETS = {"app.js": minify_js, "style.css": minify_css}
+
+
+def _write(path: Path, data: bytes):
+    # Через временный файл: работающий сервер не должен отдать недописанный
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def build(static_dir: Path, out_dir: Path, minify: bool = True) -> dict:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / "manifest.json"
+    try:
+        previous = json.loads(manifest_path.read_text(encoding="utf-8")).get("files", {})
+    except (OSError, ValueError):
+        previous = {}
+
+    files = {}
+    for name, minifier in ASSETS.items():
+        source = (static_dir / name).read_bytes()
+        data = minifier(source.decode("utf-8")).encode("utf-8") if minify else source
+        stem, ext = name.rsplit(".", 1)
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        _write(out_dir / hashed, data)
+        _write(out_dir / f"{hashed}.gz", gz)
+        entry = {
+            "file": hashed,
+            "source_sha256": hashlib.sha256(source).hexdigest(),
+            "source_bytes": len(source),
+            "bytes": len(data),
+            "gzip_bytes": len(gz),
+        }
+        if brotli is not None:
+            br = brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+            _write(out_dir / f"{hashed}.br", br)
+            entry["br_bytes"] = len(br)
+        files[name] = entry
+
+    keep = {"manifest.json"}
+    for entry in list(files.values()) + list(previous.values()):
+        keep.update({entry["file"], entry["file"] + ".gz", entry["file"] + ".br"})
+    for path in out_dir.iterdir():
+        if path.is_file() and path.name not in keep:
+            path.unlink()
+    _write(manifest_path, json.dumps({"files": files}, ensure_ascii=False, indent=2).encode("utf-8"))
+    return files
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--static", default=str(ROOT / "static"), help="каталог с исходниками")
+    parser.add_argument("--out", help="куда писать (по умолчанию <static>/dist)")
+    parser.add_argument("--no-minify", action="store_true", help="только хэш и сжатые копии")
+    args = parser.parse_args()
+
+    static_dir = Path(args.static).resolve()
+    out_dir = Path(args.out).resolve() if args.out else static_dir / "dist"
+    try:
+        files = build(static_dir, out_dir, minify=not args.no_minify)
+    except ValueError as exc:
+        sys.exit(f"минификация не удалась: {exc}")
+    for name, entry in files.items():
+        br = f" br={entry['br_bytes']}" if "br_bytes" in entry else ""
+        print(f"{name} -> {entry['file']}: {entry['source_bytes']} -> {entry['bytes']} gzip={entry['gzip_bytes']}{br}")
+    if brotli is None:
+        print("brotli не установлен: .br не собраны, отдаётся .gz", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
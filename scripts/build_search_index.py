@@ -0,0 +1,63 @@
+"""Сборка поискового индекса для сообщений, написанных до появления поиска.
+
+Новые сообщения индексируют триггеры; скрипт проходит старые от новых к
+старым короткими транзакциями, поэтому его можно запускать рядом с сервером.
+При MESSAGE_SHARDS > 0 обрабатывается каждый шард.
+
+    python scripts/build_search_index.py [--db messenger.db] [--batch 5000] [--pause 0.05] [--rebuild]
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="путь к базе (по умолчанию DB_PATH или messenger.db)")
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза между пачками, сек")
+    parser.add_argument("--rebuild", action="store_true", help="очистить индекс и собрать заново")
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ["DB_PATH"] = str(Path(args.db).resolve())
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app
+    app.init_runtime()
+
+    if not app.SEARCH_ENABLED:
+        sys.exit("SQLite собран без FTS5")
+
+    started = time.perf_counter()
+    total = 0
+    for store in app.message_stores:
+        name = store.path.name if store.path else app.DB_PATH.name
+        conn = store.connect()
+        with store.lock, conn:
+            if args.rebuild:
+                conn.execute("DELETE FROM messages_fts")
+                last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+                app.set_meta(conn, "messages_fts_backfill_upto", last_id)
+            pending = int(app.get_meta(conn, "messages_fts_backfill_upto", "0") or 0)
+        conn.close()
+        if not pending:
+            print(f"{name}: индекс актуален")
+            continue
+
+        def progress(done: int, low: int) -> None:
+            rate = (total + done) / max(time.perf_counter() - started, 1e-6)
+            print(f"\r{name}: {done} сообщений, осталось id <= {low}, {rate:.0f}/с", end="", flush=True)
+
+        total += app.backfill_message_index(batch=args.batch, pause=args.pause, progress=progress, store=store)
+        conn = store.connect()
+        with conn:
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+        conn.close()
+        print()
+    print(f"готово: {total} сообщений за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
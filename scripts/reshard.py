@@ -0,0 +1,135 @@
+"""Офлайн-перешардирование сообщений.
+
+Переносит messages, message_reads, message_deleted_for и archive_ranges между
+основной базой и шардами (chat_id % N). Помесячные архивы общие и не двигаются. Сервер на время работы должен быть остановлен.
+
+    python scripts/reshard.py --shards 8        # основная база или 4 шарда -> 8 шардов
+    python scripts/reshard.py --shards 0        # всё обратно в messenger.db
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+COLS = "id, chat_id, user_id, kind, text, file_path, file_name, mime_type, reply_to_message_id, file_size, created_at"
+
+
+def recorded_shards(db_path: Path) -> int:
+    if not db_path.exists():
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = 'message_shards'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return int(row[0]) if row and row[0] else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, required=True, help="новое число шардов (0 — без шардов)")
+    parser.add_argument("--db", help="путь к основной базе")
+    parser.add_argument("--keep", action="store_true", help="не удалять старые файлы шардов")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM основной базы после выноса сообщений")
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ["DB_PATH"] = str(Path(args.db).resolve())
+    root = Path(__file__).resolve().parent.parent
+    db_path = Path(os.getenv("DB_PATH", str(root / "messenger.db")))
+    current = recorded_shards(db_path)
+    if current == args.shards:
+        print(f"уже {current} шардов")
+        return
+    # Открываем приложение в текущей раскладке, иначе оно откажется стартовать
+    os.environ["MESSAGE_SHARDS"] = str(current)
+    sys.path.insert(0, str(root))
+    import app
+    app.init_runtime()
+
+    sources = app.message_stores
+    if args.shards:
+        target_dir = app.shard_path(args.shards, 0).parent
+        if target_dir.exists():
+            shutil.rmtree(target_dir)
+        targets = [
+            app.MessageStore(i, args.shards, app.shard_path(args.shards, i), app.threading.Lock())
+            for i in range(args.shards)
+        ]
+    else:
+        targets = [app.MessageStore(0, 1, None, app.db_lock)]
+
+    # Порог новых id — выше всего, что когда-либо выдавалось: удалённые и
+    # заархивированные сообщения в MAX(id) горячих баз уже не видны
+    floor = 0
+    for store in sources:
+        conn = store.connect()
+        archived = conn.execute("SELECT COALESCE(MAX(max_id), 0) FROM main.archive_ranges").fetchone()[0]
+        floor = max(floor, app.message_id_high_water(conn), store.id_floor, archived)
+        conn.close()
+
+    started = time.perf_counter()
+    for target in targets:
+        target.init()
+        conn = sqlite3.connect(target.path or app.DB_PATH)
+        for source in sources:
+            conn.execute("ATTACH DATABASE ? AS src", (str(source.path or app.DB_PATH),))
+            where = f"m.chat_id % {args.shards} = {target.index}" if args.shards else "1"
+            with conn:
+                moved = conn.execute(
+                    f"INSERT OR IGNORE INTO main.messages({COLS}) SELECT {COLS} FROM src.messages m WHERE {where}"
+                ).rowcount
+                conn.execute(
+                    "INSERT OR IGNORE INTO main.message_reads(message_id, user_id, read_at) "
+                    f"SELECT r.message_id, r.user_id, r.read_at FROM src.message_reads r JOIN src.messages m ON m.id = r.message_id WHERE {where}"
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO main.message_deleted_for(message_id, user_id, created_at) "
+                    f"SELECT d.message_id, d.user_id, d.created_at FROM src.message_deleted_for d JOIN src.messages m ON m.id = d.message_id WHERE {where}"
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO main.archive_ranges(chat_id, month, min_id, max_id, count) "
+                    f"SELECT m.chat_id, m.month, m.min_id, m.max_id, m.count FROM src.archive_ranges m WHERE {where}"
+                )
+            conn.execute("DETACH DATABASE src")
+            print(f"{source.path or app.DB_PATH.name} -> {target.path or app.DB_PATH.name}: {moved}")
+        with conn:
+            # Триггеры уже проиндексировали перенесённое; новые id начнутся выше порога
+            conn.execute(
+                "INSERT INTO app_meta(key, value) VALUES ('messages_fts_backfill_upto', '0') "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+            )
+            if args.shards:
+                conn.execute(
+                    "INSERT INTO app_meta(key, value) VALUES ('message_id_floor', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(floor),),
+                )
+            elif app.message_id_high_water(conn) < floor:
+                # Без шардов id выдаёт AUTOINCREMENT — поднимаем его счётчик до порога
+                if conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'messages'", (floor,)).rowcount == 0:
+                    conn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES ('messages', ?)", (floor,))
+        conn.close()
+
+    conn = app.get_db()
+    with conn:
+        if not current:
+            conn.execute("DELETE FROM message_deleted_for")
+            conn.execute("DELETE FROM message_reads")
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM archive_ranges")
+        app.set_meta(conn, "message_shards", args.shards)
+    if not current and args.vacuum:
+        conn.execute("VACUUM")
+    conn.close()
+    if current and not args.keep:
+        shutil.rmtree(app.shard_path(current, 0).parent)
+    print(f"{current} -> {args.shards} шардов за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Запуск в продакшене.
+
+    python serve.py
+    PORT=8000 python serve.py
+
+`python app.py` остаётся режимом разработки (reload, подсказки LAN-адресов).
+Здесь нет reload, access-лога по умолчанию и опроса сетевых интерфейсов;
+инициализация базы и каталогов идёт в lifespan приложения, а не при импорте.
+Цикл событий и HTTP-парсер — uvloop и httptools, если они установлены
+(uvicorn[standard]), иначе asyncio и h11.
+
+По SIGTERM сервер начинает отвечать 503 на /readyz, ещё SHUTDOWN_DELAY_SEC
+обслуживает HTTP (пока балансировщик не уберёт его из ротации), дописывает
+очереди WebSocket и закрывает сокеты кодом 1012 (до WS_DRAIN_SEC), затем ждёт
+остальные запросы до GRACEFUL_TIMEOUT и останавливает фоновые задачи.
+
+Переменные окружения: HOST, PORT, SHUTDOWN_DELAY_SEC,
+WS_DRAIN_SEC, WS_MAX_FRAME_BYTES, WS_SERVER_MAX_FRAME_BYTES, GRACEFUL_TIMEOUT,
+KEEPALIVE_SEC, BACKLOG, ACCESS_LOG, WS_PER_MESSAGE_DEFLATE, FORWARDED_ALLOW_IPS,
+LOG_LEVEL.
+
+Воркер всегда один, WEB_CONCURRENCY > 1 отклоняется: подключения, комнаты
+звонков, присутствие и кэши (блокировки, single-flight, хвосты чатов) живут в
+памяти процесса, а архивация, чистка и очередь задач работают с теми же
+файлами SQLite. Второй воркер не получил бы событий первого, отдавал бы
+устаревшие данные и дублировал фоновую работу. Масштабирование — после того,
+как это состояние станет общим.
+"""
+import importlib.util
+import logging
+import os
+import sys
+
+import uvicorn
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _pick(preferred: str, module: str, fallback: str) -> str:
+    return preferred if importlib.util.find_spec(module) else fallback
+
+
+class DrainingServer(uvicorn.Server):
+    # uvicorn при остановке сразу рвёт WebSocket кодом 1012 и только потом
+    # шлёт lifespan shutdown — даём приложению дописать очереди раньше
+    async def shutdown(self, sockets=None):
+        app_module = sys.modules.get("app")
+        if app_module is not None and not self.force_exit:
+            await app_module.drain_websockets()
+        await super().shutdown(sockets=sockets)
+
+
+def build_config() -> uvicorn.Config:
+    loop = _pick("uvloop", "uvloop", "asyncio")
+    http = _pick("httptools", "httptools", "h11")
+    return uvicorn.Config(
+        "app:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop=loop,
+        http=http,
+        ws="websockets",
+        # Больший кадр websockets отвергает (1009) ещё до буферизации. Предел выше
+        # WS_MAX_FRAME_BYTES приложения: кадры между ними приложение считает
+        # и закрывает сокет само, по своим правилам
+        ws_max_size=int(os.getenv(
+            "WS_SERVER_MAX_FRAME_BYTES", str(int(os.getenv("WS_MAX_FRAME_BYTES", str(64 * 1024))) * 4))),
+        ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "1") == "1",
+        lifespan="on",
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+        log_level=os.getenv("LOG_LEVEL", "info").lower(),
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        timeout_keep_alive=int(os.getenv("KEEPALIVE_SEC", "15")),
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_TIMEOUT", "20")),
+        backlog=int(os.getenv("BACKLOG", "2048")),
+        server_header=False,
+    )
+
+
+def main() -> None:
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        sys.exit(f"WEB_CONCURRENCY={workers} не поддерживается: состояние и фоновые задачи живут в памяти одного процесса")
+    config = build_config()
+    server = DrainingServer(config)
+    logger.info("serving on %s:%s loop=%s http=%s", config.host, config.port, config.loop, config.http)
+    server.run()
+    if not server.started:
+        sys.exit(3)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ const state = {
     token: localStorage.getItem("token") || "",
     me: null,
     settings: null,
+    bootstrap: null,
+    presence: new Map(),
     chats: [],
     friends: [],
     currentChat: null,
@@ -396,7 +398,9 @@ async function api(path, opts = {}) {
             const data = await res.json();
             msg = data.detail || msg;
         } catch (_) {}
-        throw new Error(msg);
+        const err = new Error(msg);
+        err.status = res.status;
+        throw err;
     }
     return res.json();
 }
@@ -544,10 +548,30 @@ function chatMetaText(chat) {
         const count = state.membersById.size || chat.member_count || 0;
         return count ? `${count} участников` : "Групповой чат";
     }
-    if (chat.peer?.username) return `@${chat.peer.username}`;
+    if (chat.peer?.username) {
+        const seen = presenceText(chat.peer.id);
+        return seen ? `@${chat.peer.username} · ${seen}` : `@${chat.peer.username}`;
+    }
     return "Личный чат";
 }
 
+function presenceText(userId) {
+    const info = state.presence.get(Number(userId));
+    if (!info) return "";
+    if (info.online) return "в сети";
+    if (!info.last_seen) return "";
+    return `был(а) ${formatListTime(info.last_seen)}`;
+}
+
+function applyPresence(users) {
+    (users || []).forEach((u) => state.presence.set(Number(u.user_id), u));
+    const chat = state.currentChat;
+    if (chat && chat.type === "direct") {
+        const metaEl = qs("chatMeta");
+        if (metaEl) metaEl.textContent = chatMetaText(chat);
+    }
+}
+
 function setComposerEnabled(enabled) {
     const input = qs("messageInput");
     if (input) {
@@ -1392,8 +1416,8 @@ async function openChat(chatId) {
     else state.membersById = new Map();
 }
 
-async function loadChats() {
-    state.chats = await api("/api/chats");
+async function loadChats(preloaded = null) {
+    state.chats = preloaded || (await api("/api/chats"));
     renderChatList(qs("chatSearch")?.value || "");
     if (state.currentChatId) {
         const still = state.chats.find((c) => c.id === state.currentChatId);
@@ -1413,8 +1437,8 @@ async function loadChats() {
     }
 }
 
-async function loadFriends() {
-    state.friends = await api("/api/friends");
+async function loadFriends(preloaded = null) {
+    state.friends = preloaded || (await api("/api/friends"));
     const list = qs("friendsList");
     if (!list) return;
     list.innerHTML = "";
@@ -1465,8 +1489,8 @@ async function loadFriends() {
     });
 }
 
-async function loadFriendRequests() {
-    const rows = await api("/api/friends/requests");
+async function loadFriendRequests(preloaded = null) {
+    const rows = preloaded || (await api("/api/friends/requests"));
     const list = qs("friendRequests");
     if (!list) return;
     list.innerHTML = "";
@@ -1511,8 +1535,8 @@ async function loadFriendRequests() {
     });
 }
 
-async function loadGroupInvites() {
-    const rows = await api("/api/groups/invites");
+async function loadGroupInvites(preloaded = null) {
+    const rows = preloaded || (await api("/api/groups/invites"));
     const list = qs("groupInvites");
     if (!list) return;
     list.innerHTML = "";
@@ -1587,6 +1611,10 @@ async function loadBlockedList() {
 }
 
 async function markChatRead(chatId) {
+    if (state.ws && state.ws.readyState === WebSocket.OPEN) {
+        state.ws.send(JSON.stringify({ type: "chat:read", chat_id: chatId }));
+        return;
+    }
     try {
         await api(`/api/chats/${chatId}/read`, { method: "POST", body: "{}" });
     } catch (_) {}
@@ -1701,8 +1729,8 @@ async function sendAssetMessage(assetId) {
     }
 }
 
-async function loadAssets() {
-    state.assets = await api("/api/assets");
+async function loadAssets(preloaded = null) {
+    state.assets = preloaded || (await api("/api/assets"));
     const list = qs("assetsList");
     if (!list) return;
     list.innerHTML = "";
@@ -2634,6 +2662,14 @@ function handleCallWebSocketMessage(msg) {
         case "call:signal":
             handleCallSignal(Number(msg.payload.from_user), msg.payload.signal);
             break;
+        case "call:signal_batch": {
+            const fromUser = Number(msg.payload.from_user);
+            (async () => {
+                for (const signal of msg.payload.signals || [])
+                    await handleCallSignal(fromUser, signal);
+            })();
+            break;
+        }
         case "call:user_state":
             setRemoteTileState(
                 Number(msg.payload.user_id),
@@ -3100,9 +3136,9 @@ function stopWsHeartbeat() {
     }
 }
 
-function scheduleWsReconnect() {
+function scheduleWsReconnect(extraDelay = 0) {
     if (state.wsMeta.reconnectTimer) return;
-    const delay = Math.min(6000, 900 + state.wsMeta.retry * 450);
+    const delay = Math.min(6000, 900 + state.wsMeta.retry * 450) + extraDelay;
     state.wsMeta.retry += 1;
     state.wsMeta.reconnectTimer = setTimeout(() => {
         state.wsMeta.reconnectTimer = null;
@@ -3250,9 +3286,12 @@ function connectWs() {
             loadChats();
         }
         if (msg.type === "message:read") {
-            const { chat_id, reader_id, up_to_id } = msg.payload;
-            if (reader_id !== state.me?.id && chat_id === state.currentChatId)
-                updateReadStatusUpTo(up_to_id);
+            const { chat_id, reads } = msg.payload;
+            if (chat_id === state.currentChatId) {
+                (reads || []).forEach(({ reader_id, up_to_id }) => {
+                    if (reader_id !== state.me?.id) updateReadStatusUpTo(up_to_id);
+                });
+            }
         }
         if (msg.type === "message:deleted_all") {
             if (msg.payload.chat_id === state.currentChatId)
@@ -3309,14 +3348,16 @@ function connectWs() {
             loadChats();
         }
         if (msg.type === "user:blocked") refreshSide();
+        if (msg.type === "presence:update") applyPresence(msg.payload.users);
 
         // Звонки
         handleCallWebSocketMessage(msg);
     };
 
-    ws.onclose = () => {
+    ws.onclose = (ev) => {
         stopWsHeartbeat();
-        scheduleWsReconnect();
+        // 1012 — сервер перезапускается: разносим переподключения клиентов во времени
+        scheduleWsReconnect(ev.code === 1012 ? Math.random() * 4000 : 0);
     };
     ws.onerror = () => {
         try {
@@ -3327,20 +3368,45 @@ function connectWs() {
 
 // ─── Сессия и настройки ──────────────────────────────────────────────────────
 
+function isAuthError(err) {
+    return err?.status === 401 || err?.status === 403;
+}
+
 async function ensureSession() {
     if (!state.token) return false;
+    // Токен сбрасываем только при отказе в доступе (401/403): ошибка одного из
+    // загрузчиков bootstrap или обрыв сети не должны разлогинивать
+    for (let attempt = 0; attempt < 3; attempt++) {
+        try {
+            state.bootstrap = await api("/api/bootstrap");
+            state.me = state.bootstrap.me;
+            return true;
+        } catch (err) {
+            if (isAuthError(err)) return dropSession();
+            await new Promise((resolve) => setTimeout(resolve, 500 * (attempt + 1)));
+        }
+    }
+    // bootstrap так и не ответил — входим по /api/me, onAuthorized догрузит остальное
     try {
+        state.bootstrap = null;
         state.me = await api("/api/me");
         return true;
-    } catch (_) {
-        localStorage.removeItem("token");
-        state.token = "";
+    } catch (err) {
+        if (isAuthError(err)) return dropSession();
+        // Токен сохраняем: после обновления страницы вход повторится
+        setError("authError", "Сервер недоступен, обновите страницу позже");
         return false;
     }
 }
 
-async function loadSettings() {
-    state.settings = await api("/api/settings");
+function dropSession() {
+    localStorage.removeItem("token");
+    state.token = "";
+    return false;
+}
+
+async function loadSettings(preloaded = null) {
+    state.settings = preloaded || (await api("/api/settings"));
     applySettingsToUi();
           
     // Загрузка настроек DND
@@ -3367,12 +3433,18 @@ async function onAuthorized() {
     hide(qs("authScreen"));
     show(qs("app"));
     renderProfileMini();
+    const boot =
+        state.bootstrap || (await api("/api/bootstrap").catch(() => ({})));
+    state.bootstrap = null;
+    if (boot.rtc?.ice_servers?.length) state.call.iceServers = boot.rtc.ice_servers;
+    if (boot.presence) applyPresence(boot.presence);
     await Promise.all([
-        loadChats(),
-        loadFriends(),
-        loadFriendRequests(),
-        loadGroupInvites(),
-        loadSettings(),
+        loadChats(boot.chats),
+        loadFriends(boot.friends),
+        loadFriendRequests(boot.friend_requests),
+        loadGroupInvites(boot.group_invites),
+        loadSettings(boot.settings),
+        boot.assets ? loadAssets(boot.assets) : Promise.resolve(),
     ]);
     connectWs();
     startFallbackSync();
@@ -3391,6 +3463,7 @@ function resetToAuthUi() {
     state.currentChat = null;
     state.currentChatId = null;
     state.messagesById.clear();
+    state.presence.clear();
     state.pendingMessagesByClientId.forEach((pending) => {
         if (pending?.objectUrl && pending.objectUrl.startsWith("blob:")) {
             try {